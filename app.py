@@ -3,17 +3,30 @@ Modas Pathy - Tienda Virtual
 Versión 2.0 - Código refactorizado y optimizado
 """
 
+import atexit
+import click
+import hashlib
+import hmac
+import json
 import os
 import re
 import random
+import socket
+import threading
+import time
+import unicodedata
+import uuid
 import requests
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from functools import wraps
-from urllib.parse import quote
+from operator import attrgetter
+from types import SimpleNamespace
+from urllib.parse import quote, urlencode
 
 from flask import (
     Flask, render_template, redirect, url_for, flash,
-    request, abort, Response, jsonify
+    request, abort, Response, jsonify, make_response, session, g
 )
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import (
@@ -26,15 +39,22 @@ from flask_wtf.csrf import generate_csrf
 from wtforms import (
     StringField, PasswordField, SubmitField, FloatField,
     TextAreaField, SelectField, BooleanField, DateField, HiddenField,
-    SelectMultipleField
+    SelectMultipleField, IntegerField
 )
+from wtforms.widgets import HiddenInput
 from wtforms.validators import (
     DataRequired, InputRequired, Length, Optional, EqualTo, Regexp, NumberRange
 )
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from werkzeug.exceptions import RequestEntityTooLarge
-from sqlalchemy import or_, JSON, func, text, inspect
+from itsdangerous import URLSafeSerializer, BadData
+from PIL import Image, ImageOps
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from sqlalchemy import or_, and_, JSON, func, text, inspect, event, case, select, bindparam, insert, update, delete, union, ColumnElement
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+from sqlalchemy.orm import Session, joinedload
 from sqlalchemy.orm.attributes import flag_modified
 
 from config import config
@@ -58,145 +78,535 @@ PROFILE_FOLDER = app.config.get('PROFILE_FOLDER', os.path.join('static', 'perfil
 QR_FOLDER = app.config.get('QR_FOLDER', os.path.join('static', 'qr'))
 CUSTOM_ORDER_FOLDER = app.config.get('CUSTOM_ORDER_FOLDER', os.path.join('static', 'custom_orders'))
 ALLOWED_EXTENSIONS = app.config.get('ALLOWED_EXTENSIONS', {'png', 'jpg', 'jpeg', 'gif', 'webp'})
+IMAGE_VARIANT_WIDTHS = app.config.get('IMAGE_VARIANT_WIDTHS', {'card': 480, 'detail': 960, 'zoom': 1600})
 
 for folder in (UPLOAD_FOLDER, PROFILE_FOLDER, QR_FOLDER, CUSTOM_ORDER_FOLDER):
     os.makedirs(folder, exist_ok=True)
 
-def ensure_client_schema():
-    """Garantiza columnas opcionales en la tabla de clientes (p. ej. carnet/NIT)."""
-    try:
-        inspector = inspect(db.engine)
-        tables = inspector.get_table_names()
-        if 'clients' not in tables:
-            return
-        columns = {col['name'] for col in inspector.get_columns('clients')}
-        if 'id_number' not in columns:
-            with db.engine.begin() as conn:
-                conn.execute(text('ALTER TABLE clients ADD COLUMN id_number VARCHAR(64)'))
-        if 'is_deleted' not in columns:
-            with db.engine.begin() as conn:
-                conn.execute(text('ALTER TABLE clients ADD COLUMN is_deleted BOOLEAN DEFAULT 0'))
-        if 'deleted_at' not in columns:
-            with db.engine.begin() as conn:
-                conn.execute(text('ALTER TABLE clients ADD COLUMN deleted_at DATETIME'))
-        if 'deleted_by' not in columns:
-            with db.engine.begin() as conn:
-                conn.execute(text('ALTER TABLE clients ADD COLUMN deleted_by VARCHAR(64)'))
-    except Exception as exc:
-        try:
-            app.logger.warning('No se pudo verificar/actualizar esquema de clientes: %s', exc)
-        except Exception:
-            print(f'No se pudo verificar/actualizar esquema de clientes: {exc}')
+# Estado del indice de busqueda: None hasta comprobar (en el primer uso) si existe la tabla FTS5
+_search_state = {'enabled': None}
 
-def ensure_user_permissions_schema():
-    """Crea/ajusta columnas de permisos y tabla de historial."""
-    try:
-        inspector = inspect(db.engine)
-        tables = inspector.get_table_names()
-        if 'users' in tables:
-            columns = {col['name'] for col in inspector.get_columns('users')}
-            if 'permissions' not in columns:
-                with db.engine.begin() as conn:
-                    conn.execute(text('ALTER TABLE users ADD COLUMN permissions TEXT'))
-        if 'user_permission_logs' not in tables:
-            with db.engine.begin() as conn:
-                conn.execute(text(
-                    """
-                    CREATE TABLE IF NOT EXISTS user_permission_logs (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER NOT NULL,
-                        changed_by VARCHAR(64) NOT NULL,
-                        permissions_before TEXT,
-                        permissions_after TEXT,
-                        note VARCHAR(256),
-                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY(user_id) REFERENCES users(id)
-                    )
-                    """
-                ))
-    except Exception as exc:
-        try:
-            app.logger.warning('No se pudo verificar/actualizar esquema de usuarios: %s', exc)
-        except Exception:
-            print(f'No se pudo verificar/actualizar esquema de usuarios: {exc}')
+# Imagen principal: la marcada como principal o, si no hay, la primera subida
+BACKFILL_MAIN_IMAGES_SQL = """
+    UPDATE products SET main_image_filename = (
+        SELECT pi.filename FROM product_images pi
+        WHERE pi.product_id = products.id
+        ORDER BY pi.is_main DESC, pi.id ASC
+        LIMIT 1
+    )
+"""
 
-def ensure_custom_order_schema():
-    """Ajusta columnas de papelera en pedidos."""
-    try:
-        inspector = inspect(db.engine)
-        tables = inspector.get_table_names()
-        if 'custom_orders' not in tables:
-            return
-        columns = {col['name'] for col in inspector.get_columns('custom_orders')}
+BACKFILL_MAIN_IMAGE_VARIANTS_SQL = """
+    UPDATE products SET main_image_variants = (
+        SELECT pi.variants FROM product_images pi
+        WHERE pi.product_id = products.id
+        ORDER BY pi.is_main DESC, pi.id ASC
+        LIMIT 1
+    )
+"""
+
+# Contadores de prendas en custom_orders: columna -> estados de prenda que cuenta (None = todos)
+ITEM_PROGRESS_COLUMNS = (
+    ('items_total', None),
+    ('items_en_taller', {'asignado'}),
+    ('items_asignadas', {'asignado', 'recibido', 'listo', 'entregado'}),
+    ('items_recibidas', {'recibido', 'listo', 'entregado'}),
+    ('items_listas', {'listo', 'entregado'}),
+    ('items_entregadas', {'entregado'}),
+)
+
+# Los mismos contadores calculados desde custom_order_items (relleno inicial y recuento)
+BACKFILL_ORDER_PROGRESS_SQL = """
+    UPDATE custom_orders SET
+        items_total = (SELECT COUNT(*) FROM custom_order_items i WHERE i.order_id = custom_orders.id),
+        items_en_taller = (SELECT COUNT(*) FROM custom_order_items i WHERE i.order_id = custom_orders.id
+                           AND i.workshop_status = 'asignado'),
+        items_asignadas = (SELECT COUNT(*) FROM custom_order_items i WHERE i.order_id = custom_orders.id
+                           AND i.workshop_status IN ('asignado', 'recibido', 'listo', 'entregado')),
+        items_recibidas = (SELECT COUNT(*) FROM custom_order_items i WHERE i.order_id = custom_orders.id
+                           AND i.workshop_status IN ('recibido', 'listo', 'entregado')),
+        items_listas = (SELECT COUNT(*) FROM custom_order_items i WHERE i.order_id = custom_orders.id
+                        AND i.workshop_status IN ('listo', 'entregado')),
+        items_entregadas = (SELECT COUNT(*) FROM custom_order_items i WHERE i.order_id = custom_orders.id
+                            AND i.workshop_status = 'entregado')
+"""
+
+# -------------------------------------------------
+#               MIGRACIONES DE ESQUEMA
+# -------------------------------------------------
+# Cada paso se aplica una sola vez, en orden, y la version alcanzada queda en schema_version.
+# Los pasos deben poder repetirse sin efecto (IF NOT EXISTS, columnas que ya existen): si el
+# proceso muere entre el paso y la escritura de la version, se vuelve a ejecutar completo.
+
+def _table_columns(inspector, table):
+    return {col['name'] for col in inspector.get_columns(table)}
+
+def _add_missing_columns(table, columns):
+    """Agrega las columnas (nombre, tipo SQL) que falten en la tabla; devuelve las agregadas."""
+    inspector = inspect(db.engine)
+    if table not in inspector.get_table_names():
+        return []
+    existing = _table_columns(inspector, table)
+    missing = [(name, type_def) for name, type_def in columns if name not in existing]
+    if missing:
         with db.engine.begin() as conn:
-            if 'is_deleted' not in columns:
-                conn.execute(text('ALTER TABLE custom_orders ADD COLUMN is_deleted BOOLEAN DEFAULT 0'))
-            if 'deleted_at' not in columns:
-                conn.execute(text('ALTER TABLE custom_orders ADD COLUMN deleted_at DATETIME'))
-            if 'deleted_by' not in columns:
-                conn.execute(text('ALTER TABLE custom_orders ADD COLUMN deleted_by VARCHAR(64)'))
-            if 'assigned_to' not in columns:
-                conn.execute(text('ALTER TABLE custom_orders ADD COLUMN assigned_to INTEGER'))
-            if 'assigned_at' not in columns:
-                conn.execute(text('ALTER TABLE custom_orders ADD COLUMN assigned_at DATETIME'))
-            if 'shop_due_date' not in columns:
-                conn.execute(text('ALTER TABLE custom_orders ADD COLUMN shop_due_date DATE'))
-    except Exception as exc:
-        try:
-            app.logger.warning('No se pudo verificar/actualizar esquema de pedidos: %s', exc)
-        except Exception:
-            print(f'No se pudo verificar/actualizar esquema de pedidos: {exc}')
+            for name, type_def in missing:
+                conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {name} {type_def}'))
+    return [name for name, _ in missing]
+
+def _migrate_legacy_columns():
+    """Columnas que antes agregaban a mano fix_db.py y fix_db_extra.py."""
+    _add_missing_columns('clients', [('measurements', 'TEXT')])
+    _add_missing_columns('custom_orders', [('measurements', 'TEXT')])
+    _add_missing_columns('site_settings', [('exchange_rate', 'FLOAT DEFAULT 6.96'), ('qr_image', 'VARCHAR(256)')])
+    _add_missing_columns('users', [('is_superadmin', 'BOOLEAN DEFAULT 0'), ('profile_image', 'VARCHAR(256)')])
+    _add_missing_columns('themes', [('is_default', 'BOOLEAN DEFAULT 0')])
+
+def _migrate_client_columns():
+    """Carnet/NIT y papelera de clientes."""
+    _add_missing_columns('clients', [
+        ('id_number', 'VARCHAR(64)'),
+        ('is_deleted', 'BOOLEAN DEFAULT 0'),
+        ('deleted_at', 'DATETIME'),
+        ('deleted_by', 'VARCHAR(64)'),
+    ])
+
+def _migrate_user_permissions():
+    """Permisos por usuario y tabla de historial de permisos."""
+    _add_missing_columns('users', [('permissions', 'TEXT')])
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS user_permission_logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                changed_by VARCHAR(64) NOT NULL,
+                permissions_before TEXT,
+                permissions_after TEXT,
+                note VARCHAR(256),
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(user_id) REFERENCES users(id)
+            )
+        """))
+
+def _migrate_custom_order_columns():
+    """Papelera, asignacion y entrega a tienda en pedidos personalizados."""
+    _add_missing_columns('custom_orders', [
+        ('is_deleted', 'BOOLEAN DEFAULT 0'),
+        ('deleted_at', 'DATETIME'),
+        ('deleted_by', 'VARCHAR(64)'),
+        ('assigned_to', 'INTEGER'),
+        ('assigned_at', 'DATETIME'),
+        ('shop_due_date', 'DATE'),
+    ])
+    with db.engine.begin() as conn:
+        # Consultas incrementales (?since=) del tablero de talleres
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_custom_orders_updated_at ON custom_orders (updated_at)'))
+
+def _migrate_workshops():
+    """Talleres, asignacion por prenda y contadores de prendas por pedido."""
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS workshops (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name VARCHAR(120) NOT NULL,
+                phone VARCHAR(32),
+                is_active BOOLEAN DEFAULT 1,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """))
+    _add_missing_columns('custom_order_items', [
+        ('workshop_id', 'INTEGER'),
+        ('workshop_status', 'VARCHAR(30)'),
+        ('workshop_assigned_at', 'DATETIME'),
+        ('workshop_due_date', 'DATE'),
+        ('workshop_returned_at', 'DATETIME'),
+    ])
+    _add_missing_columns('custom_orders', [('delivered_at', 'DATETIME')] + [
+        (column, 'INTEGER NOT NULL DEFAULT 0') for column, _ in ITEM_PROGRESS_COLUMNS
+    ])
+    with db.engine.begin() as conn:
+        conn.execute(text(
+            "UPDATE custom_order_items SET workshop_status = 'pendiente' WHERE workshop_status IS NULL"
+        ))
+        conn.execute(text(BACKFILL_ORDER_PROGRESS_SQL))
+
+def _migrate_product_columns():
+    """Imagen principal y derivados desnormalizados en productos, y control de stock."""
+    added = _add_missing_columns('products', [
+        ('main_image_filename', 'VARCHAR(256)'),
+        ('main_image_variants', 'JSON'),
+        ('track_stock', 'BOOLEAN DEFAULT 0'),
+    ])
+    _add_missing_columns('product_images', [('variants', 'JSON')])
+    with db.engine.begin() as conn:
+        if 'main_image_filename' in added:
+            conn.execute(text(BACKFILL_MAIN_IMAGES_SQL))
+        if 'main_image_variants' in added:
+            conn.execute(text(BACKFILL_MAIN_IMAGE_VARIANTS_SQL))
+
+def _migrate_cache_versions():
+    """Versiones de cache compartidas entre workers."""
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS cache_versions (
+                name VARCHAR(64) PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """))
+
+def _migrate_jobs():
+    """Cola de tareas en segundo plano."""
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind VARCHAR(64) NOT NULL,
+                payload JSON,
+                status VARCHAR(16) NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL DEFAULT 3,
+                run_at DATETIME NOT NULL,
+                locked_at DATETIME,
+                locked_by VARCHAR(64),
+                last_error TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_jobs_status_run_at ON jobs (status, run_at)'))
+
+def _migrate_order_columns():
+    """Identificadores de PayPal (confirmacion idempotente) e indices del listado de pedidos."""
+    _add_missing_columns('orders', [
+        ('paypal_order_id', 'VARCHAR(64)'),
+        ('paypal_capture_id', 'VARCHAR(64)'),
+    ])
+    with db.engine.begin() as conn:
+        conn.execute(text(
+            'CREATE UNIQUE INDEX IF NOT EXISTS ix_orders_paypal_order_id ON orders (paypal_order_id)'
+        ))
+        # Listado del panel: orden por fecha, filtrado por estado o metodo de pago
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_orders_created_at ON orders (created_at, id)'))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_orders_status_created_at ON orders (status, created_at)'))
+        conn.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_orders_payment_method_created_at ON orders (payment_method, created_at)'
+        ))
+
+def _migrate_idempotency_keys():
+    """Claves de idempotencia del checkout."""
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key VARCHAR(48) PRIMARY KEY,
+                fingerprint VARCHAR(16) NOT NULL,
+                response JSON NOT NULL,
+                expires_at DATETIME NOT NULL
+            )
+        """))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_idempotency_keys_expires_at ON idempotency_keys (expires_at)'))
+
+def _migrate_code_sequences():
+    """Contadores para codigos de pedido (uno por prefijo y ano)."""
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS code_sequences (
+                name VARCHAR(32) PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            )
+        """))
+
+def _migrate_stock_reservations():
+    """Reservas de stock (ventana entre crear y capturar en PayPal)."""
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS stock_reservations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                product_id INTEGER NOT NULL REFERENCES products (id),
+                quantity INTEGER NOT NULL DEFAULT 1,
+                paypal_order_id VARCHAR(64) NOT NULL UNIQUE,
+                expires_at DATETIME NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_stock_reservations_expires_at ON stock_reservations (expires_at)'))
+
+def _migrate_daily_stats():
+    """Resumenes diarios del panel, calculados desde los pedidos existentes."""
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS daily_stats (
+                day DATE NOT NULL,
+                metric VARCHAR(32) NOT NULL,
+                dimension VARCHAR(32) NOT NULL DEFAULT '',
+                count INTEGER NOT NULL DEFAULT 0,
+                amount FLOAT NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, metric, dimension)
+            )
+        """))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_daily_stats_metric_day ON daily_stats (metric, day)'))
+    rebuild_daily_stats()
 
-def ensure_workshop_schema():
-    """Crea tabla de talleres y columnas de asignacion por prenda si faltan."""
+def _migrate_product_search():
+    """Indice FTS5 de productos (solo SQLite; sin FTS5 el catalogo busca con LIKE)."""
+    if db.engine.dialect.name != 'sqlite':
+        return
     try:
-        inspector = inspect(db.engine)
-        tables = inspector.get_table_names()
         with db.engine.begin() as conn:
-            if 'workshops' not in tables:
+            conn.execute(text("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS product_search USING fts5(
+                    name, description, category, promo,
+                    tokenize = 'unicode61'
+                )
+            """))
+    except OperationalError as exc:
+        app.logger.warning('FTS5 no disponible, la busqueda de productos usara LIKE: %s', exc)
+        return
+    _search_state['enabled'] = None
+    rebuild_product_search()
+
+def _history_entry_time(entry):
+    """Fecha UTC de una entrada antigua de _history (guardada en hora local GMT-4)."""
+    for value, fmt in ((entry.get('fecha_iso'), None), ((entry.get('fecha') or '')[:19], '%Y-%m-%d %H:%M:%S')):
+        if not value:
+            continue
+        try:
+            local = datetime.fromisoformat(value) if fmt is None else datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return local + timedelta(hours=4)
+    return datetime.utcnow()
+
+def measurement_delta(before, after):
+    """Campos que cambiaron entre dos juegos de medidas: {campo: [antes, despues]}."""
+    before = before if isinstance(before, dict) else {}
+    after = after if isinstance(after, dict) else {}
+    return {
+        k: [before.get(k), after.get(k)]
+        for k in sorted(set(before) | set(after))
+        if before.get(k) != after.get(k)
+    }
+
+def _migrate_custom_order_events():
+    """Tabla de eventos de pedidos personalizados; mueve ahi el JSON measurements._history."""
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS custom_order_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                order_id INTEGER NOT NULL REFERENCES custom_orders (id),
+                status VARCHAR(30),
+                note TEXT,
+                actor VARCHAR(128),
+                created_at DATETIME NOT NULL
+            )
+        """))
+        conn.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_custom_order_events_order_id ON custom_order_events (order_id, id)'
+        ))
+        rows = conn.execute(text(
+            "SELECT id, measurements FROM custom_orders WHERE measurements LIKE '%_history%'"
+        )).all()
+        for order_id, raw in rows:
+            data = json.loads(raw) if isinstance(raw, str) else (raw or {})
+            if not isinstance(data, dict) or '_history' not in data:
+                continue
+            events = [{
+                'order_id': order_id,
+                'status': entry.get('estado'),
+                'note': entry.get('nota') or '',
+                'actor': entry.get('usuario'),
+                'created_at': _history_entry_time(entry)
+            } for entry in data.pop('_history') or [] if isinstance(entry, dict)]
+            data.pop('_progress', None)  # Resumen antiguo, ahora en columnas items_*
+            if events:
                 conn.execute(text("""
-                    CREATE TABLE IF NOT EXISTS workshops (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        name VARCHAR(120) NOT NULL,
-                        phone VARCHAR(32),
-                        is_active BOOLEAN DEFAULT 1,
-                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                    )
-                """))
-            if 'custom_order_items' in tables:
-                item_cols = {col['name'] for col in inspector.get_columns('custom_order_items')}
-                if 'workshop_id' not in item_cols:
-                    conn.execute(text('ALTER TABLE custom_order_items ADD COLUMN workshop_id INTEGER'))
-                if 'workshop_status' not in item_cols:
-                    conn.execute(text("ALTER TABLE custom_order_items ADD COLUMN workshop_status VARCHAR(30)"))
-                if 'workshop_assigned_at' not in item_cols:
-                    conn.execute(text("ALTER TABLE custom_order_items ADD COLUMN workshop_assigned_at DATETIME"))
-                if 'workshop_due_date' not in item_cols:
-                    conn.execute(text("ALTER TABLE custom_order_items ADD COLUMN workshop_due_date DATE"))
-                if 'workshop_returned_at' not in item_cols:
-                    conn.execute(text("ALTER TABLE custom_order_items ADD COLUMN workshop_returned_at DATETIME"))
+                    INSERT INTO custom_order_events (order_id, status, note, actor, created_at)
+                    VALUES (:order_id, :status, :note, :actor, :created_at)
+                """).bindparams(bindparam('created_at', type_=db.DateTime)), events)
+            conn.execute(text('UPDATE custom_orders SET measurements = :data WHERE id = :id'),
+                         {'data': json.dumps(data), 'id': order_id})
+
+def _migrate_client_measurement_revisions():
+    """Revisiones de medidas de clientes; convierte el JSON measurements._history en diferencias."""
+    keep = max(app.config.get('CLIENT_MEASUREMENT_REVISIONS_KEEP', 20), 1)
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS client_measurement_revisions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                client_id INTEGER NOT NULL REFERENCES clients (id),
+                garment_type VARCHAR(40) NOT NULL,
+                changes JSON NOT NULL,
+                actor VARCHAR(128),
+                created_at DATETIME NOT NULL
+            )
+        """))
+        conn.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_client_measurement_revisions_client '
+            'ON client_measurement_revisions (client_id, garment_type, id)'
+        ))
+        conn.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_client_measurement_revisions_created_at '
+            'ON client_measurement_revisions (created_at)'
+        ))
+        rows = conn.execute(text(
+            "SELECT id, measurements FROM clients WHERE measurements LIKE '%_history%'"
+        )).all()
+        for client_id, raw in rows:
+            data = json.loads(raw) if isinstance(raw, str) else (raw or {})
+            if not isinstance(data, dict) or '_history' not in data:
+                continue
+            by_garment = {}
+            for entry in data.pop('_history') or []:
+                if not isinstance(entry, dict):
+                    continue
+                changes = measurement_delta(entry.get('antes'), entry.get('despues'))
+                if not changes:
+                    continue
+                garment = (entry.get('garment_type') or '')[:40]
+                by_garment.setdefault(garment, []).append({
+                    'client_id': client_id,
+                    'garment_type': garment,
+                    'changes': json.dumps(changes),
+                    'actor': entry.get('changed_by'),
+                    'created_at': _history_entry_time(entry)
+                })
+            revisions = [rev for revs in by_garment.values() for rev in revs[-keep:]]
+            if revisions:
                 conn.execute(text("""
-                    UPDATE custom_order_items
-                    SET workshop_status = COALESCE(workshop_status, 'pendiente')
-                    WHERE workshop_status IS NULL
-                """))
-            if 'custom_orders' in tables:
-                order_cols = {col['name'] for col in inspector.get_columns('custom_orders')}
-                if 'delivered_at' not in order_cols:
-                    conn.execute(text("ALTER TABLE custom_orders ADD COLUMN delivered_at DATETIME"))
+                    INSERT INTO client_measurement_revisions (client_id, garment_type, changes, actor, created_at)
+                    VALUES (:client_id, :garment_type, :changes, :actor, :created_at)
+                """).bindparams(bindparam('created_at', type_=db.DateTime)), revisions)
+            conn.execute(text('UPDATE clients SET measurements = :data WHERE id = :id'),
+                         {'data': json.dumps(data), 'id': client_id})
+
+def _migrate_client_search():
+    """Columnas normalizadas y trigramas para buscar clientes; se llenan desde los datos actuales."""
+    _add_missing_columns('clients', [
+        ('name_search', 'VARCHAR(128)'),
+        ('phone_digits', 'VARCHAR(32)'),
+        ('id_number_search', 'VARCHAR(64)'),
+    ])
+    with db.engine.begin() as conn:
+        for column in ('name_search', 'phone_digits', 'id_number_search'):
+            conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_clients_{column} ON clients ({column})'))
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS client_search_trigrams (
+                trigram VARCHAR(3) NOT NULL,
+                client_id INTEGER NOT NULL REFERENCES clients (id),
+                PRIMARY KEY (trigram, client_id)
+            )
+        """))
+        conn.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_client_search_trigrams_client_id ON client_search_trigrams (client_id)'
+        ))
+    rebuild_client_search()
+
+def _migrate_paypal_amounts():
+    """Monto esperado de cada orden PayPal, para comprobarlo al confirmar el pago."""
+    _add_missing_columns('stock_reservations', [('amount_usd', 'FLOAT')])
+    _add_missing_columns('orders', [('paypal_amount', 'FLOAT')])
+
+def _migrate_paypal_status():
+    """Ultimo estado de PayPal de cada pedido, para no rechazar pagos que pudieron cobrarse."""
+    _add_missing_columns('orders', [('paypal_status', 'VARCHAR(32)')])
+
+def _migrate_order_stock_quantity():
+    """Unidades descontadas por cada pedido, para devolver solo esas al rechazarlo o borrarlo."""
+    _add_missing_columns('orders', [('stock_quantity', 'INTEGER NOT NULL DEFAULT 0')])
+
+# (version, descripcion, paso). Solo se agregan pasos al final; nunca se renumeran.
+MIGRATIONS = (
+    (1, 'Columnas de fix_db.py y fix_db_extra.py', _migrate_legacy_columns),
+    (2, 'Carnet y papelera de clientes', _migrate_client_columns),
+    (3, 'Permisos de usuarios', _migrate_user_permissions),
+    (4, 'Papelera y asignacion de pedidos personalizados', _migrate_custom_order_columns),
+    (5, 'Talleres y contadores de prendas', _migrate_workshops),
+    (6, 'Imagen principal y stock de productos', _migrate_product_columns),
+    (7, 'Versiones de cache', _migrate_cache_versions),
+    (8, 'Cola de tareas', _migrate_jobs),
+    (9, 'PayPal e indices de pedidos web', _migrate_order_columns),
+    (10, 'Claves de idempotencia', _migrate_idempotency_keys),
+    (11, 'Contadores de codigos', _migrate_code_sequences),
+    (12, 'Reservas de stock', _migrate_stock_reservations),
+    (13, 'Resumenes diarios', _migrate_daily_stats),
+    (14, 'Indice de busqueda de productos', _migrate_product_search),
+    (15, 'Eventos de pedidos personalizados', _migrate_custom_order_events),
+    (16, 'Revisiones de medidas de clientes', _migrate_client_measurement_revisions),
+    (17, 'Busqueda de clientes', _migrate_client_search),
+    (18, 'Montos de ordenes PayPal', _migrate_paypal_amounts),
+    (19, 'Estado PayPal de pedidos', _migrate_paypal_status),
+    (20, 'Stock tomado por pedidos', _migrate_order_stock_quantity),
+)
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version():
+    """Version aplicada segun schema_version (0 si la tabla aun no existe)."""
+    try:
+        with db.engine.connect() as conn:
+            return conn.execute(text('SELECT version FROM schema_version WHERE id = 1')).scalar() or 0
+    except (OperationalError, ProgrammingError):
+        return 0
+
+
+def _set_schema_version(version):
+    with db.engine.begin() as conn:
+        updated = conn.execute(
+            text('UPDATE schema_version SET version = :version, updated_at = CURRENT_TIMESTAMP WHERE id = 1'),
+            {'version': version}
+        ).rowcount
+        if not updated:
+            conn.execute(
+                text('INSERT INTO schema_version (id, version, updated_at) VALUES (1, :version, CURRENT_TIMESTAMP)'),
+                {'version': version}
+            )
+
+
+def apply_migrations(target=None):
+    """Crea las tablas que falten y aplica en orden los pasos pendientes; devuelve los aplicados."""
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                id INTEGER PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """))
+    db.create_all()
+    current = get_schema_version()
+    applied = []
+    for version, description, step in MIGRATIONS:
+        if version <= current or (target is not None and version > target):
+            continue
+        step()
+        db.session.commit()  # Pasos que reconstruyen datos con la sesion
+        _set_schema_version(version)
+        app.logger.info('Migracion %s aplicada: %s', version, description)
+        applied.append((version, description))
+    return applied
+
+
+def check_schema_version():
+    """Al iniciar: una sola lectura de schema_version; si hay pasos pendientes los aplica
+    (MIGRATIONS_AUTO_APPLY) o avisa para ejecutar `flask db-upgrade`."""
+    try:
+        version = get_schema_version()
+        if version >= SCHEMA_VERSION:
+            return version
+        if not app.config.get('MIGRATIONS_AUTO_APPLY', True):
+            app.logger.warning('Esquema en version %s de %s: ejecuta flask db-upgrade', version, SCHEMA_VERSION)
+            return version
+        apply_migrations()
+        return get_schema_version()
     except Exception as exc:
+        db.session.rollback()
         try:
-            app.logger.warning('No se pudo verificar/actualizar esquema de talleres: %s', exc)
+            app.logger.warning('No se pudieron aplicar las migraciones de esquema: %s', exc)
         except Exception:
-            print(f'No se pudo verificar/actualizar esquema de talleres: {exc}')
-
-# Intentar ajustar el esquema al iniciar la aplicacion
-with app.app_context():
-    ensure_client_schema()
-    ensure_user_permissions_schema()
-    ensure_custom_order_schema()
-    ensure_workshop_schema()
+            print(f'No se pudieron aplicar las migraciones de esquema: {exc}')
+        return None
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -258,6 +668,7 @@ class Product(db.Model):
     price = db.Column(db.Float, nullable=False)
     original_price = db.Column(db.Float)  # Para mostrar descuentos
     stock = db.Column(db.Integer, default=0)
+    track_stock = db.Column(db.Boolean, default=False)  # Solo se descuenta stock en piezas limitadas
     sku = db.Column(db.String(50))
     is_on_sale = db.Column(db.Boolean, default=False)
     promo_text = db.Column(db.String(80))
@@ -270,6 +681,8 @@ class Product(db.Model):
     is_featured = db.Column(db.Boolean, default=False)
     
     views = db.Column(db.Integer, default=0)
+    main_image_filename = db.Column(db.String(256))  # Copia de la imagen principal para listados
+    main_image_variants = db.Column(JSON(none_as_null=True))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -279,11 +692,8 @@ class Product(db.Model):
     
     @property
     def main_image(self):
-        """Obtiene la imagen principal del producto"""
-        img = self.images.filter_by(is_main=True).first()
-        if not img:
-            img = self.images.first()
-        return img
+        """Obtiene la imagen principal del producto (consulta; en listados usar main_image_filename)"""
+        return self.images.order_by(ProductImage.is_main.desc(), ProductImage.id.asc()).first()
     
     @property
     def has_discount(self):
@@ -314,6 +724,8 @@ class ProductImage(db.Model):
     filename = db.Column(db.String(256), nullable=False)
     is_main = db.Column(db.Boolean, default=False)
     order = db.Column(db.Integer, default=0)
+    # Derivados por tamano: {'card': {'width', 'height', 'webp', 'jpeg'}, 'detail': ..., 'zoom': ...}
+    variants = db.Column(JSON(none_as_null=True))
     product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
@@ -331,19 +743,75 @@ class Order(db.Model):
     image_url = db.Column(db.String(512))
     payment_method = db.Column(db.String(20), nullable=False)  # whatsapp / paypal / qr
     total = db.Column(db.Float, nullable=False, default=0)
-    status = db.Column(db.String(50), default='Recibido')
+    # active_history: el flush necesita el estado previo para ajustar daily_stats
+    status = db.column_property(db.Column(db.String(50), default='Recibido'), active_history=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     customer_name = db.Column(db.String(128))
     customer_phone = db.Column(db.String(32))
     history = db.Column(JSON, default=list)
     order_notes = db.Column(db.Text)
+    paypal_order_id = db.Column(db.String(64), unique=True, index=True)
+    paypal_capture_id = db.Column(db.String(64))
+    paypal_amount = db.Column(db.Float)  # USD que la tienda pidio a PayPal al crear la orden
+    paypal_status = db.Column(db.String(32))  # Ultimo estado visto en PayPal al conciliar
+    stock_quantity = db.Column(db.Integer, nullable=False, default=0)  # Unidades que el pedido tomo del stock
     
     product = db.relationship('Product', back_populates='orders')
     
+    __table_args__ = (
+        db.Index('ix_orders_created_at', 'created_at', 'id'),
+        db.Index('ix_orders_status_created_at', 'status', 'created_at'),
+        db.Index('ix_orders_payment_method_created_at', 'payment_method', 'created_at'),
+    )
+    
     def __repr__(self):
         return f'<Order {self.order_code}>'
 
 
+class StockReservation(db.Model):
+    """Orden PayPal creada por la tienda, con el stock apartado mientras el cliente paga.
+
+    Tambien existe (con quantity 0) para productos sin control de stock: es la prueba de que
+    el ID de PayPal salio de /api/checkout/paypal, y fija producto y monto.
+    """
+    __tablename__ = 'stock_reservations'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False, default=1)
+    paypal_order_id = db.Column(db.String(64), nullable=False, unique=True)
+    amount_usd = db.Column(db.Float)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<StockReservation {self.paypal_order_id} x{self.quantity}>'
+
+
+class CodeSequence(db.Model):
+    """Contador por prefijo y ano para asignar codigos de pedido sin consultar colisiones"""
+    __tablename__ = 'code_sequences'
+    
+    name = db.Column(db.String(32), primary_key=True)  # p. ej. MP-2025
+    value = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<CodeSequence {self.name}={self.value}>'
+
+
+class IdempotencyKey(db.Model):
+    """Respuesta guardada de un checkout para repetirla si el cliente reenvia la misma clave"""
+    __tablename__ = 'idempotency_keys'
+    
+    key = db.Column(db.String(48), primary_key=True)  # endpoint + hash de la clave del cliente
+    fingerprint = db.Column(db.String(16), nullable=False)  # hash del cuerpo de la peticion
+    response = db.Column(JSON, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    
+    def __repr__(self):
+        return f'<IdempotencyKey {self.key}>'
+
+
 class Client(db.Model):
     """Cliente para pedidos personalizados"""
     __tablename__ = 'clients'
@@ -357,13 +825,51 @@ class Client(db.Model):
     deleted_at = db.Column(db.DateTime)
     deleted_by = db.Column(db.String(64))
     measurements = db.Column(JSON, default=dict)  # Medidas por tipo de prenda
+    # Copias normalizadas para buscar con indice (las mantiene _sync_client_search)
+    name_search = db.Column(db.String(128), index=True)
+    phone_digits = db.Column(db.String(32), index=True)
+    id_number_search = db.Column(db.String(64), index=True)
     
     custom_orders = db.relationship('CustomOrder', back_populates='client', cascade='all, delete-orphan')
+    measurement_revisions = db.relationship('ClientMeasurementRevision', backref='client',
+                                            cascade='all, delete-orphan', lazy='dynamic')
     
     def __repr__(self):
         return f'<Client {self.name}>'
 
 
+class ClientSearchTrigram(db.Model):
+    """Trigramas de nombre, telefono y carnet de cada cliente para busquedas por subcadena"""
+    __tablename__ = 'client_search_trigrams'
+
+    trigram = db.Column(db.String(3), primary_key=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), primary_key=True, index=True)
+
+
+class ClientMeasurementRevision(db.Model):
+    """Cambio de medidas de un cliente para un tipo de prenda (solo los campos que cambiaron)"""
+    __tablename__ = 'client_measurement_revisions'
+
+    id = db.Column(db.Integer, primary_key=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=False)
+    garment_type = db.Column(db.String(40), nullable=False)
+    changes = db.Column(JSON, nullable=False)  # {campo: [antes, despues]}
+    actor = db.Column(db.String(128))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        db.Index('ix_client_measurement_revisions_client', 'client_id', 'garment_type', 'id'),
+    )
+
+    @property
+    def fecha(self):
+        """Fecha en hora local de Bolivia (GMT-4) para mostrar."""
+        return (self.created_at - timedelta(hours=4)).strftime('%Y-%m-%d %H:%M:%S (GMT-4)')
+
+    def __repr__(self):
+        return f'<ClientMeasurementRevision {self.client_id} {self.garment_type}>'
+
+
 class CustomOrder(db.Model):
     """Pedido personalizado (sastreria)"""
     __tablename__ = 'custom_orders'
@@ -377,15 +883,22 @@ class CustomOrder(db.Model):
     total = db.Column(db.Float, nullable=False, default=0)
     observations = db.Column(db.Text)
     is_urgent = db.Column(db.Boolean, default=False)
-    status = db.Column(db.String(30), default='pendiente')
+    status = db.column_property(db.Column(db.String(30), default='pendiente'), active_history=True)
     measurements = db.Column(JSON, default=dict)
     assigned_to = db.Column(db.Integer, db.ForeignKey('users.id'))
     assigned_at = db.Column(db.DateTime)
     shop_due_date = db.Column(db.Date)
     delivered_at = db.Column(db.DateTime)
+    # Progreso de prendas, mantenido al asignar/cambiar/agregar/borrar prendas (ver ITEM_PROGRESS_COLUMNS)
+    items_total = db.Column(db.Integer, nullable=False, default=0)
+    items_en_taller = db.Column(db.Integer, nullable=False, default=0)
+    items_asignadas = db.Column(db.Integer, nullable=False, default=0)
+    items_recibidas = db.Column(db.Integer, nullable=False, default=0)
+    items_listas = db.Column(db.Integer, nullable=False, default=0)
+    items_entregadas = db.Column(db.Integer, nullable=False, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    is_deleted = db.Column(db.Boolean, default=False, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    is_deleted = db.column_property(db.Column(db.Boolean, default=False, index=True), active_history=True)
     deleted_at = db.Column(db.DateTime)
     deleted_by = db.Column(db.String(64))
     
@@ -393,11 +906,38 @@ class CustomOrder(db.Model):
     assigned_user = db.relationship('User', foreign_keys=[assigned_to])
     images = db.relationship('CustomOrderImage', backref='order', cascade='all, delete-orphan', lazy='dynamic')
     items = db.relationship('CustomOrderItem', backref='order', cascade='all, delete-orphan', lazy='dynamic')
+    events = db.relationship('CustomOrderEvent', back_populates='order', cascade='all, delete-orphan', lazy='dynamic')
 
     def __repr__(self):
         return f'<CustomOrder {self.code}>'
 
 
+class CustomOrderEvent(db.Model):
+    """Historial de un pedido personalizado (solo se agregan filas)"""
+    __tablename__ = 'custom_order_events'
+
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('custom_orders.id'), nullable=False)
+    status = db.Column(db.String(30))
+    note = db.Column(db.Text)
+    actor = db.Column(db.String(128))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    order = db.relationship('CustomOrder', back_populates='events')
+
+    __table_args__ = (
+        db.Index('ix_custom_order_events_order_id', 'order_id', 'id'),
+    )
+
+    @property
+    def fecha(self):
+        """Fecha en hora local de Bolivia (GMT-4) para mostrar."""
+        return (self.created_at - timedelta(hours=4)).strftime('%Y-%m-%d %H:%M:%S (GMT-4)')
+
+    def __repr__(self):
+        return f'<CustomOrderEvent {self.order_id} {self.status}>'
+
+
 class CustomOrderImage(db.Model):
     """Imagenes asociadas a pedidos personalizados"""
     __tablename__ = 'custom_order_images'
@@ -525,6 +1065,53 @@ class SiteSettings(db.Model):
     maintenance_mode = db.Column(db.Boolean, default=False)
     exchange_rate = db.Column(db.Float, default=6.96)
     qr_image = db.Column(db.String(256))
+
+
+class CacheVersion(db.Model):
+    """Version compartida por nombre de cache (senal de invalidacion entre workers)."""
+    __tablename__ = 'cache_versions'
+
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<CacheVersion {self.name}={self.version}>'
+
+
+class Job(db.Model):
+    """Tarea en segundo plano (procesar imagenes, limpiar archivos, etc.)"""
+    __tablename__ = 'jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(64), nullable=False)
+    payload = db.Column(JSON)
+    status = db.Column(db.String(16), nullable=False, default='pending')  # pending, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_at = db.Column(db.DateTime)
+    locked_by = db.Column(db.String(64))
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.kind} {self.status}>'
+
+
+class DailyStat(db.Model):
+    """Resumen diario por metrica (pedidos, ingresos, visitas) que se mantiene en cada escritura"""
+    __tablename__ = 'daily_stats'
+
+    day = db.Column(db.Date, primary_key=True)  # Dia local (STATS_UTC_OFFSET_HOURS)
+    metric = db.Column(db.String(32), primary_key=True)  # orders, custom_orders, product_views
+    dimension = db.Column(db.String(32), primary_key=True, default='')  # metodo de pago, estado...
+    count = db.Column(db.Integer, nullable=False, default=0)
+    amount = db.Column(db.Float, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<DailyStat {self.day} {self.metric}:{self.dimension}={self.count}>'
 # -------------------------------------------------
 #                            FORMULARIOS
 # -------------------------------------------------
@@ -538,6 +1125,12 @@ ORDER_STATUSES = [
     'Entregado'
 ]
 
+PAYMENT_METHODS = ['whatsapp', 'paypal', 'qr']
+
+# Estados de pago PayPal previos a la confirmacion (fuera del flujo de ORDER_STATUSES)
+PAYMENT_PENDING_STATUS = 'Pago pendiente'
+PAYMENT_REJECTED_STATUS = 'Pago rechazado'
+
 CUSTOM_ORDER_TYPES = [
     'Blusa Cochala',
     'Blusa Sucrena',
@@ -623,6 +1216,8 @@ class ProductForm(FlaskForm):
     promo_text = StringField('Texto promocional', validators=[Optional(), Length(max=80)])
     category = SelectField('Categoria', coerce=int, validators=[DataRequired()])
     images = MultipleFileField('Imagenes', validators=[FileAllowed(ALLOWED_EXTENSIONS, 'Solo imagenes permitidas')])
+    track_stock = BooleanField('Controlar stock')
+    stock = IntegerField('Stock disponible', validators=[Optional(), NumberRange(min=0)])
     is_new = BooleanField('Novedad')
     is_trending = BooleanField('Tendencia')
     is_featured = BooleanField('Destacado')
@@ -689,7 +1284,7 @@ class SiteSettingsForm(FlaskForm):
     submit = SubmitField('Guardar Configuracion')
 
 class CustomOrderForm(FlaskForm):
-    client_id = SelectField('Cliente', coerce=int, validators=[InputRequired()])
+    client_id = IntegerField('Cliente', widget=HiddenInput(), default=0, validators=[Optional()])
     new_client_name = StringField('Nombre de cliente', validators=[Optional(), Length(max=128)])
     new_client_phone = StringField('Telefono', validators=[Optional(), Length(max=32)])
     new_client_id_number = StringField('Carnet/NIT', validators=[Optional(), Length(max=64)])
@@ -817,58 +1412,112 @@ def save_image(file, folder, prefix=''):
         return filename
     return None
 
+def generate_image_variants(filename):
+    """Genera derivados WebP y JPEG por ancho junto a la imagen original (ruta relativa a uploads).
+
+    No amplia: si la original es mas angosta se detiene en su ancho real.
+    Devuelve {} si Pillow no puede abrir el archivo.
+    """
+    src_path = os.path.join(UPLOAD_FOLDER, filename)
+    base = os.path.splitext(filename)[0]
+    variants = {}
+    try:
+        with Image.open(src_path) as original:
+            im = ImageOps.exif_transpose(original)
+            if im.mode not in ('RGB', 'RGBA'):
+                im = im.convert('RGBA' if im.mode in ('LA', 'P', 'PA') else 'RGB')
+            for name, width in sorted(IMAGE_VARIANT_WIDTHS.items(), key=lambda item: item[1]):
+                if variants and width > im.width:
+                    break
+                w = min(width, im.width)
+                h = max(1, round(im.height * w / im.width))
+                resized = im.resize((w, h), Image.LANCZOS) if w < im.width else im
+                webp_name = f'{base}_{name}.webp'
+                jpeg_name = f'{base}_{name}.jpg'
+                resized.save(os.path.join(UPLOAD_FOLDER, webp_name), 'WEBP',
+                             quality=app.config.get('IMAGE_WEBP_QUALITY', 80), method=4)
+                flat = resized
+                if resized.mode == 'RGBA':
+                    flat = Image.new('RGB', resized.size, (255, 255, 255))
+                    flat.paste(resized, mask=resized.getchannel('A'))
+                flat.save(os.path.join(UPLOAD_FOLDER, jpeg_name), 'JPEG',
+                          quality=app.config.get('IMAGE_JPEG_QUALITY', 82), optimize=True, progressive=True)
+                variants[name] = {'width': w, 'height': h, 'webp': webp_name, 'jpeg': jpeg_name}
+    except (OSError, ValueError, Image.DecompressionBombError) as exc:
+        app.logger.warning('No se pudieron generar derivados de %s: %s', filename, exc)
+        return {}
+    return variants
+
+def image_file_paths(img):
+    """Rutas en disco de la imagen original y sus derivados."""
+    paths = [img.filename]
+    for variant in (img.variants or {}).values():
+        paths.extend([variant.get('webp'), variant.get('jpeg')])
+    return [os.path.join(UPLOAD_FOLDER, rel) for rel in paths if rel]
+
+def remove_asset_paths(files=(), folders=()):
+    """Borra archivos y carpetas (con su contenido) ignorando los que ya no existen."""
+    for path in files:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    for folder in folders:
+        if not os.path.isdir(folder):
+            continue
+        for root, dirs, names in os.walk(folder, topdown=False):
+            for name in names:
+                try:
+                    os.remove(os.path.join(root, name))
+                except OSError:
+                    pass
+            for d in dirs:
+                try:
+                    os.rmdir(os.path.join(root, d))
+                except OSError:
+                    pass
+        try:
+            os.rmdir(folder)
+        except OSError:
+            pass
+
+def delete_image_files(img):
+    """Programa el borrado de la imagen original y sus derivados."""
+    enqueue_job('cleanup_assets', {'files': image_file_paths(img)})
+
+def pick_image_variant(variants, size):
+    """Derivado pedido o, si la original era pequena, el mas grande disponible."""
+    if not variants:
+        return None
+    if size in variants:
+        return variants[size]
+    return max(variants.values(), key=lambda v: v.get('width') or 0)
+
+def sync_product_main_image(product):
+    """Recalcula main_image_filename/main_image_variants tras crear, editar o borrar imagenes."""
+    db.session.flush()
+    img = product.main_image
+    product.main_image_filename = img.filename if img else None
+    product.main_image_variants = img.variants if img else None
+
 def create_notification(message, admin_name, type='info'):
+    """Agrega la notificacion a la transaccion del llamador (se guarda con su commit)."""
     notif = Notification(message=message, admin_name=admin_name, type=type)
     db.session.add(notif)
-    db.session.commit()
 
 def delete_product_assets(product):
+    """Programa el borrado de imagenes y carpeta del producto (se ejecuta tras el commit)."""
+    files = []
     for img in product.images.all():
-        img_path = os.path.join(UPLOAD_FOLDER, img.filename)
-        if os.path.exists(img_path):
-            os.remove(img_path)
+        files.extend(image_file_paths(img))
     folder_name = f"{slugify(product.name)}_{product.id}"
-    product_folder = os.path.join(UPLOAD_FOLDER, folder_name)
-    if os.path.isdir(product_folder):
-        try:
-            for root, dirs, files in os.walk(product_folder, topdown=False):
-                for f in files:
-                    try:
-                        os.remove(os.path.join(root, f))
-                    except OSError:
-                        pass
-                for d in dirs:
-                    try:
-                        os.rmdir(os.path.join(root, d))
-                    except OSError:
-                        pass
-            os.rmdir(product_folder)
-        except OSError:
-            pass
+    enqueue_job('cleanup_assets', {'files': files, 'folders': [os.path.join(UPLOAD_FOLDER, folder_name)]})
 
 def delete_custom_order_assets(order):
+    """Programa el borrado de imagenes y carpeta del pedido personalizado."""
     folder_name = f"custom_{order.code}_{order.id}"
-    order_folder = os.path.join(CUSTOM_ORDER_FOLDER, folder_name)
-    for img in order.images.all():
-        img_path = os.path.join(CUSTOM_ORDER_FOLDER, img.filename)
-        if os.path.exists(img_path):
-            os.remove(img_path)
-    if os.path.isdir(order_folder):
-        try:
-            for root, dirs, files in os.walk(order_folder, topdown=False):
-                for f in files:
-                    try:
-                        os.remove(os.path.join(root, f))
-                    except OSError:
-                        pass
-                for d in dirs:
-                    try:
-                        os.rmdir(os.path.join(root, d))
-                    except OSError:
-                        pass
-            os.rmdir(order_folder)
-        except OSError:
-            pass
+    files = [os.path.join(CUSTOM_ORDER_FOLDER, img.filename) for img in order.images.all()]
+    enqueue_job('cleanup_assets', {'files': files, 'folders': [os.path.join(CUSTOM_ORDER_FOLDER, folder_name)]})
 
 def save_custom_order_images(files, order):
     folder_name = f"custom_{order.code}_{order.id}"
@@ -904,36 +1553,27 @@ def extract_reference_from_form(form):
 
 
 def append_custom_order_history(order, new_status, note='', user=None):
-    """Agrega una entrada de historial dentro del JSON de medidas/meta."""
-    data = order.measurements or {}
-    history = data.get('_history', [])
-    # Hora local Bolivia (UTC-4)
-    now = datetime.utcnow() - timedelta(hours=4)
+    """Agrega una fila al historial del pedido (custom_order_events).
+
+    Tambien toca updated_at: los cambios de prendas solo escriben aqui y el sondeo ?since=
+    del taller los detecta por esa columna.
+    """
+    order.updated_at = datetime.utcnow()
     actor = user
     if not actor:
         if current_user and current_user.is_authenticated:
             actor = current_user.name or current_user.username
         else:
             actor = 'sistema'
-    history.append({
-        'fecha': now.strftime('%Y-%m-%d %H:%M:%S (GMT-4)'),
-        'fecha_iso': now.isoformat(),
-        'estado': new_status,
-        'nota': note or '',
-        'usuario': actor
-    })
-    data['_history'] = history
-    order.measurements = data
-    # Asegurar que SQLAlchemy marque el cambio en JSON
-    try:
-        flag_modified(order, 'measurements')
-    except Exception:
-        pass
+    event = CustomOrderEvent(status=new_status, note=note or '', actor=actor)
+    order.events.append(event)
+    return event
 
 
-def get_custom_order_history(order):
-    data = order.measurements or {}
-    return data.get('_history', [])
+def get_custom_order_history(order, page=1, per_page=None):
+    """Historial del pedido, del evento mas reciente al mas antiguo, paginado."""
+    query = order.events.order_by(CustomOrderEvent.id.desc())
+    return query.paginate(page=page, per_page=per_page or app.config.get('HISTORY_PER_PAGE', 20), error_out=False)
 
 
 def normalize_phone(phone):
@@ -980,56 +1620,47 @@ def build_workshop_whatsapp_link(item):
     return f"https://wa.me/{phone}?text={quote(message)}"
 
 
+def _counts_item_status(status, statuses):
+    if status is None:
+        return 0
+    return 1 if statuses is None or status in statuses else 0
+
+
+def track_item_status(order, old_status, new_status):
+    """Ajusta los contadores de prendas del pedido (None: la prenda no existia o se borro).
+
+    Se suma en SQL (columna = columna + delta), asi dos cambios simultaneos no se pisan. Varias
+    prendas del mismo pedido antes del flush acumulan sus deltas sobre la expresion pendiente.
+    """
+    state = inspect(order)
+    for column, statuses in ITEM_PROGRESS_COLUMNS:
+        delta = _counts_item_status(new_status, statuses) - _counts_item_status(old_status, statuses)
+        if delta:
+            pending = state.attrs[column].loaded_value
+            if not isinstance(pending, ColumnElement):
+                pending = func.coalesce(getattr(CustomOrder, column), 0)
+            setattr(order, column, pending + delta)
+
+
 def refresh_order_workshop_status(order):
-    """Ajusta estado global del pedido segun estados de prendas."""
+    """Ajusta estado global del pedido segun los contadores de prendas (sin cargar las prendas)."""
     if not order or order.is_deleted:
         return
-    try:
-        items = order.items.all()
-    except Exception:
-        items = list(order.items or [])
-    if not items:
+    db.session.flush()
+    total = order.items_total or 0
+    if not total:
         return
-    statuses = [i.workshop_status or 'pendiente' for i in items]
-    total = len(items)
-    en_taller_count = sum(1 for s in statuses if s == 'asignado')
-    assigned_any = sum(1 for s in statuses if s in ('asignado', 'recibido', 'listo', 'entregado'))
-    received_count = sum(1 for s in statuses if s in ('recibido', 'listo', 'entregado'))
-    ready_count = sum(1 for s in statuses if s in ('listo', 'entregado'))
-    delivered_count = sum(1 for s in statuses if s == 'entregado')
-    all_assigned = all((s in ('asignado', 'recibido', 'listo', 'entregado') and i.workshop_id) for s, i in zip(statuses, items))
-    all_received = all(s in ('recibido', 'listo', 'entregado') for s in statuses)
-    all_ready = all(s in ('listo', 'entregado') for s in statuses)
-    all_delivered = all(s == 'entregado' for s in statuses)
-
     new_status = None
-    if all_delivered:
+    if (order.items_entregadas or 0) >= total:
         new_status = 'entregado'
-    elif all_ready:
+    elif (order.items_recibidas or 0) >= total:
         new_status = 'listo'
-    elif all_received:
-        new_status = 'listo'
-    elif all_assigned:
+    elif (order.items_asignadas or 0) >= total:
         new_status = 'en_confeccion'
 
     if new_status and order.status != new_status:
         append_custom_order_history(order, new_status, f'Estado auto: prendas -> {new_status}', user='sistema')
         order.status = new_status
-    # Guardar resumen de progreso en measurements para uso en templates
-    data = order.measurements or {}
-    data['_progress'] = {
-        'total': total,
-        'en_taller': en_taller_count,
-        'asignadas': assigned_any,
-        'recibidas': received_count,
-        'listas': ready_count,
-        'entregadas': delivered_count
-    }
-    order.measurements = data
-    try:
-        flag_modified(order, 'measurements')
-    except Exception:
-        pass
 
 
 def serialize_workshop_item(item):
@@ -1065,44 +1696,167 @@ def format_measure_diff(old, new):
 
 
 def append_client_measurement_history(cliente, garment_type, before, after, user):
-    """Registra historial de cambios de medidas a nivel cliente."""
-    data = dict(cliente.measurements or {})
-    history = data.get('_history', [])
-    now = datetime.utcnow() - timedelta(hours=4)
+    """Registra el cambio de medidas del cliente como revision (solo diferencias).
+
+    Conserva las ultimas CLIENT_MEASUREMENT_REVISIONS_KEEP revisiones por cliente y prenda;
+    la purga por antiguedad queda para `flask compact-measurement-revisions`.
+    """
+    changes = measurement_delta(before, after)
+    if not changes:
+        return None
     actor = user
     if not actor:
         if current_user and current_user.is_authenticated:
             actor = current_user.name or current_user.username
         else:
             actor = 'sistema'
-    history.append({
-        'fecha': now.strftime('%Y-%m-%d %H:%M:%S (GMT-4)'),
-        'garment_type': garment_type,
-        'changed_by': actor,
-        'antes': before or {},
-        'despues': after or {}
-    })
-    data['_history'] = history
-    cliente.measurements = data
+    if cliente.id is not None:
+        keep = max(app.config.get('CLIENT_MEASUREMENT_REVISIONS_KEEP', 20), 1)
+        same_garment = (
+            ClientMeasurementRevision.client_id == cliente.id,
+            ClientMeasurementRevision.garment_type == garment_type
+        )
+        # Id de la revision mas nueva que ya no cabe junto con la que se agrega ahora
+        oldest_kept = (
+            select(ClientMeasurementRevision.id)
+            .where(*same_garment)
+            .order_by(ClientMeasurementRevision.id.desc())
+            .offset(keep - 1)
+            .limit(1)
+            .scalar_subquery()
+        )
+        ClientMeasurementRevision.query.filter(
+            *same_garment, ClientMeasurementRevision.id <= oldest_kept
+        ).delete(synchronize_session=False)
+    revision = ClientMeasurementRevision(garment_type=garment_type, changes=changes, actor=actor)
+    cliente.measurement_revisions.append(revision)
+    return revision
+
+
+def propagate_client_measurements(cliente, garment_type, medidas, note='', user=None, dry_run=False):
+    """Copia las medidas del cliente a sus prendas de ese tipo en pedidos en curso.
+
+    Cantidad fija de consultas sin importar cuantos pedidos tenga el cliente: un SELECT de
+    las prendas afectadas, un UPDATE de prendas, un UPDATE de pedidos y un INSERT de eventos.
+    Con dry_run solo cuenta. Devuelve (prendas, pedidos).
+    """
+    rows = db.session.query(
+        CustomOrderItem.id, CustomOrderItem.order_id, CustomOrderItem.measurements, CustomOrder.status
+    ).join(CustomOrder, CustomOrderItem.order_id == CustomOrder.id).filter(
+        CustomOrder.client_id == cliente.id,
+        CustomOrder.is_deleted == False,
+        CustomOrder.status != 'entregado',
+        CustomOrderItem.garment_type == garment_type
+    ).all()
+    changed = [row for row in rows if (row.measurements or {}) != medidas]
+    item_ids = [row.id for row in changed]
+    order_status = {row.order_id: row.status for row in changed}
+    if dry_run or not item_ids:
+        return len(item_ids), len(order_status)
+    if not user:
+        user = (current_user.name or current_user.username) if current_user and current_user.is_authenticated else 'sistema'
+    now = datetime.utcnow()
+    db.session.execute(
+        update(CustomOrderItem).where(CustomOrderItem.id.in_(item_ids)).values(measurements=medidas),
+        execution_options={'synchronize_session': False}
+    )
+    db.session.execute(
+        update(CustomOrder).where(CustomOrder.id.in_(list(order_status))).values(updated_at=now),
+        execution_options={'synchronize_session': False}
+    )
+    db.session.execute(insert(CustomOrderEvent), [
+        {'order_id': order_id, 'status': status, 'note': note or '', 'actor': user, 'created_at': now}
+        for order_id, status in order_status.items()
+    ])
+    return len(item_ids), len(order_status)
+
+
+def compact_client_measurement_revisions(days=None):
+    """Borra revisiones de medidas mas antiguas que CLIENT_MEASUREMENT_REVISIONS_DAYS."""
+    days = app.config.get('CLIENT_MEASUREMENT_REVISIONS_DAYS', 730) if days is None else days
+    if not days or days <= 0:
+        return 0
+    limit = datetime.utcnow() - timedelta(days=days)
+    return ClientMeasurementRevision.query.filter(
+        ClientMeasurementRevision.created_at < limit
+    ).delete(synchronize_session=False)
+
+CODE_SLOTS = 1000000  # NNNNNN: un millon de codigos por prefijo y ano
+
+def next_sequence_value(name):
+    """Incrementa el contador dentro de la transaccion del llamador.
+
+    El UPDATE bloquea la fila (o la base en SQLite) hasta el commit, asi dos workers
+    nunca obtienen el mismo valor; si la transaccion se revierte, el valor tambien.
+    """
+    params = {'name': name}
+    if db.engine.dialect.update_returning:
+        value = db.session.execute(
+            text('UPDATE code_sequences SET value = value + 1 WHERE name = :name RETURNING value'), params
+        ).scalar()
+    else:
+        updated = db.session.execute(text('UPDATE code_sequences SET value = value + 1 WHERE name = :name'), params)
+        value = db.session.execute(
+            text('SELECT value FROM code_sequences WHERE name = :name'), params
+        ).scalar() if updated.rowcount else None
+    if value is not None:
+        return value
+    # Primer codigo del ano: crear la fila (si otro worker se adelanta, volver a incrementar)
     try:
-        flag_modified(cliente, 'measurements')
-    except Exception:
-        pass
+        with db.session.begin_nested():
+            db.session.execute(text('INSERT INTO code_sequences (name, value) VALUES (:name, 1)'), params)
+        return 1
+    except IntegrityError:
+        return next_sequence_value(name)
+
+def _mix_code_number(number, name):
+    """Permutacion con clave de 0..999999 (Feistel en base 1000) para que los codigos no sean correlativos."""
+    secret = (app.config.get('SECRET_KEY') or '').encode('utf-8')
+    left, right = divmod(number, 1000)
+    for round_no in range(4):
+        digest = hmac.new(secret, f'{name}:{round_no}:{right}'.encode('utf-8'), hashlib.sha256).digest()
+        left, right = right, (left + int.from_bytes(digest[:4], 'big')) % 1000
+    return left * 1000 + right
+
+def allocate_code(prefix):
+    """Codigo PREFIJO-AAAA-NNNNNN unico por construccion: contador del ano mezclado."""
+    year = datetime.utcnow().year
+    name = f'{prefix}-{year}'
+    value = next_sequence_value(name)
+    if value > CODE_SLOTS:
+        raise RuntimeError(f'Se agotaron los codigos {name}')
+    return f'{name}-{_mix_code_number(value - 1, name):06d}'
 
 def generate_order_code():
-    year = datetime.utcnow().year
-    rand = random.randint(0, 999999)
-    return f"MP-{year}-{rand:06d}"
+    return allocate_code('MP')
 
 def generate_custom_order_code():
-    year = datetime.utcnow().year
-    rand = random.randint(0, 999999)
-    return f"PC-{year}-{rand:06d}"
+    return allocate_code('PC')
+
+def add_with_unique_code(obj, attr, generator, attempts=5):
+    """Agrega obj con un codigo del contador.
+
+    Los codigos nuevos no chocan entre si; solo pueden coincidir con codigos aleatorios
+    antiguos del mismo ano, en cuyo caso se toma el siguiente valor del contador.
+    """
+    model = type(obj)
+    for _ in range(attempts):
+        code = generator()
+        setattr(obj, attr, code)
+        try:
+            with db.session.begin_nested():
+                db.session.add(obj)
+            return obj
+        except IntegrityError:
+            if not db.session.query(model.query.filter(getattr(model, attr) == code).exists()).scalar():
+                raise
+    raise RuntimeError('No se pudo asignar un codigo libre')
 
 def append_history(order, status, note=None):
     history = order.history or []
     history.append({'status': status, 'note': note, 'timestamp': datetime.utcnow().isoformat()})
     order.history = history
+    flag_modified(order, 'history')
 
 
 def superadmin_required(f):
@@ -1166,58 +1920,1294 @@ def permission_labels(perms):
         return [labels.get(p, p) for p in perms]
     except TypeError:
         return []
-# ═══════════════════════════════════════════════════════════════════════════
 
-@login_manager.user_loader
-def load_user(user_id):
-    return db.session.get(User, int(user_id))
 
+@app.template_filter('upload_url')
+def upload_url(filename, variants=None, size='card', fmt='jpeg'):
+    """URL de un derivado de imagen subida; la original si aun no tiene derivados."""
+    variant = pick_image_variant(variants, size)
+    return url_for('static', filename='uploads/' + (variant[fmt] if variant else filename))
 
-@app.context_processor
-def inject_globals():
-    """Inyecta variables globales en todos los templates"""
-    settings = SiteSettings.query.first()
-    exchange_rate = settings.exchange_rate if settings and settings.exchange_rate else app.config.get('PAYPAL_RATE', 6.96)
 
-    # Tema activo
+@app.template_filter('srcset')
+def image_srcset(variants, fmt='webp'):
+    """Lista srcset con los anchos reales de cada derivado."""
+    if not variants:
+        return ''
+    ordered = sorted(variants.values(), key=lambda v: v.get('width') or 0)
+    return ', '.join(f"{url_for('static', filename='uploads/' + v[fmt])} {v['width']}w" for v in ordered)
+
+
+# -------------------------------------------------
+#                 CACHE DE CONTEXTO
+# -------------------------------------------------
+
+# Versiones compartidas leidas de la BD (como maximo una vez por intervalo)
+_cache_versions_state = {'checked_at': 0.0, 'versions': {}, 'updated': {}}
+_site_context_cache = {'version': None, 'data': None}
+_site_context_lock = threading.Lock()
+
+
+def get_cache_versions():
+    """Devuelve las versiones de cache, releyendo la BD solo cada CACHE_VERSION_CHECK_SECONDS."""
+    state = _cache_versions_state
+    now = time.monotonic()
+    interval = app.config.get('CACHE_VERSION_CHECK_SECONDS', 5)
+    if now - state['checked_at'] < interval:
+        return state['versions']
+    try:
+        rows = db.session.query(CacheVersion.name, CacheVersion.version, CacheVersion.updated_at).all()
+        state['versions'] = {name: version for name, version, _ in rows}
+        state['updated'] = {name: updated_at for name, _, updated_at in rows if updated_at}
+    except Exception as exc:
+        app.logger.warning('No se pudo leer versiones de cache: %s', exc)
+        db.session.rollback()
+    state['checked_at'] = now
+    return state['versions']
+
+
+def cache_versions_updated_at(*names):
+    """Fecha (UTC) del ultimo cambio entre las caches indicadas, segun la ultima lectura."""
+    get_cache_versions()
+    dates = [_cache_versions_state['updated'].get(name) for name in names]
+    dates = [d for d in dates if isinstance(d, datetime)]
+    return max(dates) if dates else None
+
+
+def bump_cache_version(name):
+    """Incrementa la version compartida de una cache (se confirma con el commit del llamador)."""
+    updated = CacheVersion.query.filter_by(name=name).update(
+        {CacheVersion.version: CacheVersion.version + 1, CacheVersion.updated_at: datetime.utcnow()},
+        synchronize_session=False
+    )
+    if not updated:
+        db.session.add(CacheVersion(name=name, version=1))
+    # Forzar relectura en este proceso en la siguiente peticion
+    _cache_versions_state['checked_at'] = 0.0
+
+
+def snapshot_row(obj):
+    """Copia las columnas de un modelo a un objeto simple, seguro fuera de la sesion."""
+    if obj is None:
+        return None
+    return SimpleNamespace(**{col.key: getattr(obj, col.key) for col in obj.__table__.columns})
+
+
+def _load_site_context():
+    settings = SiteSettings.query.first()
     active_theme = Theme.query.filter_by(is_default=True).first()
     if not active_theme:
         active_theme = Theme.query.first()
-    
-    # Categorías públicas
     categories = Category.query.filter_by(is_active=True).order_by(Category.order, Category.name).all()
-    
-    # Información de contacto
     contact = ContactInfo.query.first()
-    
-    # Notificaciones (solo para admin)
-    notifications = []
-    if current_user.is_authenticated:
-        notifications = Notification.query.order_by(
-            Notification.timestamp.desc()
-        ).limit(10).all()
-    
     return {
-        'active_theme': active_theme,
-        'site_settings': settings,
-        'public_categories': categories,
-        'contact_info': contact,
-        'notifications': notifications,
-        'current_year': datetime.utcnow().year,
-        'slugify': slugify,
-        'paypal_client_id': app.config.get('PAYPAL_CLIENT_ID'),
-        'paypal_rate': exchange_rate,
-        'paypal_percent_fee': app.config.get('PAYPAL_PERCENT_FEE', 0),
-        'paypal_fixed_fee': app.config.get('PAYPAL_FIXED_FEE', 0),
-        'GARMENT_FIELDS': GARMENT_FIELDS,
-        'MEASUREMENT_FIELDS': MEASUREMENT_FIELDS,
-        'CUSTOM_ORDER_TYPES': CUSTOM_ORDER_TYPES,
-        'CUSTOM_ORDER_STATUS_LABELS': CUSTOM_ORDER_STATUS_LABELS,
-        'getattr': getattr,
-        'PERMISSION_CHOICES': PERMISSION_CHOICES,
-        'PERMISSION_LABELS': dict(PERMISSION_CHOICES),
-        'has_permission': has_permission,
-        'is_tailor_only': is_tailor_only,
+        'site_settings': snapshot_row(settings),
+        'active_theme': snapshot_row(active_theme),
+        'public_categories': [snapshot_row(c) for c in categories],
+        'contact_info': snapshot_row(contact),
+    }
+
+
+def get_site_context():
+    """Configuracion, tema, categorias y contacto cacheados por proceso y versionados."""
+    version = get_cache_versions().get('site_context', 0)
+    cached = _site_context_cache
+    if cached['data'] is not None and cached['version'] == version:
+        return cached['data']
+    with _site_context_lock:
+        if cached['data'] is None or cached['version'] != version:
+            cached['data'] = _load_site_context()
+            cached['version'] = version
+        return cached['data']
+
+
+def invalidate_site_context():
+    """Invalida el contexto del sitio en este proceso y en los demas workers."""
+    bump_cache_version('site_context')
+    _site_context_cache['data'] = None
+
+
+_home_sections_cache = {'version': None, 'loaded_at': 0.0, 'data': None}
+_home_sections_lock = threading.Lock()
+
+
+def product_card(product):
+    """Datos de tarjeta de producto que se pueden cachear fuera de la sesion."""
+    card = snapshot_row(product)
+    card.has_discount = product.has_discount
+    card.discount_percent = product.discount_percent
+    card.promo_label = product.promo_label
+    return card
+
+
+def _load_home_sections():
+    sections = {
+        'novedades': Product.query.filter_by(is_new=True, is_active=True).limit(8).all(),
+        'tendencias': Product.query.filter_by(is_trending=True, is_active=True).limit(8).all(),
+        'destacados': Product.query.filter_by(is_featured=True, is_active=True).limit(8).all(),
+        'productos': Product.query.filter_by(is_active=True).order_by(Product.created_at.desc()).limit(12).all(),
+    }
+    return {name: [product_card(p) for p in products] for name, products in sections.items()}
+
+
+def get_home_sections():
+    """Secciones de la portada precalculadas; se recalculan al cambiar productos o cada HOME_SECTIONS_TTL."""
+    version = get_cache_versions().get('products', 0)
+    ttl = app.config.get('HOME_SECTIONS_TTL', 300)
+    cached = _home_sections_cache
+
+    def stale():
+        return (
+            cached['data'] is None
+            or cached['version'] != version
+            or time.monotonic() - cached['loaded_at'] >= ttl
+        )
+
+    if stale():
+        with _home_sections_lock:
+            if stale():
+                cached['data'] = _load_home_sections()
+                cached['version'] = version
+                cached['loaded_at'] = time.monotonic()
+    return cached['data']
+
+
+def invalidate_product_caches():
+    """Invalida las caches derivadas de productos en este proceso y en los demas workers."""
+    bump_cache_version('products')
+    _home_sections_cache['data'] = None
+
+
+# -------------------------------------------------
+#               BUSQUEDA DE PRODUCTOS
+# -------------------------------------------------
+
+# Pesos bm25 por columna: name, description, category, promo
+SEARCH_WEIGHTS = (10.0, 1.0, 4.0, 2.0)
+
+
+def normalize_search_text(value):
+    """Minusculas y sin tildes ("Sucreña" -> "sucrena") para indexar y buscar."""
+    value = unicodedata.normalize('NFKD', value or '')
+    return ''.join(ch for ch in value if not unicodedata.combining(ch)).casefold()
+
+
+def build_search_match(q):
+    """Convierte el texto del usuario en una consulta FTS5 de prefijos (todas las palabras)."""
+    tokens = re.findall(r'\w+', normalize_search_text(q))
+    return ' '.join(f'"{tok}"*' for tok in tokens)
+
+
+def _search_row(product_id, name, description, category_name, promo_text):
+    return {
+        'id': product_id,
+        'name': normalize_search_text(name),
+        'description': normalize_search_text(description),
+        'category': normalize_search_text(category_name),
+        'promo': normalize_search_text(promo_text),
+    }
+
+
+def _write_search_rows(rows):
+    if not rows:
+        return
+    db.session.execute(
+        text('DELETE FROM product_search WHERE rowid = :id'),
+        [{'id': r['id']} for r in rows]
+    )
+    db.session.execute(text("""
+        INSERT INTO product_search (rowid, name, description, category, promo)
+        VALUES (:id, :name, :description, :category, :promo)
+    """), rows)
+
+
+def _product_search_rows(condition=None):
+    query = db.session.query(
+        Product.id, Product.name, Product.description, Category.name, Product.promo_text
+    ).outerjoin(Category, Category.id == Product.category_id)
+    if condition is not None:
+        query = query.filter(condition)
+    return [_search_row(*values) for values in query.all()]
+
+
+def product_search_enabled():
+    """Si existe el indice FTS5 (se consulta una vez por proceso, en el primer uso)."""
+    if _search_state['enabled'] is None:
+        found = False
+        if db.engine.dialect.name == 'sqlite':
+            found = db.session.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'product_search'"
+            )).first() is not None
+        _search_state['enabled'] = found
+    return _search_state['enabled']
+
+
+def index_product_search(product):
+    """Actualiza la entrada del producto en el indice (dentro de la transaccion actual)."""
+    if not product_search_enabled():
+        return
+    db.session.flush()
+    _write_search_rows(_product_search_rows(Product.id == product.id))
+
+
+def remove_product_search(product_id):
+    if not product_search_enabled():
+        return
+    db.session.execute(text('DELETE FROM product_search WHERE rowid = :id'), {'id': product_id})
+
+
+def reindex_category_search(category_id):
+    """Reindexa los productos de una categoria (p. ej. al renombrarla)."""
+    if not product_search_enabled():
+        return
+    db.session.flush()
+    _write_search_rows(_product_search_rows(Product.category_id == category_id))
+
+
+def rebuild_product_search():
+    """Reconstruye el indice completo de busqueda."""
+    if not product_search_enabled():
+        return 0
+    db.session.execute(text('DELETE FROM product_search'))
+    rows = _product_search_rows()
+    _write_search_rows(rows)
+    return len(rows)
+
+
+def apply_product_search(query, q):
+    """Filtra la consulta de productos por texto; devuelve (query, columna de relevancia o None)."""
+    if product_search_enabled():
+        match = build_search_match(q)
+        if not match:
+            return query, None
+        weights = ', '.join(str(w) for w in SEARCH_WEIGHTS)
+        matches = text(
+            f'SELECT rowid AS product_id, bm25(product_search, {weights}) AS rank '
+            'FROM product_search WHERE product_search MATCH :match'
+        ).bindparams(match=match).columns(product_id=db.Integer, rank=db.Float).subquery('search_matches')
+        query = query.join(matches, matches.c.product_id == Product.id)
+        return query, matches.c.rank.asc()
+    search = f"%{q}%"
+    query = query.filter(
+        or_(Product.name.ilike(search), Product.description.ilike(search))
+    )
+    return query, None
+
+
+# -------------------------------------------------
+#               BUSQUEDA DE CLIENTES
+# -------------------------------------------------
+
+CLIENT_SEARCH_FIELDS = ('name', 'phone', 'id_number')
+
+
+def normalize_client_name(value):
+    """Nombre sin tildes, en minusculas y con espacios simples ("  María  Lopez" -> "maria lopez")."""
+    return ' '.join(normalize_search_text(value).split())
+
+
+def normalize_id_number(value):
+    """Carnet/NIT solo con letras y numeros ("123-456 LP" -> "123456lp")."""
+    return re.sub(r'[\W_]', '', normalize_search_text(value))
+
+
+def client_trigrams(*values):
+    grams = set()
+    for value in values:
+        value = value or ''
+        grams.update(value[i:i + 3] for i in range(len(value) - 2))
+    return grams
+
+
+def fill_client_search(cliente):
+    cliente.name_search = normalize_client_name(cliente.name)[:128]
+    cliente.phone_digits = normalize_phone(cliente.phone)[:32] or None
+    cliente.id_number_search = normalize_id_number(cliente.id_number)[:64] or None
+
+
+def _client_trigram_rows(client_id, name_search, phone_digits, id_number_search):
+    return [
+        {'trigram': gram, 'client_id': client_id}
+        for gram in client_trigrams(name_search, phone_digits, id_number_search)
+    ]
+
+
+@event.listens_for(Session, 'before_flush')
+def _sync_client_search(session, flush_context, instances):
+    pending = session.info.setdefault('client_search', set())
+    for obj in session.new:
+        if isinstance(obj, Client):
+            fill_client_search(obj)
+            pending.add(obj)
+    for obj in session.dirty:
+        if isinstance(obj, Client):
+            state = inspect(obj)
+            if any(state.attrs[key].history.has_changes() for key in CLIENT_SEARCH_FIELDS):
+                fill_client_search(obj)
+                pending.add(obj)
+    deleted_ids = [obj.id for obj in session.deleted if isinstance(obj, Client) and obj.id]
+    if deleted_ids:
+        session.connection().execute(
+            delete(ClientSearchTrigram).where(ClientSearchTrigram.client_id.in_(deleted_ids))
+        )
+
+
+@event.listens_for(Session, 'after_flush')
+def _write_client_trigrams(session, flush_context):
+    # En after_flush session.deleted aun refleja lo que se borro en este flush
+    pending = [obj for obj in session.info.pop('client_search', ()) if obj.id is not None and obj not in session.deleted]
+    if not pending:
+        return
+    conn = session.connection()
+    conn.execute(delete(ClientSearchTrigram).where(ClientSearchTrigram.client_id.in_([obj.id for obj in pending])))
+    rows = [row for obj in pending for row in _client_trigram_rows(
+        obj.id, obj.name_search, obj.phone_digits, obj.id_number_search
+    )]
+    if rows:
+        conn.execute(insert(ClientSearchTrigram), rows)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_client_search(session):
+    session.info.pop('client_search', None)
+
+
+def rebuild_client_search():
+    """Recalcula las columnas normalizadas y los trigramas de todos los clientes."""
+    rows = db.session.query(Client.id, Client.name, Client.phone, Client.id_number).all()
+    values = []
+    grams = []
+    for client_id, name, phone, id_number in rows:
+        entry = {
+            'id': client_id,
+            'name_search': normalize_client_name(name)[:128],
+            'phone_digits': normalize_phone(phone)[:32] or None,
+            'id_number_search': normalize_id_number(id_number)[:64] or None
+        }
+        values.append(entry)
+        grams.extend(_client_trigram_rows(client_id, entry['name_search'], entry['phone_digits'], entry['id_number_search']))
+    db.session.execute(delete(ClientSearchTrigram))
+    if values:
+        db.session.execute(text("""
+            UPDATE clients SET name_search = :name_search, phone_digits = :phone_digits,
+                id_number_search = :id_number_search
+            WHERE id = :id
+        """), values)
+    if grams:
+        db.session.execute(insert(ClientSearchTrigram), grams)
+    return len(values)
+
+
+def _prefix_match(column, value):
+    # Rango sobre el indice en lugar de LIKE 'x%' (SQLite solo usa el indice con NOCASE)
+    return and_(column >= value, column < value + '\uffff')
+
+
+def client_search_filter(term):
+    """Condicion de busqueda de clientes y orden por relevancia; None si el termino esta vacio.
+
+    El nombre se compara con name_search, los digitos (si el termino parece telefono) con
+    phone_digits y el carnet (si tiene numeros) con id_number_search. Los candidatos salen
+    de los indices: prefijos por rango y, para subcadenas de 3+ caracteres, los clientes que
+    tienen todos los trigramas del termino; luego se verifica con LIKE solo sobre esos.
+    """
+    pairs = [(Client.name_search, normalize_client_name(term))]
+    if re.fullmatch(r'[\d\s+\-().]+', term):
+        pairs.append((Client.phone_digits, normalize_phone(term)))
+    if re.search(r'\d', term):
+        pairs.append((Client.id_number_search, normalize_id_number(term)))
+    pairs = [(column, value) for column, value in pairs if value]
+    if not pairs:
+        return None
+    prefixes = [_prefix_match(column, value) for column, value in pairs]
+    candidates = [select(Client.id).where(prefix) for prefix in prefixes]
+    matches = list(prefixes)
+    for column, value in pairs:
+        grams = client_trigrams(value)
+        if not grams:
+            continue
+        candidates.append(select(ClientSearchTrigram.client_id).where(
+            ClientSearchTrigram.trigram.in_(grams)
+        ).group_by(ClientSearchTrigram.client_id).having(
+            func.count(ClientSearchTrigram.trigram) == len(grams)
+        ))
+        matches.append(column.contains(value, autoescape=True))
+    condition = and_(Client.id.in_(union(*candidates)), or_(*matches))
+    return condition, case((or_(*prefixes), 0), else_=1)
+
+
+def search_clients(term, limit=8, offset=0):
+    """Clientes activos que coinciden con el termino (nombre, telefono o carnet)."""
+    found = client_search_filter(term)
+    if found is None:
+        return []
+    condition, relevance = found
+    return Client.query.filter(Client.is_deleted == False, condition).order_by(
+        relevance, Client.name_search, Client.id
+    ).offset(offset).limit(limit).all()
+
+
+def find_duplicate_client(name, phone=None, id_number=None):
+    """Cliente existente con el mismo telefono, carnet o nombre (en ese orden de prioridad)."""
+    checks = []
+    digits = normalize_phone(phone)
+    if digits:
+        checks.append(Client.phone_digits == digits)
+    id_value = normalize_id_number(id_number)
+    if id_value:
+        checks.append(Client.id_number_search == id_value)
+    name_value = normalize_client_name(name)
+    if name_value:
+        checks.append(Client.name_search == name_value)
+    if not checks:
+        return None
+    priority = case(*[(check, idx) for idx, check in enumerate(checks)], else_=len(checks))
+    return Client.query.filter(or_(*checks)).order_by(priority, Client.id).first()
+
+
+# -------------------------------------------------
+#               CONTADOR DE VISITAS
+# -------------------------------------------------
+
+# Visitas pendientes por producto en este proceso; se vuelcan con UPDATE views = views + n,
+# por lo que varios workers pueden escribir sin pisarse.
+_pending_views = {'counts': {}, 'total': 0, 'flushed_at': time.monotonic()}
+_pending_views_lock = threading.Lock()
+
+
+def _product_views_due():
+    # Llamar con _pending_views_lock tomado
+    return bool(_pending_views['total']) and (
+        _pending_views['total'] >= app.config.get('VIEW_FLUSH_THRESHOLD', 50)
+        or time.monotonic() - _pending_views['flushed_at'] >= app.config.get('VIEW_FLUSH_INTERVAL', 30)
+    )
+
+
+def record_product_view(product_id):
+    """Suma una visita en memoria y vuelca el lote si vencio el intervalo o el umbral."""
+    with _pending_views_lock:
+        counts = _pending_views['counts']
+        counts[product_id] = counts.get(product_id, 0) + 1
+        _pending_views['total'] += 1
+        due = _product_views_due()
+    if due:
+        flush_product_views()
+
+
+def flush_product_views_if_due():
+    """Vuelca el lote si vencio; lo llama el hilo de tareas para no esperar a la siguiente visita."""
+    with _pending_views_lock:
+        due = _product_views_due()
+    return flush_product_views() if due else 0
+
+
+def flush_product_views():
+    """Escribe las visitas acumuladas: un UPDATE por producto en una sola transaccion."""
+    with _pending_views_lock:
+        counts = _pending_views['counts']
+        _pending_views['counts'] = {}
+        _pending_views['total'] = 0
+        _pending_views['flushed_at'] = time.monotonic()
+    if not counts:
+        return 0
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(
+                text('UPDATE products SET views = COALESCE(views, 0) + :n WHERE id = :id'),
+                [{'id': pid, 'n': n} for pid, n in counts.items()]
+            )
+            apply_daily_stats(conn, {(stats_day(), 'product_views', ''): [sum(counts.values()), 0.0]})
+    except Exception as exc:
+        app.logger.warning('No se pudieron guardar %s visitas: %s', sum(counts.values()), exc)
+        # Reintentar en el siguiente volcado
+        with _pending_views_lock:
+            for pid, n in counts.items():
+                _pending_views['counts'][pid] = _pending_views['counts'].get(pid, 0) + n
+                _pending_views['total'] += n
+        return 0
+    return len(counts)
+
+
+@atexit.register
+def _flush_product_views_at_exit():
+    try:
+        with app.app_context():
+            flush_product_views()
+    except Exception:
+        pass
+
+
+# -------------------------------------------------
+#                  ESTADISTICAS
+# -------------------------------------------------
+
+# Resumenes en daily_stats, ajustados en el mismo flush que cambia los pedidos, asi el
+# panel lee unas pocas filas por dia en lugar de recorrer orders y custom_orders:
+#   orders         pedidos web por metodo de pago (count) e ingresos (amount)
+#   custom_orders  pedidos personalizados por estado actual, en el dia en que se crearon
+#   product_views  visitas de productos, sumadas al volcar el contador
+
+# Pedidos web que aun no (o nunca) cuentan como venta
+UNCOUNTED_ORDER_STATUSES = {PAYMENT_PENDING_STATUS, PAYMENT_REJECTED_STATUS}
+
+UPSERT_DAILY_STATS_SQL = """
+    INSERT INTO daily_stats (day, metric, dimension, count, amount)
+    VALUES (:day, :metric, :dimension, :count, :amount)
+    ON CONFLICT (day, metric, dimension) DO UPDATE SET
+        count = daily_stats.count + excluded.count,
+        amount = daily_stats.amount + excluded.amount
+"""
+
+
+def stats_day(moment=None):
+    """Dia local (segun STATS_UTC_OFFSET_HOURS) de una fecha UTC; por defecto, hoy."""
+    moment = moment or datetime.utcnow()
+    return (moment + timedelta(hours=app.config.get('STATS_UTC_OFFSET_HOURS', -4))).date()
+
+
+def utc_day_start(day):
+    """Inicio en UTC del dia local indicado (inverso de stats_day)."""
+    offset = timedelta(hours=app.config.get('STATS_UTC_OFFSET_HOURS', -4))
+    return datetime.combine(day, datetime.min.time()) - offset
+
+
+def _add_stat(deltas, day, metric, dimension, count, amount=0.0):
+    entry = deltas.setdefault((day, metric, dimension or ''), [0, 0.0])
+    entry[0] += count
+    entry[1] += amount or 0.0
+
+
+def _daily_stats_params(sql, deltas):
+    rows = [
+        {'day': day, 'metric': metric, 'dimension': dimension, 'count': count, 'amount': amount}
+        for (day, metric, dimension), (count, amount) in deltas.items() if count or amount
+    ]
+    return text(sql).bindparams(bindparam('day', type_=db.Date)), rows
+
+
+def apply_daily_stats(conn, deltas):
+    """Suma los deltas {(dia, metrica, dimension): [count, amount]} en la transaccion de conn."""
+    stmt, rows = _daily_stats_params(UPSERT_DAILY_STATS_SQL, deltas)
+    if not rows:
+        return
+    if conn.dialect.name in ('sqlite', 'postgresql'):
+        conn.execute(stmt, rows)
+        return
+    update, _ = _daily_stats_params("""
+        UPDATE daily_stats SET count = count + :count, amount = amount + :amount
+        WHERE day = :day AND metric = :metric AND dimension = :dimension
+    """, deltas)
+    insert, _ = _daily_stats_params("""
+        INSERT INTO daily_stats (day, metric, dimension, count, amount)
+        VALUES (:day, :metric, :dimension, :count, :amount)
+    """, deltas)
+    for row in rows:
+        if not conn.execute(update, row).rowcount:
+            conn.execute(insert, row)
+
+
+def _previous_value(obj, key):
+    """Valor de la columna antes de este flush (requiere active_history si se reemplazo)."""
+    history = inspect(obj).attrs[key].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(obj, key)
+
+
+def _order_stat(order, status):
+    if status in UNCOUNTED_ORDER_STATUSES:
+        return None
+    return order.payment_method
+
+
+def _custom_order_stat(order, status, is_deleted):
+    if is_deleted:
+        return None
+    return status or 'pendiente'
+
+
+@event.listens_for(Session, 'before_flush')
+def _update_daily_stats(session, flush_context, instances):
+    # Antes del flush las filas borradas aun existen; created_at vacio (pedido nuevo) cuenta como hoy
+    deltas = {}
+    for obj in session.new:
+        if isinstance(obj, Order):
+            method = _order_stat(obj, obj.status)
+            if method:
+                _add_stat(deltas, stats_day(obj.created_at), 'orders', method, 1, obj.total)
+        elif isinstance(obj, CustomOrder):
+            status = _custom_order_stat(obj, obj.status, obj.is_deleted)
+            if status:
+                _add_stat(deltas, stats_day(obj.created_at), 'custom_orders', status, 1)
+    for obj in session.dirty:
+        if isinstance(obj, Order):
+            before = _order_stat(obj, _previous_value(obj, 'status'))
+            after = _order_stat(obj, obj.status)
+            if before != after:
+                day = stats_day(obj.created_at)
+                if before:
+                    _add_stat(deltas, day, 'orders', before, -1, -(obj.total or 0))
+                if after:
+                    _add_stat(deltas, day, 'orders', after, 1, obj.total)
+        elif isinstance(obj, CustomOrder):
+            before = _custom_order_stat(obj, _previous_value(obj, 'status'), _previous_value(obj, 'is_deleted'))
+            after = _custom_order_stat(obj, obj.status, obj.is_deleted)
+            if before != after:
+                day = stats_day(obj.created_at)
+                if before:
+                    _add_stat(deltas, day, 'custom_orders', before, -1)
+                if after:
+                    _add_stat(deltas, day, 'custom_orders', after, 1)
+    for obj in session.deleted:
+        if isinstance(obj, Order):
+            method = _order_stat(obj, _previous_value(obj, 'status'))
+            if method:
+                _add_stat(deltas, stats_day(obj.created_at), 'orders', method, -1, -(obj.total or 0))
+        elif isinstance(obj, CustomOrder):
+            status = _custom_order_stat(obj, _previous_value(obj, 'status'), _previous_value(obj, 'is_deleted'))
+            if status:
+                _add_stat(deltas, stats_day(obj.created_at), 'custom_orders', status, -1)
+    if deltas:
+        apply_daily_stats(session.connection(), deltas)
+
+
+def rebuild_daily_stats():
+    """Recalcula los resumenes de pedidos desde las tablas (las visitas no se pueden reconstruir)."""
+    DailyStat.query.filter(DailyStat.metric.in_(('orders', 'custom_orders'))).delete(synchronize_session=False)
+    deltas = {}
+    orders = db.session.query(Order.created_at, Order.payment_method, Order.status, Order.total)
+    for created_at, method, status, total in orders.yield_per(1000):
+        if status not in UNCOUNTED_ORDER_STATUSES:
+            _add_stat(deltas, stats_day(created_at), 'orders', method, 1, total)
+    custom_orders = db.session.query(CustomOrder.created_at, CustomOrder.status).filter(CustomOrder.is_deleted == False)
+    for created_at, status in custom_orders.yield_per(1000):
+        _add_stat(deltas, stats_day(created_at), 'custom_orders', status or 'pendiente', 1)
+    apply_daily_stats(db.session.connection(), deltas)
+    return len(deltas)
+
+
+def get_live_counts():
+    """Conteos del catalogo y usuarios en una sola consulta (agregacion condicional)."""
+    def flagged(column):
+        return func.coalesce(func.sum(case((column == True, 1), else_=0)), 0)
+
+    row = db.session.query(
+        func.count(Product.id).label('productos'),
+        flagged(Product.is_active).label('productos_activos'),
+        flagged(Product.is_new).label('novedades'),
+        flagged(Product.is_trending).label('tendencias'),
+        flagged(Product.is_featured).label('destacados'),
+        select(func.count(Category.id)).scalar_subquery().label('categorias'),
+        select(func.count(User.id)).scalar_subquery().label('usuarios'),
+    ).one()
+    return dict(row._mapping)
+
+
+def get_dashboard_series(days):
+    """Series diarias de los ultimos dias y totales por metodo de pago y por estado."""
+    today = stats_day()
+    since = today - timedelta(days=days - 1)
+    series = OrderedDict(
+        (since + timedelta(days=n), {'pedidos': 0, 'ingresos': 0.0, 'visitas': 0}) for n in range(days)
+    )
+    by_method = {}
+    rows = db.session.query(
+        DailyStat.day, DailyStat.metric, DailyStat.dimension, DailyStat.count, DailyStat.amount
+    ).filter(DailyStat.day >= since, DailyStat.day <= today, DailyStat.metric.in_(('orders', 'product_views'))).all()
+    for day, metric, dimension, count, amount in rows:
+        point = series.get(day)
+        if point is None:
+            continue
+        if metric == 'orders':
+            point['pedidos'] += count
+            point['ingresos'] += amount
+            totals = by_method.setdefault(dimension, {'pedidos': 0, 'ingresos': 0.0})
+            totals['pedidos'] += count
+            totals['ingresos'] += amount
+        else:
+            point['visitas'] += count
+    custom_by_status = dict(db.session.query(DailyStat.dimension, func.sum(DailyStat.count)).filter(
+        DailyStat.metric == 'custom_orders'
+    ).group_by(DailyStat.dimension).all())
+    return {
+        'days': days,
+        'series': [dict(point, day=day) for day, point in series.items()],
+        'by_method': by_method,
+        'custom_by_status': {status: custom_by_status.get(status) or 0 for status in CUSTOM_ORDER_STATUSES},
+        'pedidos': sum(point['pedidos'] for point in series.values()),
+        'ingresos': sum(point['ingresos'] for point in series.values()),
+        'visitas': sum(point['visitas'] for point in series.values()),
+    }
+
+
+# -------------------------------------------------
+#               COLA DE TAREAS
+# -------------------------------------------------
+
+# Las tareas se guardan en la tabla jobs dentro de la transaccion del llamador, asi solo
+# existen si el cambio se confirma. Segun JOBS_MODE las ejecuta un hilo del proceso web
+# ('thread'), un proceso aparte con `flask jobs-worker` ('worker') o la misma peticion ('inline',
+# sin fila en jobs: se ejecutan al confirmar el commit del llamador y un fallo solo se registra).
+
+JOB_HANDLERS = {}
+JOB_GIVE_UP_HANDLERS = {}
+_job_thread_state = {'thread': None, 'pid': None, 'wake': threading.Event()}
+_job_thread_lock = threading.Lock()
+_requeue_state = {'checked_at': 0.0}
+
+
+def job_handler(kind, on_give_up=None):
+    """Registra la funcion que ejecuta un tipo de tarea (recibe el payload como kwargs).
+
+    on_give_up recibe el mismo payload cuando la tarea agota sus intentos, en la misma
+    transaccion que la marca fallida.
+    """
+    def decorator(f):
+        JOB_HANDLERS[kind] = f
+        if on_give_up is not None:
+            JOB_GIVE_UP_HANDLERS[kind] = on_give_up
+        return f
+    return decorator
+
+
+def enqueue_job(kind, payload=None, delay=0, max_attempts=None):
+    """Agrega una tarea a la sesion actual; se confirma con el commit del llamador."""
+    payload = payload or {}
+    if app.config.get('JOBS_MODE') == 'inline':
+        db.session.info.setdefault('inline_jobs', []).append((kind, payload))
+        return None
+    job = Job(
+        kind=kind,
+        payload=payload,
+        run_at=datetime.utcnow() + timedelta(seconds=delay),
+        max_attempts=max_attempts or app.config.get('JOBS_MAX_ATTEMPTS', 3)
+    )
+    db.session.add(job)
+    db.session.info['jobs_enqueued'] = True
+    return job
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_job_thread(session):
+    # Tambien se dispara al liberar un SAVEPOINT (begin_nested); solo cuenta el commit externo
+    if session.in_nested_transaction():
+        return
+    if session.info.pop('jobs_enqueued', False) and app.config.get('JOBS_MODE', 'thread') == 'thread':
+        start_job_thread()
+        _job_thread_state['wake'].set()
+    inline_jobs = session.info.pop('inline_jobs', None)
+    if inline_jobs:
+        run_inline_jobs(inline_jobs)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_enqueued_jobs(session):
+    if session.in_nested_transaction():
+        return
+    session.info.pop('jobs_enqueued', None)
+    session.info.pop('inline_jobs', None)
+
+
+def run_inline_jobs(jobs):
+    """Ejecuta tareas del modo 'inline' despues del commit que las encolo.
+
+    La sesion recien confirmada ya no admite SQL, asi que cada tarea corre en su propio
+    contexto de aplicacion (sesion nueva, que solo ve lo confirmado).
+    """
+    for kind, payload in jobs:
+        with app.app_context():
+            try:
+                JOB_HANDLERS[kind](**payload)
+            except Exception as exc:
+                db.session.rollback()
+                app.logger.warning('Tarea %s fallo en modo inline: %s', kind, exc)
+
+
+def requeue_stale_jobs(force=False):
+    """Devuelve a pendientes las tareas de workers que murieron a mitad de ejecucion.
+
+    Sin force se revisa como mucho una vez por JOBS_REQUEUE_INTERVAL, y solo se escribe si hay
+    tareas vencidas: con la cola ociosa el sondeo no toma el bloqueo de escritura de SQLite.
+    """
+    if not force and time.monotonic() - _requeue_state['checked_at'] < app.config.get('JOBS_REQUEUE_INTERVAL', 60):
+        return 0
+    _requeue_state['checked_at'] = time.monotonic()
+    limit = datetime.utcnow() - timedelta(seconds=app.config.get('JOBS_LOCK_TIMEOUT', 600))
+    stale = Job.query.filter(Job.status == 'running', Job.locked_at < limit)
+    if db.session.query(stale.exists()).scalar() is not True:
+        db.session.rollback()
+        return 0
+    count = stale.update(
+        {Job.status: 'pending', Job.locked_at: None, Job.locked_by: None},
+        synchronize_session=False
+    )
+    db.session.commit()
+    return count
+
+
+def claim_next_job(worker_id):
+    """Toma la siguiente tarea vencida; el UPDATE condicionado evita que dos workers tomen la misma."""
+    for _ in range(5):
+        now = datetime.utcnow()
+        job_id = db.session.query(Job.id).filter(
+            Job.status == 'pending', Job.run_at <= now
+        ).order_by(Job.run_at, Job.id).limit(1).scalar()
+        if job_id is None:
+            return None
+        claimed = Job.query.filter(Job.id == job_id, Job.status == 'pending').update(
+            {Job.status: 'running', Job.locked_at: now, Job.locked_by: worker_id, Job.attempts: Job.attempts + 1},
+            synchronize_session=False
+        )
+        db.session.commit()
+        if claimed:
+            return db.session.get(Job, job_id)
+    return None
+
+
+def run_job(job):
+    """Ejecuta una tarea tomada; si falla la reprograma con espera exponencial o la marca fallida."""
+    handler = JOB_HANDLERS.get(job.kind)
+    try:
+        if handler is None:
+            raise LookupError(f'Tipo de tarea desconocido: {job.kind}')
+        handler(**(job.payload or {}))
+        job.status = 'done'
+        job.last_error = None
+        job.locked_at = None
+        job.locked_by = None
+        db.session.commit()
+        return True
+    except Exception as exc:
+        db.session.rollback()
+        job = db.session.get(Job, job.id)
+        job.last_error = f'{type(exc).__name__}: {exc}'[:2000]
+        job.locked_at = None
+        job.locked_by = None
+        if job.attempts >= job.max_attempts:
+            job.status = 'failed'
+            give_up = JOB_GIVE_UP_HANDLERS.get(job.kind)
+            if give_up is not None:
+                try:
+                    give_up(**(job.payload or {}))
+                except Exception as give_up_exc:
+                    db.session.rollback()
+                    job = db.session.get(Job, job.id)
+                    job.status = 'failed'
+                    job.locked_at = None
+                    job.locked_by = None
+                    job.last_error = f'{type(exc).__name__}: {exc}'[:2000]
+                    app.logger.warning('Tarea %s (%s): no se pudo cerrar tras agotar intentos: %s',
+                                       job.id, job.kind, give_up_exc)
+        else:
+            job.status = 'pending'
+            delay = app.config.get('JOBS_RETRY_DELAY', 30) * 2 ** max(job.attempts - 1, 0)
+            job.run_at = datetime.utcnow() + timedelta(seconds=delay)
+        db.session.commit()
+        app.logger.warning('Tarea %s (%s) fallo en el intento %s: %s', job.id, job.kind, job.attempts, exc)
+        return False
+
+
+def run_pending_jobs(worker_id=None, limit=None):
+    """Procesa tareas vencidas hasta vaciar la cola (o llegar a limit). Devuelve cuantas ejecuto."""
+    worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+    requeue_stale_jobs()
+    done = 0
+    while limit is None or done < limit:
+        job = claim_next_job(worker_id)
+        if job is None:
+            break
+        run_job(job)
+        done += 1
+    return done
+
+
+def _job_thread_loop():
+    worker_id = f'{socket.gethostname()}:{os.getpid()}:hilo'
+    wake = _job_thread_state['wake']
+    while True:
+        try:
+            with app.app_context():
+                run_pending_jobs(worker_id)
+                # Un worker sin visitas nuevas tambien escribe las que tiene en memoria
+                flush_product_views_if_due()
+        except Exception as exc:
+            app.logger.warning('Error en el hilo de tareas: %s', exc)
+        wake.wait(app.config.get('JOBS_POLL_INTERVAL', 5))
+        wake.clear()
+
+
+def start_job_thread():
+    """Arranca (una vez por proceso) el hilo que ejecuta tareas en modo 'thread'."""
+    thread = _job_thread_state['thread']
+    if thread is not None and thread.is_alive() and _job_thread_state['pid'] == os.getpid():
+        return
+    with _job_thread_lock:
+        thread = _job_thread_state['thread']
+        if thread is not None and thread.is_alive() and _job_thread_state['pid'] == os.getpid():
+            return
+        thread = threading.Thread(target=_job_thread_loop, name='jobs-worker', daemon=True)
+        _job_thread_state['thread'] = thread
+        _job_thread_state['pid'] = os.getpid()
+        thread.start()
+
+
+@app.before_request
+def _ensure_job_thread():
+    # Retoma tareas pendientes de reinicios anteriores aunque no se encole nada nuevo
+    if app.config.get('JOBS_MODE', 'thread') == 'thread':
+        start_job_thread()
+
+
+@job_handler('product_image_variants')
+def process_product_image_variants(product_id):
+    """Genera los derivados de las imagenes nuevas de un producto."""
+    product = db.session.get(Product, product_id)
+    if product is None:
+        return
+    changed = False
+    for img in product.images.filter(ProductImage.variants.is_(None)).all():
+        variants = generate_image_variants(img.filename)
+        if variants:
+            img.variants = variants
+            changed = True
+    if changed:
+        sync_product_main_image(product)
+        invalidate_product_caches()
+
+
+@job_handler('cleanup_assets')
+def cleanup_assets(files=(), folders=()):
+    remove_asset_paths(files, folders)
+
+
+# -------------------------------------------------
+#            CACHE DE PAGINAS PUBLICAS
+# -------------------------------------------------
+
+# LRU en memoria por proceso; opcionalmente respaldada en disco (PAGE_CACHE_DIR).
+# La clave incluye la version de cada etiqueta, asi que al subir la version
+# (p. ej. 'products' o 'site_context') las entradas anteriores dejan de usarse.
+_page_cache = OrderedDict()
+_page_cache_lock = threading.Lock()
+_page_cache_state = {'disk_writes': 0}
+
+
+def _page_cache_key(tags):
+    versions = get_cache_versions()
+    args = urlencode(sorted(request.args.items(multi=True)))
+    tag_part = ','.join(f'{tag}:{versions.get(tag, 0)}' for tag in tags)
+    return f'{request.host_url}|{request.path}?{args}|{tag_part}'
+
+
+def _page_cache_bypass():
+    return (
+        not app.config.get('PAGE_CACHE_ENABLED', True)
+        or request.method != 'GET'
+        or current_user.is_authenticated
+        or '_flashes' in session
+    )
+
+
+def _page_cache_path(key):
+    return os.path.join(app.config['PAGE_CACHE_DIR'], hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+
+def _page_cache_disk_get(key, now, ttl):
+    path = _page_cache_path(key)
+    try:
+        with open(path, 'rb') as fh:
+            meta = json.loads(fh.readline())
+            body = fh.read()
+    except (OSError, ValueError):
+        return None
+    if meta.get('key') != key or now - meta.get('stored_at', 0) >= ttl:
+        return None
+    meta['body'] = body
+    return meta
+
+
+def _page_cache_disk_set(key, entry):
+    folder = app.config['PAGE_CACHE_DIR']
+    path = _page_cache_path(key)
+    meta = {k: v for k, v in entry.items() if k != 'body'}
+    meta['key'] = key
+    try:
+        os.makedirs(folder, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as fh:
+            fh.write(json.dumps(meta).encode('utf-8') + b'\n')
+            fh.write(entry['body'])
+        os.replace(tmp_path, path)
+    except OSError as exc:
+        app.logger.warning('No se pudo escribir cache de pagina en disco: %s', exc)
+        return
+    _page_cache_state['disk_writes'] += 1
+    if _page_cache_state['disk_writes'] % 200 == 0:
+        prune_page_cache_dir()
+
+
+def prune_page_cache_dir(max_age=None):
+    """Borra del disco las paginas vencidas (o todas con max_age=0)."""
+    folder = app.config.get('PAGE_CACHE_DIR')
+    if not folder or not os.path.isdir(folder):
+        return 0
+    max_age = app.config.get('PAGE_CACHE_TTL', 60) if max_age is None else max_age
+    now = time.time()
+    removed = 0
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            if now - os.path.getmtime(path) >= max_age:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def page_cache_get(key):
+    ttl = app.config.get('PAGE_CACHE_TTL', 60)
+    now = time.time()
+    with _page_cache_lock:
+        entry = _page_cache.get(key)
+        if entry is not None:
+            if now - entry['stored_at'] < ttl:
+                _page_cache.move_to_end(key)
+                return entry
+            del _page_cache[key]
+    if app.config.get('PAGE_CACHE_DIR'):
+        entry = _page_cache_disk_get(key, now, ttl)
+        if entry is not None:
+            _page_cache_memory_set(key, entry)
+        return entry
+    return None
+
+
+def _page_cache_memory_set(key, entry):
+    max_entries = app.config.get('PAGE_CACHE_MAX_ENTRIES', 256)
+    with _page_cache_lock:
+        _page_cache[key] = entry
+        _page_cache.move_to_end(key)
+        while len(_page_cache) > max_entries:
+            _page_cache.popitem(last=False)
+
+
+def page_cache_set(key, response):
+    entry = {
+        'body': response.get_data(),
+        'status': response.status_code,
+        'content_type': response.content_type,
+        'stored_at': time.time(),
+    }
+    _page_cache_memory_set(key, entry)
+    if app.config.get('PAGE_CACHE_DIR'):
+        _page_cache_disk_set(key, entry)
+
+
+def clear_page_cache():
+    with _page_cache_lock:
+        _page_cache.clear()
+    return prune_page_cache_dir(max_age=0)
+
+
+def make_etag(*parts):
+    return hashlib.sha1('|'.join(str(p) for p in parts).encode('utf-8')).hexdigest()[:20]
+
+
+def _is_not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if last_modified and request.if_modified_since:
+        return last_modified.replace(microsecond=0, tzinfo=timezone.utc) <= request.if_modified_since
+    return False
+
+
+def conditional_get(validators, on_not_modified=None):
+    """Responde 304 sin ejecutar la vista si el cliente tiene la version actual.
+
+    validators recibe los argumentos de la vista y devuelve (etag, last_modified)
+    o None para responder normalmente (p. ej. si el recurso no existe).
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            result = validators(*args, **kwargs) if request.method == 'GET' else None
+            if not result:
+                return f(*args, **kwargs)
+            etag, last_modified = result
+            etag = make_etag(etag, current_user.is_authenticated)
+            if _is_not_modified(etag, last_modified):
+                if on_not_modified:
+                    on_not_modified(*args, **kwargs)
+                resp = Response(status=304)
+            else:
+                resp = make_response(f(*args, **kwargs))
+                if resp.status_code != 200:
+                    return resp
+            resp.set_etag(etag, weak=True)
+            if last_modified:
+                resp.last_modified = last_modified.replace(tzinfo=timezone.utc)
+            resp.headers['Cache-Control'] = 'no-cache'
+            return resp
+        return wrapper
+    return decorator
+
+
+def cached_page(*tags, on_hit=None):
+    """Cachea la respuesta completa para visitantes anonimos.
+
+    tags son nombres de version de cache (ver bump_cache_version); on_hit se
+    ejecuta con los argumentos de la vista cuando se sirve desde cache.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if _page_cache_bypass():
+                return f(*args, **kwargs)
+            key = _page_cache_key(tags)
+            entry = page_cache_get(key)
+            if entry is not None:
+                if on_hit:
+                    on_hit(*args, **kwargs)
+                resp = Response(entry['body'], status=entry['status'], content_type=entry['content_type'])
+                resp.headers['X-Page-Cache'] = 'HIT'
+                return resp
+            resp = make_response(f(*args, **kwargs))
+            if resp.status_code == 200 and not resp.direct_passthrough and '_flashes' not in session:
+                page_cache_set(key, resp)
+            resp.headers['X-Page-Cache'] = 'MISS'
+            return resp
+        return wrapper
+    return decorator
+
+
+# -------------------------------------------------
+#              PAGINACION POR CURSOR
+# -------------------------------------------------
+
+_cursor_serializer = URLSafeSerializer(app.config['SECRET_KEY'], salt='keyset-cursor')
+
+
+class KeysetPagination:
+    """Pagina obtenida por cursor: sin COUNT(*) ni OFFSET, solo hacia adelante."""
+    is_keyset = True
+    has_prev = True
+
+    def __init__(self, items, per_page, next_cursor):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.has_next = next_cursor is not None
+
+
+def encode_cursor(sort_name, value, item_id):
+    """Token opaco con el valor de orden y el id del ultimo elemento mostrado."""
+    if isinstance(value, datetime):
+        value = {'dt': value.isoformat()}
+    return _cursor_serializer.dumps([sort_name, value, item_id])
+
+
+def decode_cursor(token, sort_name):
+    """Devuelve (valor, id) o None si el token es invalido o de otro orden."""
+    try:
+        name, value, item_id = _cursor_serializer.loads(token)
+    except (BadData, ValueError, TypeError):
+        return None
+    if name != sort_name:
+        return None
+    if isinstance(value, dict) and 'dt' in value:
+        value = datetime.fromisoformat(value['dt'])
+    return value, item_id
+
+
+def paginate_listing(query, sort_name, sort_spec, id_column, page, per_page, after=None):
+    """Pagina por numero las primeras KEYSET_PAGE_LIMIT paginas y despues por cursor (after=...).
+
+    sort_spec es (columna, descendente, getter del valor en el item); el id desempata
+    en la misma direccion para que el orden sea estable. Los NULL van al final en orden
+    descendente y al principio en ascendente (el orden natural de SQLite, asi sirve el indice).
+    """
+    column, descending, getter = sort_spec
+    limit = app.config.get('KEYSET_PAGE_LIMIT', 0)
+    if descending:
+        query = query.order_by(column.desc().nulls_last(), id_column.desc())
+    else:
+        query = query.order_by(column.asc().nulls_first(), id_column.asc())
+
+    cursor = decode_cursor(after, sort_name) if (after and limit) else None
+    if cursor is not None:
+        value, last_id = cursor
+        if descending:
+            if value is None:
+                query = query.filter(column.is_(None), id_column < last_id)
+            else:
+                query = query.filter(or_(
+                    column < value, and_(column == value, id_column < last_id), column.is_(None)
+                ))
+        else:
+            if value is None:
+                query = query.filter(or_(column.isnot(None), and_(column.is_(None), id_column > last_id)))
+            else:
+                query = query.filter(or_(column > value, and_(column == value, id_column > last_id)))
+        rows = query.limit(per_page + 1).all()
+        items = rows[:per_page]
+        next_cursor = None
+        if len(rows) > per_page:
+            next_cursor = encode_cursor(sort_name, getter(items[-1]), items[-1].id)
+        return KeysetPagination(items, per_page, next_cursor)
+
+    pagination = query.paginate(page=page, per_page=per_page, error_out=False)
+    pagination.is_keyset = False
+    pagination.max_page = min(pagination.pages, limit) if limit else pagination.pages
+    pagination.next_cursor = None
+    if limit and pagination.page >= limit and pagination.has_next and pagination.items:
+        last = pagination.items[-1]
+        pagination.next_cursor = encode_cursor(sort_name, getter(last), last.id)
+    return pagination
+
+# ═══════════════════════════════════════════════════════════════════════════
+
+@login_manager.user_loader
+def load_user(user_id):
+    return db.session.get(User, int(user_id))
+
+
+@app.context_processor
+def inject_globals():
+    """Inyecta variables globales en todos los templates"""
+    # Configuración, tema activo, categorías públicas y contacto (cacheados)
+    site_context = get_site_context()
+    settings = site_context['site_settings']
+    exchange_rate = settings.exchange_rate if settings and settings.exchange_rate else app.config.get('PAYPAL_RATE', 6.96)
+    
+    # Notificaciones (solo para admin)
+    notifications = []
+    if current_user.is_authenticated:
+        notifications = Notification.query.order_by(
+            Notification.timestamp.desc()
+        ).limit(10).all()
+    
+    return {
+        'active_theme': site_context['active_theme'],
+        'site_settings': settings,
+        'public_categories': site_context['public_categories'],
+        'contact_info': site_context['contact_info'],
+        'notifications': notifications,
+        'current_year': datetime.utcnow().year,
+        'slugify': slugify,
+        'paypal_client_id': app.config.get('PAYPAL_CLIENT_ID'),
+        'paypal_rate': exchange_rate,
+        'paypal_percent_fee': app.config.get('PAYPAL_PERCENT_FEE', 0),
+        'paypal_fixed_fee': app.config.get('PAYPAL_FIXED_FEE', 0),
+        'GARMENT_FIELDS': GARMENT_FIELDS,
+        'MEASUREMENT_FIELDS': MEASUREMENT_FIELDS,
+        'CUSTOM_ORDER_TYPES': CUSTOM_ORDER_TYPES,
+        'CUSTOM_ORDER_STATUS_LABELS': CUSTOM_ORDER_STATUS_LABELS,
+        'getattr': getattr,
+        'PERMISSION_CHOICES': PERMISSION_CHOICES,
+        'PERMISSION_LABELS': dict(PERMISSION_CHOICES),
+        'has_permission': has_permission,
+        'is_tailor_only': is_tailor_only,
         'WORKSHOP_ITEM_STATUS_LABELS': WORKSHOP_ITEM_STATUS_LABELS,
         'csrf_token': generate_csrf
     }
@@ -1229,12 +3219,8 @@ def inject_globals():
 
 def init_db():
     """Inicializa la base de datos con datos por defecto"""
-    db.create_all()
-    ensure_client_schema()
-    ensure_user_permissions_schema()
-    ensure_custom_order_schema()
-    ensure_workshop_schema()
-    
+    apply_migrations()
+
     # Crear tema por defecto si no existe
     if Theme.query.count() == 0:
         themes_data = [
@@ -1272,43 +3258,249 @@ def init_db():
         admin.set_password('admin123')
         db.session.add(admin)
         print('✓ Usuario admin creado (usuario: admin, contraseña: admin123)')
-    
+
+    db.session.commit()
+
+
+@app.cli.command('db-upgrade')
+@click.option('--to', 'target', default=None, type=int, help='Aplicar solo hasta esta version.')
+def db_upgrade_command(target):
+    """Aplica las migraciones de esquema pendientes."""
+    applied = apply_migrations(target)
+    for version, description in applied:
+        print(f'  {version:>3}  {description}')
+    print(f'✓ Esquema en version {get_schema_version()} ({len(applied)} migraciones aplicadas)')
+
+
+@app.cli.command('db-version')
+def db_version_command():
+    """Muestra la version del esquema y las migraciones pendientes."""
+    current = get_schema_version()
+    print(f'Version actual: {current} (ultima: {SCHEMA_VERSION})')
+    for version, description, _ in MIGRATIONS:
+        if version > current:
+            print(f'  pendiente {version:>3}  {description}')
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Reconstruye el indice de busqueda de productos."""
+    total = rebuild_product_search()
+    db.session.commit()
+    print(f'✓ Indice de busqueda reconstruido ({total} productos)')
+
+
+@app.cli.command('rebuild-client-search')
+def rebuild_client_search_command():
+    """Recalcula las columnas normalizadas y trigramas de busqueda de clientes."""
+    total = rebuild_client_search()
+    db.session.commit()
+    print(f'✓ Busqueda de clientes reconstruida ({total} clientes)')
+
+
+@app.cli.command('clear-page-cache')
+def clear_page_cache_command():
+    """Vacia la cache de paginas publicas (memoria de este proceso y disco)."""
+    removed = clear_page_cache()
+    print(f'✓ Cache de paginas vaciada ({removed} archivos en disco)')
+
+
+@app.cli.command('jobs-worker')
+@click.option('--once', is_flag=True, help='Procesar lo pendiente y salir.')
+@click.option('--interval', default=None, type=float, help='Segundos de espera cuando la cola esta vacia.')
+def jobs_worker_command(once, interval):
+    """Ejecuta la cola de tareas en este proceso (usar con JOBS_MODE=worker)."""
+    interval = interval or app.config.get('JOBS_POLL_INTERVAL', 5)
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    print(f'✓ Worker de tareas {worker_id} iniciado')
+    while True:
+        done = run_pending_jobs(worker_id)
+        if done:
+            print(f'✓ {done} tareas procesadas')
+        if once:
+            break
+        time.sleep(interval)
+
+
+@app.cli.command('jobs-status')
+def jobs_status_command():
+    """Muestra cuantas tareas hay por estado y las ultimas fallidas."""
+    counts = dict(db.session.query(Job.status, func.count(Job.id)).group_by(Job.status).all())
+    for status in ('pending', 'running', 'done', 'failed'):
+        print(f'{status}: {counts.get(status, 0)}')
+    for job in Job.query.filter_by(status='failed').order_by(Job.updated_at.desc()).limit(10).all():
+        print(f'  #{job.id} {job.kind} ({job.attempts} intentos): {job.last_error}')
+
+
+@app.cli.command('jobs-retry')
+@click.option('--id', 'job_id', type=int, default=None, help='Reintentar solo esta tarea.')
+def jobs_retry_command(job_id):
+    """Vuelve a poner en cola las tareas fallidas."""
+    query = Job.query.filter_by(status='failed')
+    if job_id:
+        query = query.filter_by(id=job_id)
+    count = query.update(
+        {Job.status: 'pending', Job.attempts: 0, Job.run_at: datetime.utcnow()},
+        synchronize_session=False
+    )
+    db.session.commit()
+    print(f'✓ {count} tareas en cola nuevamente')
+
+
+@app.cli.command('jobs-purge')
+@click.option('--days', default=7, type=int, help='Antiguedad minima de las tareas completadas.')
+def jobs_purge_command(days):
+    """Borra tareas completadas antiguas."""
+    limit = datetime.utcnow() - timedelta(days=days)
+    count = Job.query.filter(Job.status == 'done', Job.updated_at < limit).delete(synchronize_session=False)
+    db.session.commit()
+    print(f'✓ {count} tareas eliminadas')
+
+
+@app.cli.command('release-stock-reservations')
+def release_stock_reservations_command():
+    """Devuelve al stock las reservas de PayPal vencidas."""
+    released = release_expired_reservations(force=True)
+    db.session.commit()
+    print(f'✓ {released} reservas liberadas')
+
+
+@app.cli.command('paypal-reconcile')
+@click.option('--older-than', default=60, type=int, help='Segundos minimos desde la creacion del pedido.')
+def paypal_reconcile_command(older_than):
+    """Agenda la conciliacion de los pedidos PayPal que siguen pendientes."""
+    limit = datetime.utcnow() - timedelta(seconds=older_than)
+    ids = [row.paypal_order_id for row in db.session.query(Order.paypal_order_id).filter(
+        Order.status == PAYMENT_PENDING_STATUS,
+        Order.paypal_order_id.isnot(None),
+        Order.created_at <= limit
+    ).all()]
+    for paypal_order_id in ids:
+        enqueue_job('paypal_reconcile', {'paypal_order_id': paypal_order_id})
+    db.session.commit()
+    print(f'✓ {len(ids)} pedidos PayPal en conciliacion')
+
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recalcula los resumenes diarios de pedidos desde las tablas orders y custom_orders."""
+    total = rebuild_daily_stats()
+    db.session.commit()
+    print(f'✓ Resumenes diarios reconstruidos ({total} filas)')
+
+
+@app.cli.command('recount-order-items')
+def recount_order_items_command():
+    """Recalcula los contadores de prendas de todos los pedidos personalizados."""
+    result = db.session.execute(text(BACKFILL_ORDER_PROGRESS_SQL))
     db.session.commit()
+    print(f'✓ Contadores de prendas recalculados en {result.rowcount} pedidos')
+
+
+@app.cli.command('compact-measurement-revisions')
+@click.option('--days', default=None, type=int, help='Antiguedad maxima (por defecto CLIENT_MEASUREMENT_REVISIONS_DAYS).')
+def compact_measurement_revisions_command(days):
+    """Borra revisiones antiguas del historial de medidas de clientes."""
+    count = compact_client_measurement_revisions(days)
+    db.session.commit()
+    print(f'✓ {count} revisiones de medidas eliminadas')
+
+
+@app.cli.command('backfill-main-images')
+def backfill_main_images_command():
+    """Rellena products.main_image_filename para los productos existentes."""
+    result = db.session.execute(text(BACKFILL_MAIN_IMAGES_SQL))
+    db.session.execute(text(BACKFILL_MAIN_IMAGE_VARIANTS_SQL))
+    db.session.commit()
+    print(f'✓ Imagen principal actualizada en {result.rowcount} productos')
+
+
+@app.cli.command('generate-image-variants')
+@click.option('--force', is_flag=True, help='Regenerar tambien las imagenes que ya tienen derivados.')
+def generate_image_variants_command(force):
+    """Genera los derivados WebP/JPEG de las imagenes de producto ya subidas."""
+    query = ProductImage.query
+    if not force:
+        query = query.filter(ProductImage.variants.is_(None))
+    done = 0
+    for img in query.order_by(ProductImage.id).all():
+        variants = generate_image_variants(img.filename)
+        if variants:
+            img.variants = variants
+            done += 1
+    db.session.flush()
+    db.session.execute(text(BACKFILL_MAIN_IMAGE_VARIANTS_SQL))
+    invalidate_product_caches()
+    db.session.commit()
+    print(f'✓ Derivados generados para {done} imagenes')
 
 
 # ═══════════════════════════════════════════════════════════════════════════
 #                        RUTAS PÚBLICAS
 # ═══════════════════════════════════════════════════════════════════════════
 
+def _catalog_validators():
+    """ETag del catalogo/sitemap a partir de las versiones de productos y sitio (sin consultas extra)."""
+    # 'populares' cambia con las visitas, que no suben la version de productos
+    if request.args.get('sort') == 'populares':
+        return None
+    versions = get_cache_versions()
+    etag = ('catalogo', versions.get('products', 0), versions.get('site_context', 0))
+    return etag, cache_versions_updated_at('products', 'site_context')
+
+
+def _product_validators(slug, id):
+    row = db.session.query(Product.updated_at).filter(Product.id == id).first()
+    if row is None:
+        return None
+    versions = get_cache_versions()
+    updated_at = row.updated_at
+    etag = ('producto', id, updated_at.isoformat() if updated_at else '', versions.get('products', 0), versions.get('site_context', 0))
+    return etag, updated_at
+
+
 @app.route('/')
+@cached_page('products', 'site_context')
 def index():
     """Página principal"""
-    novedades = Product.query.filter_by(is_new=True, is_active=True).limit(8).all()
-    tendencias = Product.query.filter_by(is_trending=True, is_active=True).limit(8).all()
-    destacados = Product.query.filter_by(is_featured=True, is_active=True).limit(8).all()
-    productos = Product.query.filter_by(is_active=True).order_by(Product.created_at.desc()).limit(12).all()
+    sections = get_home_sections()
     
-    # Mezclar para variedad
-    random.shuffle(novedades)
-    random.shuffle(tendencias)
-    random.shuffle(destacados)
+    # Mezclar para variedad (copias, el pool cacheado no se modifica)
+    novedades = random.sample(sections['novedades'], len(sections['novedades']))
+    tendencias = random.sample(sections['tendencias'], len(sections['tendencias']))
+    destacados = random.sample(sections['destacados'], len(sections['destacados']))
     
     return render_template('public/index.html',
         novedades=novedades,
         tendencias=tendencias,
         destacados=destacados,
-        productos=productos
+        productos=sections['productos']
     )
 
 
+# Ordenes del catálogo: (columna, descendente, valor en el producto)
+CATALOG_SORTS = {
+    'recientes': (Product.created_at, True, attrgetter('created_at')),
+    'antiguos': (Product.created_at, False, attrgetter('created_at')),
+    'precio_asc': (Product.price, False, attrgetter('price')),
+    'precio_desc': (Product.price, True, attrgetter('price')),
+    'nombre_asc': (Product.name, False, attrgetter('name')),
+    'nombre_desc': (Product.name, True, attrgetter('name')),
+    'populares': (func.coalesce(Product.views, 0), True, lambda p: p.views or 0),
+}
+
+
 @app.route('/catalogo')
+@conditional_get(_catalog_validators)
+@cached_page('products', 'site_context')
 def catalogo():
     """Catálogo de productos con filtros y paginación"""
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 12, type=int)
+    after = request.args.get('after', '', type=str)
     q = request.args.get('q', '', type=str).strip()
     categoria_id = request.args.get('categoria', type=int)
-    sort = request.args.get('sort', 'recientes', type=str)
+    sort = request.args.get('sort', 'relevancia' if q else 'recientes', type=str)
     
     query = Product.query.filter_by(is_active=True)
     
@@ -1316,27 +3508,18 @@ def catalogo():
     if categoria_id:
         query = query.filter_by(category_id=categoria_id)
     
-    # Búsqueda
+    # Búsqueda (índice de texto completo)
+    relevance = None
     if q:
-        search = f"%{q}%"
-        query = query.filter(
-            or_(Product.name.ilike(search), Product.description.ilike(search))
-        )
-    
-    # Ordenamiento
-    sort_options = {
-        'recientes': Product.created_at.desc(),
-        'antiguos': Product.created_at.asc(),
-        'precio_asc': Product.price.asc(),
-        'precio_desc': Product.price.desc(),
-        'nombre_asc': Product.name.asc(),
-        'nombre_desc': Product.name.desc(),
-        'populares': Product.views.desc()
-    }
-    query = query.order_by(sort_options.get(sort, Product.created_at.desc()))
+        query, relevance = apply_product_search(query, q)
     
-    # Paginación
-    pagination = db.paginate(query, page=page, per_page=per_page, error_out=False)
+    # Ordenamiento y paginación (por número o por cursor)
+    if sort == 'relevancia' and relevance is not None:
+        pagination = query.order_by(relevance, Product.id.desc()).paginate(page=page, per_page=per_page, error_out=False)
+    else:
+        if sort not in CATALOG_SORTS:
+            sort = 'recientes'
+        pagination = paginate_listing(query, sort, CATALOG_SORTS[sort], Product.id, page, per_page, after)
     
     categoria = Category.query.get(categoria_id) if categoria_id else None
     categorias = Category.query.filter_by(is_active=True).order_by(Category.name).all()
@@ -1360,13 +3543,14 @@ def producto_detalle_legacy(id):
 
 
 @app.route('/p/<slug>-<int:id>')
+@conditional_get(_product_validators, on_not_modified=lambda slug, id: record_product_view(id))
+@cached_page('products', 'site_context', on_hit=lambda slug, id: record_product_view(id))
 def producto_detalle(slug, id):
     """Página de detalle de producto"""
     producto = Product.query.get_or_404(id)
     
-    # Incrementar vistas
-    producto.views += 1
-    db.session.commit()
+    # Incrementar vistas (por lotes, sin escribir en cada visita)
+    record_product_view(producto.id)
     
     # Productos relacionados
     relacionados = Product.query.filter(
@@ -1382,12 +3566,14 @@ def producto_detalle(slug, id):
 
 
 @app.route('/quienes-somos')
+@cached_page('site_context')
 def quienes_somos():
     """Página Quiénes Somos"""
     return render_template('public/quienes_somos.html')
 
 
 @app.route('/contacto')
+@cached_page('site_context')
 def contacto():
     """Página de Contacto"""
     return render_template('public/contacto.html')
@@ -1402,20 +3588,42 @@ def rastrear_pedido():
         pedido = Order.query.filter_by(order_code=code).first()
         if not pedido:
             flash('No se encontró un pedido con ese código.', 'warning')
-    return render_template('public/rastrear_pedido.html', pedido=pedido, code=code, statuses=ORDER_STATUSES)
+    return render_template('public/rastrear_pedido.html', pedido=pedido, code=code, statuses=ORDER_STATUSES,
+                           pending_status=PAYMENT_PENDING_STATUS, rejected_status=PAYMENT_REJECTED_STATUS)
 
 
 @app.route('/pedido/<order_code>')
 def pedido_confirmado(order_code):
     """Página de confirmación de pedido"""
     pedido = Order.query.filter_by(order_code=order_code.upper()).first_or_404()
-    return render_template('public/pedido_confirmado.html', pedido=pedido)
+    return render_template('public/pedido_confirmado.html', pedido=pedido, pending_status=PAYMENT_PENDING_STATUS)
 
 
 @app.route('/api/pedidos/<order_code>')
 def api_pedido(order_code):
-    """Endpoint de rastreo en JSON"""
+    """Endpoint de rastreo en JSON (con ETag para clientes que consultan el estado)"""
     pedido = Order.query.filter_by(order_code=order_code.upper()).first_or_404()
+    history = pedido.history or []
+    last_change = None
+    if history:
+        try:
+            last_change = datetime.fromisoformat(history[-1].get('timestamp'))
+        except (TypeError, ValueError, AttributeError):
+            last_change = None
+    etag = make_etag('pedido', pedido.id, pedido.status, len(history), last_change or '')
+    last_modified = last_change or pedido.created_at
+    if _is_not_modified(etag, last_modified):
+        resp = Response(status=304)
+    else:
+        resp = _api_pedido_response(pedido)
+    resp.set_etag(etag, weak=True)
+    if last_modified:
+        resp.last_modified = last_modified.replace(tzinfo=timezone.utc)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
+def _api_pedido_response(pedido):
     return jsonify({
         'order_code': pedido.order_code,
         'product': pedido.product.name if pedido.product else '',
@@ -1434,15 +3642,17 @@ def api_pedido(order_code):
 
 
 def paypal_api_base():
-    """Devuelve la URL base de PayPal segun entorno."""
+    """Devuelve la URL base de PayPal segun entorno (PAYPAL_API_BASE la reemplaza, p. ej. un stub local)."""
+    if app.config.get('PAYPAL_API_BASE'):
+        return app.config['PAYPAL_API_BASE'].rstrip('/')
     env = (app.config.get('PAYPAL_ENVIRONMENT') or 'sandbox').lower()
     return 'https://api-m.paypal.com' if env in ('live', 'production') else 'https://api-m.sandbox.paypal.com'
 
 
 def compute_paypal_total_usd(bs_amount):
     """Calcula el monto en USD incluyendo comision de PayPal."""
-    # Obtener tasa de cambio de la BD
-    settings = SiteSettings.query.first()
+    # Obtener tasa de cambio (configuración cacheada)
+    settings = get_site_context()['site_settings']
     rate = settings.exchange_rate if settings and settings.exchange_rate else 6.96
     
     percent = float(app.config.get('PAYPAL_PERCENT_FEE') or 0)
@@ -1457,22 +3667,130 @@ def compute_paypal_total_usd(bs_amount):
     return round(gross, 2)
 
 
-def paypal_get_token():
-    """Obtiene token OAuth de PayPal."""
+class PayPalClient:
+    """Cliente de la API REST de PayPal.
+
+    Reutiliza conexiones con requests.Session (keep-alive) y guarda el token OAuth hasta poco
+    antes de que venza (expires_in). Los reintentos con espera exponencial son para la cola de
+    tareas; las llamadas hechas dentro de una peticion web pasan retry=False y hacen un solo
+    intento, para no retener al worker mas de un timeout. Es seguro compartirlo entre hilos.
+    """
+
+    def __init__(self, base_url, client_id, secret, timeout=10, retries=2, backoff=0.5, refresh_margin=60):
+        self.base_url = base_url.rstrip('/')
+        self.client_id = client_id
+        self.secret = secret
+        self.timeout = timeout
+        self.refresh_margin = refresh_margin
+        self._token = None
+        self._token_expires_at = 0.0
+        self._token_lock = threading.Lock()
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({'GET', 'POST'}),
+            raise_on_status=False
+        )
+        self.session = self._build_session(retry)
+        self.request_session = self._build_session(0)
+
+    @staticmethod
+    def _build_session(max_retries):
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=10, max_retries=max_retries)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get_token(self, force=False, retry=True):
+        """Token OAuth vigente; solo un hilo lo renueva cuando esta por vencer."""
+        if not force and self._token and time.monotonic() < self._token_expires_at:
+            return self._token
+        with self._token_lock:
+            if not force and self._token and time.monotonic() < self._token_expires_at:
+                return self._token
+            session = self.session if retry else self.request_session
+            resp = session.post(
+                f'{self.base_url}/v1/oauth2/token',
+                data={'grant_type': 'client_credentials'},
+                auth=(self.client_id, self.secret),
+                timeout=self.timeout
+            )
+            resp.raise_for_status()
+            data = resp.json()
+            token = data.get('access_token')
+            if not token:
+                raise requests.RequestException('PayPal no devolvio access_token')
+            expires_in = float(data.get('expires_in') or 0)
+            self._token = token
+            self._token_expires_at = time.monotonic() + max(expires_in - self.refresh_margin, 0)
+            return token
+
+    def invalidate_token(self):
+        with self._token_lock:
+            self._token = None
+            self._token_expires_at = 0.0
+
+    def request(self, method, path, request_id=None, retry=True, **kwargs):
+        """Llama a la API con el token cacheado; si PayPal responde 401 lo renueva una vez.
+
+        request_id se envia como PayPal-Request-Id para que los reintentos de un POST
+        no dupliquen la operacion. retry=False hace un solo intento por llamada.
+        """
+        session = self.session if retry else self.request_session
+        for attempt in range(2):
+            headers = {
+                'Authorization': f'Bearer {self.get_token(force=attempt > 0, retry=retry)}',
+                'Content-Type': 'application/json'
+            }
+            if request_id:
+                headers['PayPal-Request-Id'] = request_id
+            resp = session.request(method, f'{self.base_url}{path}', headers=headers, timeout=self.timeout, **kwargs)
+            if resp.status_code == 401 and attempt == 0:
+                self.invalidate_token()
+                continue
+            resp.raise_for_status()
+            return resp.json()
+
+    def create_order(self, payload, retry=True):
+        return self.request('POST', '/v2/checkout/orders', json=payload, request_id=str(uuid.uuid4()), retry=retry)
+
+    def capture_order(self, order_id, retry=True):
+        return self.request('POST', f'/v2/checkout/orders/{order_id}/capture', request_id=f'capture-{order_id}', retry=retry)
+
+    def get_order(self, order_id, retry=True):
+        return self.request('GET', f'/v2/checkout/orders/{order_id}', retry=retry)
+
+
+_paypal_client_state = {'client': None, 'key': None}
+_paypal_client_lock = threading.Lock()
+
+
+def get_paypal_client():
+    """Cliente PayPal compartido del proceso; se recrea si cambian URL o credenciales."""
     client_id = app.config.get('PAYPAL_CLIENT_ID')
     secret = app.config.get('PAYPAL_SECRET')
     if not client_id or not secret:
         abort(500, description='Faltan credenciales de PayPal')
+    key = (paypal_api_base(), client_id, secret)
+    with _paypal_client_lock:
+        if _paypal_client_state['key'] != key:
+            _paypal_client_state['client'] = PayPalClient(
+                key[0], client_id, secret,
+                timeout=app.config.get('PAYPAL_TIMEOUT', 10),
+                retries=app.config.get('PAYPAL_RETRIES', 2)
+            )
+            _paypal_client_state['key'] = key
+        return _paypal_client_state['client']
+
+
+def paypal_get_token():
+    """Obtiene token OAuth de PayPal (cacheado hasta que este por vencer)."""
     try:
-        resp = requests.post(
-            f"{paypal_api_base()}/v1/oauth2/token",
-            data={'grant_type': 'client_credentials'},
-            auth=(client_id, secret),
-            timeout=10
-        )
-        resp.raise_for_status()
-        data = resp.json()
-        return data.get('access_token')
+        return get_paypal_client().get_token(retry=False)
     except requests.RequestException as exc:
         app.logger.exception('Error obteniendo token de PayPal: %s', exc)
         abort(502, description='No se pudo conectar con PayPal')
@@ -1480,11 +3798,6 @@ def paypal_get_token():
 
 def paypal_create_order(amount_usd, product):
     """Crea una orden de PayPal y devuelve su payload."""
-    token = paypal_get_token()
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Content-Type': 'application/json'
-    }
     payload = {
         'intent': 'CAPTURE',
         'purchase_units': [{
@@ -1502,14 +3815,7 @@ def paypal_create_order(amount_usd, product):
         }
     }
     try:
-        resp = requests.post(
-            f"{paypal_api_base()}/v2/checkout/orders",
-            json=payload,
-            headers=headers,
-            timeout=10
-        )
-        resp.raise_for_status()
-        return resp.json()
+        return get_paypal_client().create_order(payload, retry=False)
     except requests.RequestException as exc:
         app.logger.exception('Error creando orden PayPal: %s', exc)
         abort(502, description='No se pudo crear la orden en PayPal')
@@ -1517,43 +3823,218 @@ def paypal_create_order(amount_usd, product):
 
 def paypal_capture_order(order_id):
     """Captura una orden PayPal existente."""
-    token = paypal_get_token()
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Content-Type': 'application/json'
-    }
     try:
-        resp = requests.post(
-            f"{paypal_api_base()}/v2/checkout/orders/{order_id}/capture",
-            headers=headers,
-            timeout=10
-        )
-        resp.raise_for_status()
-        return resp.json()
+        return get_paypal_client().capture_order(order_id, retry=False)
     except requests.RequestException as exc:
         app.logger.exception('Error capturando orden PayPal %s: %s', order_id, exc)
         abort(502, description='No se pudo capturar el pago en PayPal')
 
 
-def _create_order(product_id, image_url, payment_method, total=None, customer_name=None, customer_phone=None, order_notes=None):
-    """Crea y persiste un pedido"""
+# Stock: solo se controla en productos con track_stock (piezas limitadas). El descuento es
+# un UPDATE condicionado (stock >= n), atomico con varios workers en SQLite o en un servidor.
+_stock_state = {'swept_at': 0.0}
+
+
+def take_stock(product, quantity=1):
+    """Descuenta stock en la transaccion del llamador; False si no alcanza."""
+    if not product.track_stock:
+        return True
+    updated = Product.query.filter(
+        Product.id == product.id,
+        Product.track_stock.is_(True),
+        Product.stock >= quantity
+    ).update({Product.stock: Product.stock - quantity}, synchronize_session=False)
+    db.session.expire(product, ['stock'])
+    if not updated:
+        return False
+    if (product.stock or 0) <= 0:
+        # Paso a agotado: las paginas publicas deben dejar de ofrecerlo
+        invalidate_product_caches()
+    return True
+
+
+def restore_stock(product_id, quantity=1):
+    """Devuelve unidades al stock (reserva vencida o pago rechazado)."""
+    updated = Product.query.filter(Product.id == product_id, Product.track_stock.is_(True)).update(
+        {Product.stock: Product.stock + quantity}, synchronize_session=False
+    )
+    if updated:
+        stock = db.session.query(Product.stock).filter(Product.id == product_id).scalar()
+        if stock == quantity:
+            invalidate_product_caches()
+    return bool(updated)
+
+
+def reserve_stock(product, paypal_order_id, quantity=1, amount_usd=None):
+    """Registra la orden PayPal y aparta stock durante el pago; se confirma al capturar o vence."""
+    if not product.track_stock:
+        quantity = 0
+    elif not take_stock(product, quantity):
+        return False
+    db.session.add(StockReservation(
+        product_id=product.id,
+        quantity=quantity,
+        paypal_order_id=paypal_order_id,
+        amount_usd=amount_usd,
+        expires_at=datetime.utcnow() + timedelta(seconds=app.config.get('STOCK_RESERVATION_TTL', 900))
+    ))
+    return True
+
+
+def consume_stock_reservation(paypal_order_id, product_id):
+    """Convierte la reserva en venta (el stock ya estaba descontado).
+
+    Devuelve las unidades que tenia apartadas (0 si el producto no controla stock), o None
+    si no existia una reserva de esa orden para ese producto.
+    """
+    reservation = StockReservation.query.filter_by(paypal_order_id=paypal_order_id, product_id=product_id).first()
+    if reservation is None:
+        return None
+    quantity = reservation.quantity
+    # DELETE condicionado: si otro worker la consumio o la barrio antes, no cuenta
+    if not StockReservation.query.filter_by(id=reservation.id).delete(synchronize_session=False):
+        return None
+    return quantity
+
+
+def take_order_stock(order):
+    """Descuenta la pieza de un pedido que aun no la tomo; False si no hay stock."""
+    if order.stock_quantity or not order.product.track_stock:
+        return True
+    if not take_stock(order.product):
+        return False
+    order.stock_quantity = 1
+    return True
+
+
+def release_order_stock(order):
+    """Devuelve al stock solo las unidades que el pedido tomo realmente."""
+    if order.stock_quantity:
+        restore_stock(order.product_id, order.stock_quantity)
+        order.stock_quantity = 0
+
+
+def release_expired_reservations(force=False):
+    """Devuelve al stock las reservas vencidas; sin force se ejecuta como mucho una vez por intervalo."""
+    if not force and time.monotonic() - _stock_state['swept_at'] < app.config.get('STOCK_SWEEP_INTERVAL', 60):
+        return 0
+    _stock_state['swept_at'] = time.monotonic()
+    released = 0
+    expired = StockReservation.query.filter(StockReservation.expires_at <= datetime.utcnow()).all()
+    for reservation in expired:
+        # El DELETE condicionado evita devolver dos veces si otro worker barre al mismo tiempo
+        if StockReservation.query.filter_by(id=reservation.id).delete(synchronize_session=False):
+            if reservation.quantity:
+                restore_stock(reservation.product_id, reservation.quantity)
+            released += 1
+    return released
+
+
+_idempotency_state = {'purged_at': 0.0}
+
+
+def idempotent_checkout(scope):
+    """Repite la respuesta original si llega otra vez la misma Idempotency-Key.
+
+    La clave (cabecera Idempotency-Key o campo idempotency_key) se guarda en el mismo
+    commit que crea el pedido, y la repeticion solo lee, sin abrir otra transaccion de escritura.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            data = request.get_json(force=True, silent=True) or {}
+            raw_key = (request.headers.get('Idempotency-Key') or data.get('idempotency_key') or '').strip()
+            if not raw_key:
+                return f(*args, **kwargs)
+            if len(raw_key) > 128:
+                abort(400, description='Idempotency-Key invalida')
+            key = f"{scope}:{hashlib.sha256(raw_key.encode('utf-8')).hexdigest()[:32]}"
+            body = {k: v for k, v in data.items() if k != 'idempotency_key'}
+            fingerprint = hashlib.sha256(json.dumps(body, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+            
+            stored = db.session.get(IdempotencyKey, key)
+            if stored and stored.expires_at > datetime.utcnow():
+                if stored.fingerprint != fingerprint:
+                    abort(422, description='La Idempotency-Key ya se uso con otros datos')
+                return jsonify(stored.response)
+            
+            g.idempotency = {'key': key, 'fingerprint': fingerprint, 'expired': stored}
+            try:
+                return f(*args, **kwargs)
+            except IntegrityError:
+                # Dos peticiones simultaneas con la misma clave: gana la primera en confirmar
+                db.session.rollback()
+                stored = db.session.get(IdempotencyKey, key)
+                if stored is None:
+                    raise
+                return jsonify(stored.response)
+        return wrapper
+    return decorator
+
+
+def checkout_response(order):
+    """Cuerpo JSON de los endpoints de checkout (tambien es lo que repite la Idempotency-Key)."""
+    return {
+        'order_code': order.order_code,
+        'status': order.status,
+        'redirect_url': url_for('pedido_confirmado', order_code=order.order_code)
+    }
+
+
+def stage_idempotent_response(order):
+    """Agrega la respuesta del checkout a la transaccion en curso si la peticion trae clave.
+
+    Si el pedido cambia despues (p. ej. al aplicar la captura de PayPal) se vuelve a llamar
+    antes del commit final para que la repeticion devuelva el mismo cuerpo.
+    """
+    pending = g.get('idempotency')
+    if not pending:
+        return
+    if pending.get('row') is not None:
+        pending['row'].response = checkout_response(order)
+        return
+    now = datetime.utcnow()
+    if pending['expired'] is not None:
+        db.session.delete(pending['expired'])
+    pending['row'] = IdempotencyKey(
+        key=pending['key'],
+        fingerprint=pending['fingerprint'],
+        response=checkout_response(order),
+        expires_at=now + timedelta(seconds=app.config.get('IDEMPOTENCY_TTL', 86400))
+    )
+    db.session.add(pending['row'])
+    # Expulsar claves vencidas de vez en cuando, dentro de la misma transaccion
+    if time.monotonic() - _idempotency_state['purged_at'] >= app.config.get('IDEMPOTENCY_PURGE_INTERVAL', 600):
+        _idempotency_state['purged_at'] = time.monotonic()
+        IdempotencyKey.query.filter(IdempotencyKey.expires_at <= now).delete(synchronize_session=False)
+
+
+def _create_order(product_id, image_url, payment_method, total=None, customer_name=None, customer_phone=None, order_notes=None,
+                  status=None, paypal_order_id=None, paypal_amount=None, stock_quantity=0, check_stock=False):
+    """Crea y persiste un pedido.
+
+    stock_quantity son las unidades que el pedido ya tomo (reserva de PayPal). check_stock solo
+    comprueba disponibilidad: los pedidos por WhatsApp/QR descuentan al confirmarlos en el panel.
+    """
     product = Product.query.get_or_404(product_id)
-    code = generate_order_code()
-    while Order.query.filter_by(order_code=code).first():
-        code = generate_order_code()
+    if check_stock and product.track_stock and (product.stock or 0) <= 0:
+        abort(409, description='Producto agotado')
     order = Order(
-        order_code=code,
         product_id=product.id,
         image_url=image_url,
         payment_method=payment_method,
         total=total or product.price,
-        status='Pagado' if payment_method == 'paypal' else 'Recibido',
+        status=status or ('Pagado' if payment_method == 'paypal' else 'Recibido'),
         customer_name=customer_name,
         customer_phone=customer_phone,
-        order_notes=order_notes
+        order_notes=order_notes,
+        paypal_order_id=paypal_order_id,
+        paypal_amount=paypal_amount,
+        stock_quantity=stock_quantity
     )
     append_history(order, order.status, note=f'Creado via {payment_method}')
-    db.session.add(order)
+    add_with_unique_code(order, 'order_code', generate_order_code)
+    stage_idempotent_response(order)
     db.session.commit()
     return order
 
@@ -1572,6 +4053,8 @@ def checkout_paypal():
         abort(400, description='Producto invalido')
     
     product = Product.query.get_or_404(product_id)
+    if product.track_stock and (product.stock or 0) <= 0:
+        abort(409, description='Producto agotado')
     bs_total = product.price
     usd_total = compute_paypal_total_usd(bs_total)
     
@@ -1580,6 +4063,13 @@ def checkout_paypal():
     if not order_id:
         abort(502, description='PayPal no devolvio ID de orden')
     
+    # Apartar la pieza mientras el cliente paga (despues de la llamada HTTP, para no bloquear la BD)
+    release_expired_reservations()
+    if not reserve_stock(product, order_id, amount_usd=usd_total):
+        db.session.commit()
+        abort(409, description='Producto agotado')
+    db.session.commit()
+    
     return jsonify({
         'order_id': order_id,
         'amount_usd': usd_total,
@@ -1587,23 +4077,10 @@ def checkout_paypal():
     })
 
 
-@app.route('/api/checkout/paypal/capture', methods=['POST'])
-def checkout_paypal_capture():
-    """Captura el pago de PayPal y genera el pedido."""
-    data = request.get_json(force=True, silent=True) or {}
-    order_id = data.get('order_id')
-    image_url = (data.get('image_url') or '').strip()
-    order_notes = (data.get('order_notes') or '').strip()
-    
-    if not order_id:
-        abort(400, description='Falta el ID de orden de PayPal')
-    
-    capture_data = paypal_capture_order(order_id)
-    
-    if capture_data.get('status') != 'COMPLETED':
-        abort(400, description='El pago no se completo en PayPal')
-    
-    purchase_units = capture_data.get('purchase_units') or []
+def parse_paypal_result(data):
+    """Extrae (estado, product_id, capture_id) de una orden o captura de PayPal."""
+    status = data.get('status')
+    purchase_units = data.get('purchase_units') or []
     product_id = None
     capture_id = None
     
@@ -1618,23 +4095,255 @@ def checkout_paypal_capture():
         captures = payments.get('captures') or []
         if captures:
             capture_id = captures[0].get('id')
+            # Una orden COMPLETED puede traer la captura rechazada o pendiente de revision
+            if captures[0].get('status') in ('DECLINED', 'FAILED'):
+                status = 'DECLINED'
+            elif captures[0].get('status') == 'PENDING':
+                status = 'PENDING'
+    return status, product_id, capture_id
+
+
+def paypal_result_mismatch(order, data):
+    """Motivo por el que la orden o captura de PayPal no corresponde al pedido, o None si coincide.
+
+    Compara el producto (custom_id) y el monto cobrado con los que la tienda fijo al crear la orden.
+    """
+    _, product_id, _ = parse_paypal_result(data)
+    if product_id != order.product_id:
+        return f'producto {product_id} en lugar de {order.product_id}'
+    unit = (data.get('purchase_units') or [{}])[0]
+    captures = (unit.get('payments') or {}).get('captures') or []
+    amount = (captures[0] if captures else unit).get('amount') or {}
+    expected = order.paypal_amount if order.paypal_amount is not None else compute_paypal_total_usd(order.total)
+    try:
+        value = float(amount.get('value'))
+    except (TypeError, ValueError):
+        value = None
+    if amount.get('currency_code') != 'USD' or value is None or abs(value - expected) > 0.005:
+        return f"monto {amount.get('value')} {amount.get('currency_code')} en lugar de {expected:.2f} USD"
+    return None
+
+
+def reject_paypal_order(order, note):
+    """Marca el pedido como pago rechazado y devuelve al stock lo que haya tomado."""
+    order.status = PAYMENT_REJECTED_STATUS
+    append_history(order, PAYMENT_REJECTED_STATUS, note=note)
+    release_order_stock(order)
+
+
+def apply_paypal_result(order, data):
+    """Confirma o rechaza un pedido pendiente segun la respuesta de PayPal.
+
+    Un pedido rechazado sin captura (conciliacion agotada) se reabre si PayPal ya cobro.
+    Es idempotente: si el pedido ya tiene capture_id o no esta pendiente ni rechazado no hace
+    nada. Devuelve True si cambio el pedido.
+    """
+    if order.paypal_capture_id or order.status not in (PAYMENT_PENDING_STATUS, PAYMENT_REJECTED_STATUS):
+        return False
+    status, product_id, capture_id = parse_paypal_result(data)
+    rejected = order.status == PAYMENT_REJECTED_STATUS
+    if rejected and status != 'COMPLETED':
+        return False
+    if status == 'COMPLETED':
+        problem = paypal_result_mismatch(order, data)
+        if problem:
+            # Cobrado, pero no es lo que se pidio: no se entrega y queda para reembolso
+            app.logger.warning('Pago PayPal %s no coincide con el pedido %s: %s', order.paypal_order_id, order.order_code, problem)
+            order.paypal_capture_id = capture_id
+            note = f'El pago no coincide con el pedido ({problem}); reembolsar en PayPal'
+            if rejected:
+                append_history(order, PAYMENT_REJECTED_STATUS, note=note)
+            else:
+                reject_paypal_order(order, note)
+            return True
+        if rejected and not take_order_stock(order):
+            # La pieza ya se devolvio al rechazar y se vendio de nuevo: el pago queda igual
+            app.logger.warning('Pago PayPal %s confirmado tarde sin stock de %s', order.paypal_order_id, order.product.name)
+        order.paypal_capture_id = capture_id
+        order.status = 'Pagado'
+        note = f'Pago PayPal confirmado (capture {capture_id})' if capture_id else 'Pago PayPal confirmado'
+        append_history(order, 'Pagado', note=note)
+        return True
+    if status in ('VOIDED', 'DECLINED'):
+        reject_paypal_order(order, f'PayPal reporto el pago como {status}')
+        return True
+    return False
+
+
+# Estados de PayPal en los que el cobro pudo ocurrir o aun puede completarse
+PAYPAL_MAYBE_CHARGED_STATUSES = ('APPROVED', 'PENDING', 'COMPLETED')
+
+
+def abandon_paypal_order(paypal_order_id):
+    """La conciliacion agoto sus intentos.
+
+    Si PayPal nunca llego a aprobar el pago el pedido pasa a rechazado. Si pudo cobrarse
+    (captura en revision, o respuesta de la captura perdida) queda pendiente y marcado para
+    revisarlo a mano; el webhook lo sigue conciliando.
+    """
+    order = Order.query.filter_by(paypal_order_id=paypal_order_id).first()
+    if order is None or order.status != PAYMENT_PENDING_STATUS:
+        return
+    if order.paypal_capture_id or order.paypal_status in PAYPAL_MAYBE_CHARGED_STATUSES:
+        app.logger.warning('Pago PayPal %s sin resolver (estado %s): revisar a mano', paypal_order_id, order.paypal_status)
+        append_history(order, PAYMENT_PENDING_STATUS,
+                       note=f'PayPal sigue en estado {order.paypal_status}; revisar el pago a mano')
+        return
+    reject_paypal_order(order, 'PayPal no confirmo el pago a tiempo')
+
+
+@job_handler('paypal_reconcile', on_give_up=abandon_paypal_order)
+def reconcile_paypal_order(paypal_order_id):
+    """Consulta la orden en PayPal, la captura si esta aprobada y confirma el pedido.
+
+    Solo captura si producto y monto coinciden con el pedido, y nunca para un pedido ya
+    rechazado (esos solo se reabren si PayPal ya cobro). El ultimo estado visto queda en
+    paypal_status. Los errores de red se propagan para que la cola reintente la tarea.
+    """
+    order = Order.query.filter_by(paypal_order_id=paypal_order_id).first()
+    if order is None or order.paypal_capture_id:
+        return
+    if order.status not in (PAYMENT_PENDING_STATUS, PAYMENT_REJECTED_STATUS):
+        return
+    client = get_paypal_client()
+    try:
+        data = client.get_order(paypal_order_id)
+    except requests.HTTPError as exc:
+        if exc.response is not None and exc.response.status_code == 404:
+            if order.status == PAYMENT_PENDING_STATUS:
+                reject_paypal_order(order, 'PayPal no reconoce la orden')
+                db.session.commit()
+            return
+        raise
+    order.paypal_status = parse_paypal_result(data)[0]
+    if order.status == PAYMENT_REJECTED_STATUS:
+        apply_paypal_result(order, data)
+        db.session.commit()
+        return
+    if data.get('status') == 'APPROVED':
+        problem = paypal_result_mismatch(order, data)
+        if problem:
+            app.logger.warning('Orden PayPal %s no coincide con el pedido %s: %s', paypal_order_id, order.order_code, problem)
+            reject_paypal_order(order, f'La orden PayPal no coincide con el pedido ({problem}); no se capturo')
+            db.session.commit()
+            return
+        # Guardar APPROVED antes de capturar: si se pierde la respuesta, el pago pudo cobrarse
+        db.session.commit()
+        data = client.capture_order(paypal_order_id)
+        order.paypal_status = parse_paypal_result(data)[0]
+    if apply_paypal_result(order, data):
+        db.session.commit()
+    elif order.paypal_status in ('APPROVED', 'PENDING', 'CREATED', 'SAVED', 'PAYER_ACTION_REQUIRED'):
+        # Aun sin resolver en PayPal: reintentar mas tarde
+        db.session.commit()
+        raise RuntimeError(f'Pago PayPal {paypal_order_id} aun en estado {order.paypal_status}')
+    else:
+        db.session.commit()
+
+
+@app.route('/api/checkout/paypal/capture', methods=['POST'])
+@idempotent_checkout('paypal')
+def checkout_paypal_capture():
+    """Captura el pago de PayPal y genera el pedido.
+
+    En modo asincrono (PAYPAL_CAPTURE_MODE='async') registra el pedido como pendiente
+    sin llamar a PayPal; la captura la hace la cola de tareas y el webhook la confirma.
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    order_id = data.get('order_id')
+    image_url = (data.get('image_url') or '').strip()
+    order_notes = (data.get('order_notes') or '').strip()
     
-    if not product_id:
-        abort(400, description='No se pudo asociar el producto al pago')
+    if not order_id:
+        abort(400, description='Falta el ID de orden de PayPal')
     
-    product = Product.query.get_or_404(product_id)
-    order = _create_order(product.id, image_url, 'paypal', total=product.price, order_notes=order_notes)
-    note = f'Pago PayPal confirmado (capture {capture_id})' if capture_id else 'Pago PayPal confirmado'
-    append_history(order, 'Pagado', note=note)
+    # Reintentos del navegador: devolver el pedido ya registrado para esta orden PayPal
+    existing = Order.query.filter_by(paypal_order_id=order_id).first()
+    if existing:
+        return jsonify(checkout_response(existing))
+    
+    # Solo se aceptan ordenes creadas por /api/checkout/paypal y aun vigentes; la reserva fija producto y monto
+    reservation = StockReservation.query.filter_by(paypal_order_id=order_id).first()
+    if reservation is None:
+        abort(409, description='La orden de PayPal vencio o no fue creada por la tienda')
+    product = Product.query.get_or_404(reservation.product_id)
+    paypal_amount = reservation.amount_usd or compute_paypal_total_usd(product.price)
+    
+    if app.config.get('PAYPAL_CAPTURE_MODE', 'async') == 'async':
+        try:
+            product_id = int(data.get('product_id'))
+        except (TypeError, ValueError):
+            abort(400, description='Producto invalido')
+        # Sin la reserva de este producto (vencida, barrida o ajena) no se descuenta stock nuevo
+        quantity = consume_stock_reservation(order_id, product_id) if product_id == product.id else None
+        if quantity is None:
+            db.session.rollback()
+            abort(409, description='La orden de PayPal vencio o no corresponde al producto')
+        try:
+            order = _create_order(product.id, image_url, 'paypal', total=product.price, order_notes=order_notes,
+                                  status=PAYMENT_PENDING_STATUS, paypal_order_id=order_id, paypal_amount=paypal_amount,
+                                  stock_quantity=quantity)
+        except IntegrityError:
+            # Otra peticion registro la misma orden PayPal al mismo tiempo (y encolo la conciliacion)
+            db.session.rollback()
+            order = Order.query.filter_by(paypal_order_id=order_id).first_or_404()
+        else:
+            # Despues de confirmar el pedido, para que la tarea siempre lo encuentre
+            enqueue_job('paypal_reconcile', {'paypal_order_id': order_id},
+                        max_attempts=app.config.get('PAYPAL_RECONCILE_ATTEMPTS', 8))
+            db.session.commit()
+        return jsonify(checkout_response(order))
+    
+    capture_data = paypal_capture_order(order_id)
+    if parse_paypal_result(capture_data)[0] != 'COMPLETED':
+        abort(400, description='El pago no se completo en PayPal')
+    
+    quantity = consume_stock_reservation(order_id, product.id)
+    if quantity is None:
+        quantity = 0
+        if product.track_stock and take_stock(product):
+            quantity = 1
+        elif product.track_stock:
+            # El pago ya se capturo: se registra igual y se avisa para resolverlo con el cliente
+            app.logger.warning('Pago PayPal %s capturado sin stock de %s', order_id, product.name)
+    order = _create_order(product.id, image_url, 'paypal', total=product.price, order_notes=order_notes,
+                          status=PAYMENT_PENDING_STATUS, paypal_order_id=order_id, paypal_amount=paypal_amount,
+                          stock_quantity=quantity)
+    # Confirma el pedido, o lo rechaza si lo cobrado no coincide con producto y monto
+    apply_paypal_result(order, capture_data)
+    stage_idempotent_response(order)
     db.session.commit()
     
-    return jsonify({
-        'order_code': order.order_code,
-        'redirect_url': url_for('pedido_confirmado', order_code=order.order_code)
-    })
+    return jsonify(checkout_response(order))
+
+
+@app.route('/api/paypal/webhook', methods=['POST'])
+def paypal_webhook():
+    """Webhook de PayPal: no confia en el cuerpo, solo agenda una conciliacion de la orden."""
+    payload = request.get_json(force=True, silent=True) or {}
+    resource = payload.get('resource') or {}
+    event_type = payload.get('event_type') or ''
+    if event_type.startswith('CHECKOUT.ORDER.'):
+        paypal_order_id = resource.get('id')
+    else:
+        related = (resource.get('supplementary_data') or {}).get('related_ids') or {}
+        paypal_order_id = related.get('order_id')
+    if paypal_order_id:
+        # Tambien los rechazados sin captura: PayPal puede cobrar despues de agotada la conciliacion
+        pending = db.session.query(Order.id).filter(
+            Order.paypal_order_id == paypal_order_id,
+            Order.paypal_capture_id.is_(None),
+            Order.status.in_((PAYMENT_PENDING_STATUS, PAYMENT_REJECTED_STATUS))
+        ).first()
+        if pending:
+            enqueue_job('paypal_reconcile', {'paypal_order_id': paypal_order_id},
+                        max_attempts=app.config.get('PAYPAL_RECONCILE_ATTEMPTS', 8))
+            db.session.commit()
+    return jsonify({'ok': True})
 
 
 @app.route('/api/checkout/whatsapp', methods=['POST'])
+@idempotent_checkout('whatsapp')
 def checkout_whatsapp():
     """Genera pedido iniciado por WhatsApp"""
     data = request.get_json(force=True, silent=True) or {}
@@ -1651,15 +4360,13 @@ def checkout_whatsapp():
     except (TypeError, ValueError):
         abort(400, description='Producto inválido')
     
-    order = _create_order(product_id, image_url, 'whatsapp', total=total, order_notes=order_notes)
+    order = _create_order(product_id, image_url, 'whatsapp', total=total, order_notes=order_notes, check_stock=True)
     
-    return jsonify({
-        'order_code': order.order_code,
-        'redirect_url': url_for('pedido_confirmado', order_code=order.order_code)
-    })
+    return jsonify(checkout_response(order))
 
 
 @app.route('/api/checkout/qr', methods=['POST'])
+@idempotent_checkout('qr')
 def checkout_qr():
     """Genera pedido iniciado por QR"""
     data = request.get_json(force=True, silent=True) or {}
@@ -1676,12 +4383,9 @@ def checkout_qr():
     except (TypeError, ValueError):
         abort(400, description='Producto invalido')
     
-    order = _create_order(product_id, image_url, 'qr', total=total, order_notes=order_notes)
+    order = _create_order(product_id, image_url, 'qr', total=total, order_notes=order_notes, check_stock=True)
     
-    return jsonify({
-        'order_code': order.order_code,
-        'redirect_url': url_for('pedido_confirmado', order_code=order.order_code)
-    })
+    return jsonify(checkout_response(order))
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -1702,6 +4406,8 @@ Sitemap: {base}/sitemap.xml
 
 
 @app.route('/sitemap.xml')
+@conditional_get(_catalog_validators)
+@cached_page('products', 'site_context')
 def sitemap_xml():
     """Sitemap XML para SEO"""
     base = request.url_root.rstrip('/')
@@ -1778,15 +4484,9 @@ def admin_logout():
 @login_required
 def admin_dashboard():
     """Dashboard principal del admin"""
-    stats = {
-        'productos': Product.query.count(),
-        'categorias': Category.query.count(),
-        'usuarios': User.query.count(),
-        'productos_activos': Product.query.filter_by(is_active=True).count(),
-        'novedades': Product.query.filter_by(is_new=True).count(),
-        'tendencias': Product.query.filter_by(is_trending=True).count(),
-        'destacados': Product.query.filter_by(is_featured=True).count(),
-    }
+    flush_product_views()
+    stats = get_live_counts()
+    resumen = get_dashboard_series(app.config.get('STATS_DASHBOARD_DAYS', 30))
     
     # Productos más vistos
     top_productos = Product.query.order_by(Product.views.desc()).limit(5).all()
@@ -1796,6 +4496,7 @@ def admin_dashboard():
     
     return render_template('admin/dashboard.html',
         stats=stats,
+        resumen=resumen,
         top_productos=top_productos,
         notificaciones=notificaciones
     )
@@ -1824,9 +4525,10 @@ def admin_categorias():
                 is_active=form.is_active.data
             )
             db.session.add(categoria)
-            db.session.commit()
-            
+            invalidate_site_context()
             create_notification(f'Nueva categoría: {categoria.name}', current_user.username, 'success')
+            db.session.commit()
+
             flash('Categoría creada correctamente.', 'success')
             return redirect(url_for('admin_categorias'))
     
@@ -1852,6 +4554,8 @@ def admin_categoria_editar(id):
             categoria.description = form.description.data
             categoria.icon = form.icon.data or 'bi-tag'
             categoria.is_active = form.is_active.data
+            reindex_category_search(categoria.id)
+            invalidate_site_context()
             db.session.commit()
             
             flash('Categoría actualizada.', 'success')
@@ -1874,9 +4578,10 @@ def admin_categoria_eliminar(id):
         return redirect(url_for('admin_categorias'))
     
     db.session.delete(categoria)
-    db.session.commit()
-    
+    invalidate_site_context()
     create_notification(f'Categoría eliminada: {nombre}', current_user.username, 'warning')
+    db.session.commit()
+
     flash('Categoría eliminada.', 'warning')
     return redirect(url_for('admin_categorias'))
 
@@ -1891,6 +4596,7 @@ def admin_categoria_eliminar(id):
 def admin_productos():
     """Listado de productos"""
     page = request.args.get('page', 1, type=int)
+    after = request.args.get('after', '', type=str)
     q = request.args.get('q', '', type=str).strip()
     categoria_id = request.args.get('categoria', type=int)
     
@@ -1901,7 +4607,7 @@ def admin_productos():
     if categoria_id:
         query = query.filter_by(category_id=categoria_id)
     
-    pagination = db.paginate(query.order_by(Product.created_at.desc()), page=page, per_page=15)
+    pagination = paginate_listing(query, 'recientes', CATALOG_SORTS['recientes'], Product.id, page, 15, after)
     categorias = Category.query.filter_by(is_active=True).all()
     
     return render_template('admin/productos.html',
@@ -1934,7 +4640,9 @@ def admin_producto_nuevo():
             is_new=form.is_new.data,
             is_trending=form.is_trending.data,
             is_featured=form.is_featured.data,
-            is_active=form.is_active.data
+            is_active=form.is_active.data,
+            track_stock=form.track_stock.data,
+            stock=form.stock.data or 0
         )
         db.session.add(producto)
         db.session.commit()
@@ -1952,16 +4660,21 @@ def admin_producto_nuevo():
             if f and f.filename and allowed_file(f.filename):
                 filename = save_image(f, product_folder, f'prod_{producto.id}_')
                 if filename:
+                    rel_path = os.path.join(folder_name, filename).replace('\\', '/')
                     img = ProductImage(
-                        filename=os.path.join(folder_name, filename).replace('\\', '/'),
+                        filename=rel_path,
                         is_main=(i == main_index),
                         order=i,
                         product_id=producto.id
                     )
                     db.session.add(img)
         
-        db.session.commit()
+        sync_product_main_image(producto)
+        index_product_search(producto)
+        invalidate_product_caches()
+        enqueue_job('product_image_variants', {'product_id': producto.id})
         create_notification(f'Nuevo producto: {producto.name}', current_user.username, 'success')
+        db.session.commit()
         flash('Producto creado correctamente.', 'success')
         return redirect(url_for('admin_productos'))
     
@@ -1990,15 +4703,17 @@ def admin_producto_editar(id):
         producto.is_trending = form.is_trending.data
         producto.is_featured = form.is_featured.data
         producto.is_active = form.is_active.data
+        producto.track_stock = form.track_stock.data
+        # Solo escribir el stock si el admin lo cambio; asi no pisa ventas ocurridas mientras editaba
+        if str(form.stock.data or 0) != (request.form.get('stock_original') or '0'):
+            producto.stock = form.stock.data or 0
         
         # Eliminar imágenes marcadas
         delete_ids = request.form.getlist('delete_image_ids')
         for img_id in delete_ids:
             img = ProductImage.query.get(int(img_id))
             if img:
-                img_path = os.path.join(UPLOAD_FOLDER, img.filename)
-                if os.path.exists(img_path):
-                    os.remove(img_path)
+                delete_image_files(img)
                 db.session.delete(img)
         
         # Manejar imagen principal
@@ -2025,16 +4740,21 @@ def admin_producto_editar(id):
             if f and f.filename and allowed_file(f.filename):
                 filename = save_image(f, product_folder, f'prod_{producto.id}_')
                 if filename:
+                    rel_path = os.path.join(folder_name, filename).replace('\\', '/')
                     img = ProductImage(
-                        filename=os.path.join(folder_name, filename).replace('\\', '/'),
+                        filename=rel_path,
                         is_main=(not is_existing and i == main_int),
                         order=producto.images.count() + i,
                         product_id=producto.id
                     )
                     db.session.add(img)
         
-        db.session.commit()
+        sync_product_main_image(producto)
+        index_product_search(producto)
+        invalidate_product_caches()
+        enqueue_job('product_image_variants', {'product_id': producto.id})
         create_notification(f'Producto editado: {producto.name}', current_user.username, 'info')
+        db.session.commit()
         flash('Producto actualizado.', 'success')
         return redirect(url_for('admin_productos'))
     
@@ -2060,10 +4780,12 @@ def admin_producto_eliminar(id):
     # Eliminar imágenes y carpeta
     delete_product_assets(producto)
     
+    remove_product_search(producto.id)
+    invalidate_product_caches()
     db.session.delete(producto)
-    db.session.commit()
-    
     create_notification(f'Producto eliminado: {nombre}', current_user.username, 'warning')
+    db.session.commit()
+
     flash('Producto eliminado.', 'warning')
     return redirect(url_for('admin_productos'))
 
@@ -2165,9 +4887,9 @@ def admin_usuario_nuevo():
                     changed_by=current_user.username,
                     note='Permisos asignados al crear usuario'
                 )
-            db.session.commit()
-            
             create_notification(f'Nuevo administrador: {user.username}', current_user.username, 'success')
+            db.session.commit()
+
             flash('Usuario creado correctamente.', 'success')
             return redirect(url_for('admin_usuarios'))
     
@@ -2245,9 +4967,9 @@ def admin_usuario_eliminar(id):
     
     nombre = user.username
     db.session.delete(user)
-    db.session.commit()
-    
     create_notification(f'Usuario eliminado: {nombre}', current_user.username, 'warning')
+    db.session.commit()
+
     flash('Usuario eliminado.', 'warning')
     return redirect(url_for('admin_usuarios'))
 
@@ -2288,6 +5010,7 @@ def admin_theme_nuevo():
             is_default=form.is_default.data
         )
         db.session.add(tema)
+        invalidate_site_context()
         db.session.commit()
         
         flash('Tema creado correctamente.', 'success')
@@ -2309,6 +5032,7 @@ def admin_theme_editar(id):
             Theme.query.update({Theme.is_default: False})
         
         form.populate_obj(tema)
+        invalidate_site_context()
         db.session.commit()
         
         flash('Tema actualizado.', 'success')
@@ -2329,6 +5053,7 @@ def admin_theme_eliminar(id):
         return redirect(url_for('admin_themes'))
     
     db.session.delete(tema)
+    invalidate_site_context()
     db.session.commit()
     
     flash('Tema eliminado.', 'warning')
@@ -2346,6 +5071,7 @@ def admin_theme_activar():
         Theme.query.update({Theme.is_default: False})
         tema = Theme.query.get_or_404(tema_id)
         tema.is_default = True
+        invalidate_site_context()
         db.session.commit()
         flash(f'Tema "{tema.name}" activado.', 'success')
     
@@ -2364,12 +5090,14 @@ def admin_contactos():
     if not info:
         info = ContactInfo()
         db.session.add(info)
+        invalidate_site_context()
         db.session.commit()
     
     form = ContactForm(obj=info)
     
     if form.validate_on_submit():
         form.populate_obj(info)
+        invalidate_site_context()
         db.session.commit()
         flash('Información de contacto actualizada.', 'success')
         return redirect(url_for('admin_contactos'))
@@ -2386,6 +5114,7 @@ def admin_settings():
     if not settings:
         settings = SiteSettings()
         db.session.add(settings)
+        invalidate_site_context()
         db.session.commit()
     
     form = SiteSettingsForm(obj=settings)
@@ -2406,6 +5135,7 @@ def admin_settings():
             if filename:
                 settings.qr_image = filename
         
+        invalidate_site_context()
         db.session.commit()
         flash('Configuración actualizada correctamente.', 'success')
         return redirect(url_for('admin_settings'))
@@ -2422,9 +5152,48 @@ def admin_settings():
 @login_required
 @permission_required('manage_orders')
 def admin_pedidos():
-    """Listado de pedidos"""
-    pedidos = Order.query.order_by(Order.created_at.desc()).all()
-    return render_template('admin/pedidos.html', pedidos=pedidos, statuses=ORDER_STATUSES)
+    """Listado de pedidos paginado y filtrable"""
+    page = request.args.get('page', 1, type=int)
+    after = request.args.get('after', '', type=str)
+    estado = request.args.get('estado', '', type=str)
+    metodo = request.args.get('metodo', '', type=str)
+    q = (request.args.get('q') or '').strip()
+    desde = request.args.get('desde', type=lambda v: datetime.strptime(v, '%Y-%m-%d').date())
+    hasta = request.args.get('hasta', type=lambda v: datetime.strptime(v, '%Y-%m-%d').date())
+
+    # El producto (con su imagen principal desnormalizada) llega en la misma consulta
+    query = Order.query.options(joinedload(Order.product))
+    if estado:
+        query = query.filter(Order.status == estado)
+    if metodo:
+        query = query.filter(Order.payment_method == metodo)
+    if desde:
+        query = query.filter(Order.created_at >= utc_day_start(desde))
+    if hasta:
+        query = query.filter(Order.created_at < utc_day_start(hasta + timedelta(days=1)))
+    if q:
+        like = f'%{q}%'
+        query = query.filter(or_(
+            Order.order_code == q.upper(),
+            Order.order_code.ilike(like),
+            Order.customer_name.ilike(like),
+            Order.customer_phone.ilike(like)
+        ))
+
+    pagination = paginate_listing(
+        query, 'recientes', (Order.created_at, True, attrgetter('created_at')),
+        Order.id, page, app.config.get('ORDERS_PER_PAGE', 25), after
+    )
+    filtros = {'estado': estado, 'metodo': metodo, 'q': q,
+               'desde': desde.isoformat() if desde else '', 'hasta': hasta.isoformat() if hasta else ''}
+    return render_template('admin/pedidos.html',
+        pedidos=pagination.items,
+        pagination=pagination,
+        filtros=filtros,
+        statuses=ORDER_STATUSES,
+        filter_statuses=ORDER_STATUSES + [PAYMENT_PENDING_STATUS, PAYMENT_REJECTED_STATUS],
+        payment_methods=PAYMENT_METHODS
+    )
 
 
 @app.route('/admin/pedidos/<int:order_id>/estado', methods=['POST'])
@@ -2435,6 +5204,11 @@ def admin_pedido_estado(order_id):
     pedido = Order.query.get_or_404(order_id)
     new_status = request.form.get('status')
     if new_status and new_status in ORDER_STATUSES:
+        # Los pedidos por WhatsApp/QR toman la pieza al confirmarlos (salir de 'Recibido')
+        if new_status == 'Recibido':
+            release_order_stock(pedido)
+        elif not take_order_stock(pedido):
+            flash(f'{pedido.product.name} no tiene stock; el pedido se actualizo igual.', 'warning')
         pedido.status = new_status
         append_history(pedido, new_status, note=f'Actualizado por {current_user.username}')
         db.session.commit()
@@ -2451,6 +5225,7 @@ def admin_pedido_eliminar(order_id):
     """Eliminar pedido individual"""
     pedido = Order.query.get_or_404(order_id)
     code = pedido.order_code
+    release_order_stock(pedido)
     db.session.delete(pedido)
     db.session.commit()
     flash(f'Pedido {code} eliminado.', 'warning')
@@ -2536,6 +5311,7 @@ def api_assign_workshop_item(item_id):
     due_raw = payload.get('due_date')
 
     taller = Workshop.query.get_or_404(workshop_id) if workshop_id else None
+    old_status = item.workshop_status or 'pendiente'
     item.workshop = taller
     if taller:
         item.workshop_status = status
@@ -2561,6 +5337,7 @@ def api_assign_workshop_item(item_id):
             return jsonify({'error': 'La fecha de entrega al taller no puede exceder la fecha limite del pedido.'}), 400
     item.workshop_due_date = parsed_due
 
+    track_item_status(item.order, old_status, item.workshop_status)
     refresh_order_workshop_status(item.order)
     db.session.commit()
 
@@ -2621,6 +5398,7 @@ def api_item_workshop_status(item_id):
         f'Prenda {item.id}: {WORKSHOP_ITEM_STATUS_LABELS.get(old_status, old_status)} -> {WORKSHOP_ITEM_STATUS_LABELS.get(new_status, new_status)}',
         user=(current_user.name or current_user.username)
     )
+    track_item_status(item.order, old_status, new_status)
     refresh_order_workshop_status(item.order)
     db.session.commit()
     return jsonify({
@@ -2633,23 +5411,69 @@ def api_item_workshop_status(item_id):
 @login_required
 @permission_required('manage_custom_orders')
 def api_pedidos_en_taller():
-    """Listado filtrado de pedidos donde todas las prendas estan asignadas."""
-    pedidos = CustomOrder.query.filter_by(is_deleted=False).order_by(CustomOrder.created_at.desc()).all()
-    data = []
-    for p in pedidos:
+    """Pedidos donde todas las prendas estan asignadas a un taller, paginados.
+
+    ?since=<server_time de la respuesta anterior> devuelve solo los pedidos cambiados desde
+    entonces y en 'removed' los que dejaron de estar en taller, para sondear sin recargar todo.
+    """
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 50, type=int), 1), 200)
+    since_raw = request.args.get('since')
+    since = None
+    if since_raw:
         try:
-            items = p.items.all()
-        except Exception:
-            items = list(p.items or [])
-        if items and all((i.workshop_status == 'asignado' and i.workshop_id) for i in items):
-            data.append({
-                'id': p.id,
-                'code': p.code,
-                'cliente': p.client.name if p.client else '',
-                'status': p.status,
-                'items': [serialize_workshop_item(it) for it in items]
-            })
-    return jsonify(data)
+            since = datetime.fromisoformat(since_raw)
+        except ValueError:
+            return jsonify({'error': 'Parametro since invalido'}), 400
+    server_time = datetime.utcnow()
+
+    assigned = func.sum(case((and_(
+        CustomOrderItem.workshop_status == 'asignado', CustomOrderItem.workshop_id.isnot(None)
+    ), 1), else_=0))
+    en_taller_ids = db.session.query(CustomOrderItem.order_id).group_by(CustomOrderItem.order_id).having(
+        assigned == func.count(CustomOrderItem.id)
+    )
+    query = CustomOrder.query.options(joinedload(CustomOrder.client)).filter(
+        CustomOrder.is_deleted == False,
+        CustomOrder.id.in_(en_taller_ids)
+    )
+    removed = []
+    if since is not None:
+        query = query.filter(CustomOrder.updated_at >= since)
+        removed = [row.id for row in db.session.query(CustomOrder.id).filter(
+            CustomOrder.updated_at >= since,
+            or_(CustomOrder.is_deleted == True, CustomOrder.id.notin_(en_taller_ids))
+        ).all()]
+    pedidos = query.order_by(CustomOrder.created_at.desc(), CustomOrder.id.desc()).offset(
+        (page - 1) * per_page
+    ).limit(per_page + 1).all()
+    has_next = len(pedidos) > per_page
+    pedidos = pedidos[:per_page]
+
+    # Prendas de toda la pagina (con su taller) en una sola consulta
+    items_by_order = {}
+    if pedidos:
+        items = CustomOrderItem.query.options(joinedload(CustomOrderItem.workshop)).filter(
+            CustomOrderItem.order_id.in_([p.id for p in pedidos])
+        ).order_by(CustomOrderItem.id).all()
+        for it in items:
+            items_by_order.setdefault(it.order_id, []).append(it)
+    data = [{
+        'id': p.id,
+        'code': p.code,
+        'cliente': p.client.name if p.client else '',
+        'status': p.status,
+        'updated_at': p.updated_at.isoformat() if p.updated_at else None,
+        'items': [serialize_workshop_item(it) for it in items_by_order.get(p.id, [])]
+    } for p in pedidos]
+    return jsonify({
+        'pedidos': data,
+        'removed': removed,
+        'page': page,
+        'per_page': per_page,
+        'has_next': has_next,
+        'server_time': server_time.isoformat()
+    })
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -2658,14 +5482,19 @@ def api_pedidos_en_taller():
 # -------------------------------------------------
 
 
-def _custom_order_client_choices():
-    choices = [(0, 'Nuevo cliente')]
-    for c in Client.query.filter_by(is_deleted=False).order_by(Client.name).all():
-        phone = c.phone or 'Sin telefono'
-        doc = f" · {c.id_number}" if c.id_number else ''
-        label = f"{c.name} ({phone}){doc}"
-        choices.append((c.id, label))
-    return choices
+def _active_client(client_id):
+    """Cliente activo por id (una busqueda por clave primaria) o None."""
+    if not client_id:
+        return None
+    client = db.session.get(Client, client_id)
+    return client if client and not client.is_deleted else None
+
+
+def _render_custom_order_form(form):
+    return render_template(
+        'admin/custom_order_form.html', form=form, nuevo=True,
+        selected_client=_active_client(form.client_id.data)
+    )
 
 
 def _tailor_user_choices():
@@ -2680,6 +5509,7 @@ def admin_custom_orders():
         abort(403)
     tailor_only = False
     page = request.args.get('page', 1, type=int)
+    after = request.args.get('after', '', type=str)
     client_id = request.args.get('cliente', type=int)
     garment = request.args.get('tipo', '', type=str)
     estado = request.args.get('estado', '', type=str)
@@ -2708,8 +5538,10 @@ def admin_custom_orders():
     if not estado:
         query = query.filter(CustomOrder.status != 'entregado')
 
-    pagination = db.paginate(query.order_by(CustomOrder.created_at.desc()), page=page, per_page=15, error_out=False)
-    clients = Client.query.filter_by(is_deleted=False).order_by(Client.name).all()
+    pagination = paginate_listing(
+        query, 'recientes', (CustomOrder.created_at, True, attrgetter('created_at')),
+        CustomOrder.id, page, 15, after
+    )
     today = datetime.utcnow().date()
     soon_orders = base_query.filter(
         CustomOrder.delivery_date != None,
@@ -2717,19 +5549,11 @@ def admin_custom_orders():
     ).order_by(CustomOrder.delivery_date.asc()).all()
     agenda_items = base_query.filter(CustomOrder.delivery_date != None).order_by(CustomOrder.delivery_date.asc(), CustomOrder.is_urgent.desc()).limit(100).all()
     urgentes_count = base_query.filter(CustomOrder.is_urgent == True).count()
-    changed = False
-    for p in pagination.items:
-        prev = p.status
-        refresh_order_workshop_status(p)
-        if p.status != prev:
-            changed = True
-    if changed:
-        db.session.commit()
 
     return render_template('admin/custom_orders.html',
         pedidos=pagination.items,
         pagination=pagination,
-        clients=clients,
+        filtro_cliente_obj=_active_client(client_id),
         tipos=CUSTOM_ORDER_TYPES,
         estados=CUSTOM_ORDER_STATUSES,
         estado_labels=CUSTOM_ORDER_STATUS_LABELS,
@@ -2848,6 +5672,7 @@ def admin_workshop_eliminar(workshop_id):
     """Elimina taller y libera prendas asociadas."""
     taller = Workshop.query.get_or_404(workshop_id)
     for item in CustomOrderItem.query.filter_by(workshop_id=taller.id).all():
+        track_item_status(item.order, item.workshop_status or 'pendiente', 'pendiente')
         item.workshop_id = None
         item.workshop_status = 'pendiente'
         item.workshop_assigned_at = None
@@ -2867,6 +5692,7 @@ def admin_custom_orders_entregados():
         abort(403)
     tailor_only = False
     page = request.args.get('page', 1, type=int)
+    after = request.args.get('after', '', type=str)
     search_term = (request.args.get('q') or '').strip()
     base_q = CustomOrder.query.filter_by(is_deleted=False, status='entregado')
     if search_term:
@@ -2877,11 +5703,9 @@ def admin_custom_orders_entregados():
                 Client.name.ilike(like)
             )
         )
-    pagination = db.paginate(
-        base_q.order_by(CustomOrder.updated_at.desc()),
-        page=page,
-        per_page=15,
-        error_out=False
+    pagination = paginate_listing(
+        base_q, 'actualizados', (CustomOrder.updated_at, True, attrgetter('updated_at')),
+        CustomOrder.id, page, 15, after
     )
     return render_template(
         'admin/custom_orders_delivered.html',
@@ -2900,7 +5724,7 @@ def admin_custom_order_entregado_detalle(order_id):
     pedido = CustomOrder.query.filter_by(id=order_id, is_deleted=False, status='entregado').first_or_404()
     if not (current_user.is_superadmin or has_permission(current_user, 'manage_custom_orders')):
         abort(403)
-    history = get_custom_order_history(pedido)
+    history = get_custom_order_history(pedido, request.args.get('hpage', 1, type=int))
     return render_template(
         'admin/custom_order_delivered_detail.html',
         pedido=pedido,
@@ -2916,7 +5740,7 @@ def admin_tailor_order_detalle(order_id):
     pedido = CustomOrder.query.filter_by(id=order_id, is_deleted=False).first_or_404()
     if not tailor_can_access_order(current_user, pedido):
         abort(403)
-    history = get_custom_order_history(pedido)
+    history = get_custom_order_history(pedido, request.args.get('hpage', 1, type=int))
     return render_template(
         'admin/tailor_order_detail.html',
         pedido=pedido,
@@ -2932,7 +5756,6 @@ def admin_tailor_order_detalle(order_id):
 def admin_custom_order_nuevo():
     """Crear pedido personalizado"""
     form = CustomOrderForm()
-    form.client_id.choices = _custom_order_client_choices()
     form.assigned_to.choices = [(0, 'Asignacion por prenda (sin taller de pedido)')]
     prefill_client = request.args.get('cliente', type=int)
     if request.method == 'GET':
@@ -2952,28 +5775,32 @@ def admin_custom_order_nuevo():
             items_data = []
         if not items_data:
             flash('Debes agregar al menos una prenda al pedido.', 'warning')
-            return render_template('admin/custom_order_form.html', form=form, nuevo=True)
+            return _render_custom_order_form(form)
         
         if not form.delivery_date.data:
             flash('La fecha de entrega es obligatoria.', 'warning')
-            return render_template('admin/custom_order_form.html', form=form, nuevo=True)
+            return _render_custom_order_form(form)
 
         client = None
-        if form.client_id.data and form.client_id.data != 0:
-            client = Client.query.get(form.client_id.data)
-            if client and client.is_deleted:
+        if form.client_id.data:
+            client = db.session.get(Client, form.client_id.data)
+            if not client:
+                flash('El cliente seleccionado no existe.', 'danger')
+                form.client_id.data = 0
+                return _render_custom_order_form(form)
+            if client.is_deleted:
                 flash('El cliente seleccionado está en papelera. Restaura primero para usarlo.', 'danger')
-                return render_template('admin/custom_order_form.html', form=form, nuevo=True)
+                return _render_custom_order_form(form)
         if not client:
             if not form.new_client_name.data:
                 flash('Debes seleccionar un cliente o ingresar nombre.', 'warning')
-                return render_template('admin/custom_order_form.html', form=form, nuevo=True)
+                return _render_custom_order_form(form)
             # Evitar duplicar clientes con el mismo nombre
             name_val = form.new_client_name.data.strip()
-            existing = Client.query.filter(func.lower(Client.name) == name_val.lower()).first()
+            existing = find_duplicate_client(name_val)
             if existing:
                 flash('Ya existe un cliente con ese nombre, selecciona el existente.', 'warning')
-                return render_template('admin/custom_order_form.html', form=form, nuevo=True)
+                return _render_custom_order_form(form)
             phone_val = (form.new_client_phone.data or '').strip()
             id_number_val = (getattr(form, 'new_client_id_number', None).data if hasattr(form, 'new_client_id_number') else None)
             client = Client(
@@ -2984,14 +5811,9 @@ def admin_custom_order_nuevo():
             db.session.add(client)
             db.session.flush()
 
-        code = generate_custom_order_code()
-        while CustomOrder.query.filter_by(code=code).first():
-            code = generate_custom_order_code()
-
         first_item = items_data[0]
         order_measurements = first_item.get('measurements', {})
         order = CustomOrder(
-            code=code,
             client_id=client.id,
             garment_type=first_item.get('garment_type'),
             delivery_date=form.delivery_date.data,
@@ -3005,8 +5827,8 @@ def admin_custom_order_nuevo():
             assigned_to=None,
             assigned_at=None
         )
-        db.session.add(order)
-        db.session.flush()
+        order.items_total = len(items_data)
+        add_with_unique_code(order, 'code', generate_custom_order_code)
 
         # Crear prendas asociadas
         for item in items_data:
@@ -3024,8 +5846,9 @@ def admin_custom_order_nuevo():
 
         actor = current_user.name or current_user.username if current_user.is_authenticated else 'sistema'
         append_custom_order_history(order, form.status.data, 'Estado inicial', user=actor)
-        db.session.commit()
+        db.session.flush()
 
+        # El archivo subido solo existe durante la peticion; se guarda aqui y en el mismo commit
         files = request.files.getlist('images')
         saved = save_custom_order_images(files, order)
         for rel in saved:
@@ -3037,7 +5860,7 @@ def admin_custom_order_nuevo():
             return redirect(url_for('admin_custom_order_nuevo', cliente=client.id))
         return redirect(url_for('admin_custom_order_detalle', order_id=order.id))
 
-    return render_template('admin/custom_order_form.html', form=form, nuevo=True)
+    return _render_custom_order_form(form)
 
 
 @app.route('/admin/pedidos-personalizados/<int:order_id>')
@@ -3047,7 +5870,7 @@ def admin_custom_order_detalle(order_id):
     pedido = CustomOrder.query.filter_by(id=order_id, is_deleted=False).first_or_404()
     if not tailor_can_access_order(current_user, pedido):
         abort(403)
-    history = get_custom_order_history(pedido)
+    history = get_custom_order_history(pedido, request.args.get('hpage', 1, type=int))
     tailor_only = False
     workshops = Workshop.query.order_by(Workshop.name).all()
     workshops_json = [{'id': w.id, 'name': w.name, 'phone': w.phone} for w in workshops]
@@ -3180,6 +6003,7 @@ def admin_custom_order_item_nuevo(order_id):
             measurements=measures
         )
         db.session.add(item)
+        track_item_status(pedido, None, 'pendiente')
         # Actualizar ultimo tipo/medidas en el cliente para esta prenda
         cliente = pedido.client
         if measures:
@@ -3190,6 +6014,7 @@ def admin_custom_order_item_nuevo(order_id):
         if medidas_count:
             note += f' ({medidas_count} medidas)'
         append_custom_order_history(pedido, pedido.status, note, user=(current_user.name or current_user.username))
+        refresh_order_workshop_status(pedido)
         db.session.commit()
         flash('Prenda agregada al pedido.', 'success')
     else:
@@ -3249,7 +6074,9 @@ def admin_custom_order_item_eliminar(order_id, item_id):
     if item.order_id != pedido.id:
         abort(404)
     db.session.delete(item)
+    track_item_status(pedido, item.workshop_status or 'pendiente', None)
     append_custom_order_history(pedido, pedido.status, f'Prenda eliminada: {item.garment_type}', user=(current_user.name or current_user.username))
+    refresh_order_workshop_status(pedido)
     db.session.commit()
     flash('Prenda eliminada del pedido.', 'warning')
     return redirect(url_for('admin_custom_order_detalle', order_id=pedido.id))
@@ -3449,20 +6276,12 @@ def admin_cliente_editar(id):
                 medidas,
                 current_user.username if current_user.is_authenticated else 'sistema'
             )
-            # Propagar cambios a prendas en pedidos del cliente para este tipo
-            for pedido in cliente.custom_orders:
-                updated_items = []
-                for item in pedido.items.filter_by(garment_type=form.garment_type.data).all():
-                    if (item.measurements or {}) != medidas:
-                        item.measurements = medidas
-                        flag_modified(item, 'measurements')
-                        updated_items.append(item.id)
-                if updated_items:
-                    actor = current_user.name or current_user.username
-                    note = f'Medidas de cliente actualizadas por {actor} para {form.garment_type.data}'
-                    if changes_text:
-                        note += f' | Cambios: {changes_text}'
-                    append_custom_order_history(pedido, pedido.status, note, user=actor)
+            # Propagar cambios a prendas de este tipo en pedidos en curso del cliente
+            actor = current_user.name or current_user.username
+            note = f'Medidas de cliente actualizadas por {actor} para {form.garment_type.data}'
+            if changes_text:
+                note += f' | Cambios: {changes_text}'
+            propagate_client_measurements(cliente, form.garment_type.data, medidas, note, user=actor)
         db.session.commit()
         flash('Cliente actualizado.', 'success')
         return redirect(url_for('admin_clientes'))
@@ -3470,25 +6289,35 @@ def admin_cliente_editar(id):
     return render_template('admin/cliente_form.html', form=form, cliente=cliente, nuevo=False)
 
 
-@app.route('/api/clientes/buscar')
+@app.route('/api/clientes/<int:client_id>/medidas/propagacion')
 @login_required
 @permission_required('manage_clients')
+def api_cliente_medidas_propagacion(client_id):
+    """Vista previa: cuantas prendas en pedidos en curso cambiarian con estas medidas."""
+    cliente = Client.query.filter_by(id=client_id, is_deleted=False).first_or_404()
+    prenda = request.args.get('prenda')
+    if not prenda:
+        abort(400, description='Falta el tipo de prenda')
+    medidas = {f: request.args[f] for f in MEASUREMENT_FIELDS if request.args.get(f)}
+    if not medidas:
+        return jsonify({'items': 0, 'orders': 0})
+    items, orders = propagate_client_measurements(cliente, prenda, medidas, dry_run=True)
+    return jsonify({'items': items, 'orders': orders})
+
+
+@app.route('/api/clientes/buscar')
+@login_required
 def api_clientes_buscar():
-    """Buscar clientes por nombre o telefono"""
+    """Buscar clientes por nombre, telefono o carnet (paginado, para autocompletar)"""
+    can_search = has_permission(current_user, 'manage_clients') or has_permission(current_user, 'manage_custom_orders') or getattr(current_user, 'is_superadmin', False)
+    if not can_search:
+        abort(403)
     term = (request.args.get('q') or '').strip()
-    if not term:
-        return jsonify([])
-    like_term = f"%{term}%"
-    results = Client.query.filter(
-        Client.is_deleted == False,
-        or_(
-            Client.phone.ilike(like_term),
-            Client.name.ilike(like_term),
-            Client.id_number.ilike(like_term)
-        )
-    ).order_by(Client.name).limit(8).all()
-    data = [{'id': c.id, 'name': c.name, 'phone': c.phone, 'id_number': c.id_number} for c in results]
-    return jsonify(data)
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 8, type=int), 1), 50)
+    results = search_clients(term, limit=per_page + 1, offset=(page - 1) * per_page) if term else []
+    data = [{'id': c.id, 'name': c.name, 'phone': c.phone, 'id_number': c.id_number} for c in results[:per_page]]
+    return jsonify({'results': data, 'page': page, 'per_page': per_page, 'has_next': len(results) > per_page})
 
 
 @app.route('/api/clientes', methods=['POST'])
@@ -3501,13 +6330,7 @@ def api_clientes_crear():
     id_number = (payload.get('id_number') or '').strip()
     if not name:
         return jsonify({'error': 'El nombre es obligatorio'}), 400
-    existing = None
-    if phone:
-        existing = Client.query.filter(func.lower(Client.phone) == phone.lower()).first()
-    if not existing and id_number:
-        existing = Client.query.filter(func.lower(Client.id_number) == id_number.lower()).first()
-    if not existing:
-        existing = Client.query.filter(func.lower(Client.name) == name.lower()).first()
+    existing = find_duplicate_client(name, phone, id_number)
     if existing:
         return jsonify({'error': 'Ya existe un cliente con esos datos', 'id': existing.id}), 409
     cliente = Client(name=name, phone=phone, id_number=id_number or None)
@@ -3531,6 +6354,18 @@ def api_cliente_medidas(client_id):
         abort(403)
     if request.method == 'GET':
         prenda = request.args.get('prenda')
+        if request.args.get('historial') == '1':
+            query = cliente.measurement_revisions
+            if prenda:
+                query = query.filter_by(garment_type=prenda)
+            limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+            revisions = query.order_by(ClientMeasurementRevision.id.desc()).limit(limit).all()
+            return jsonify([{
+                'garment_type': rev.garment_type,
+                'changes': rev.changes,
+                'actor': rev.actor,
+                'fecha': rev.fecha
+            } for rev in revisions])
         data = (cliente.measurements or {}).get(prenda or '', {}) if prenda else (cliente.measurements or {})
         return jsonify(data)
     
@@ -3578,6 +6413,10 @@ def server_error(e):
 #                           INICIO
 # ═══════════════════════════════════════════════════════════════════════════
 
+# Al importar solo se lee la version del esquema (ver check_schema_version)
+with app.app_context():
+    check_schema_version()
+
 if __name__ == '__main__':
     with app.app_context():
         init_db()
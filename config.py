@@ -19,6 +19,10 @@ class Config:
     PROFILE_FOLDER = os.path.join(basedir, 'static', 'perfiles')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16 MB
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+    # Derivados de imagenes de producto (ancho maximo en px por uso)
+    IMAGE_VARIANT_WIDTHS = {'card': 480, 'detail': 960, 'zoom': 1600}
+    IMAGE_WEBP_QUALITY = int(os.environ.get('IMAGE_WEBP_QUALITY', 80))
+    IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', 82))
     
     # Sesión
     PERMANENT_SESSION_LIFETIME = timedelta(days=7)
@@ -28,6 +32,51 @@ class Config:
     
     # Paginación
     PRODUCTS_PER_PAGE = 12
+    ORDERS_PER_PAGE = int(os.environ.get('ORDERS_PER_PAGE', 25))
+    HISTORY_PER_PAGE = int(os.environ.get('HISTORY_PER_PAGE', 20))
+    # Últimas páginas numeradas; desde ahí se sigue por cursor (0 = solo números)
+    KEYSET_PAGE_LIMIT = int(os.environ.get('KEYSET_PAGE_LIMIT', 5))
+
+    # Migraciones de esquema: aplicar las pendientes al iniciar (0 = solo con flask db-upgrade)
+    MIGRATIONS_AUTO_APPLY = os.environ.get('MIGRATIONS_AUTO_APPLY', '1') == '1'
+
+    # Cache (segundos entre lecturas de la version compartida en BD)
+    CACHE_VERSION_CHECK_SECONDS = float(os.environ.get('CACHE_VERSION_CHECK_SECONDS', 5))
+    HOME_SECTIONS_TTL = float(os.environ.get('HOME_SECTIONS_TTL', 300))
+
+    # Cache de paginas publicas para visitantes anonimos
+    PAGE_CACHE_ENABLED = os.environ.get('PAGE_CACHE_ENABLED', '1') == '1'
+    PAGE_CACHE_TTL = float(os.environ.get('PAGE_CACHE_TTL', 60))
+    PAGE_CACHE_MAX_ENTRIES = int(os.environ.get('PAGE_CACHE_MAX_ENTRIES', 256))
+    PAGE_CACHE_DIR = os.environ.get('PAGE_CACHE_DIR')  # Opcional: cache en disco compartida por workers
+
+    # Cola de tareas: 'thread' (hilo en cada proceso web), 'worker' (flask jobs-worker) o 'inline'
+    JOBS_MODE = os.environ.get('JOBS_MODE', 'thread')
+    JOBS_POLL_INTERVAL = float(os.environ.get('JOBS_POLL_INTERVAL', 5))
+    JOBS_MAX_ATTEMPTS = int(os.environ.get('JOBS_MAX_ATTEMPTS', 3))
+    JOBS_RETRY_DELAY = float(os.environ.get('JOBS_RETRY_DELAY', 30))
+    JOBS_LOCK_TIMEOUT = float(os.environ.get('JOBS_LOCK_TIMEOUT', 600))
+    JOBS_REQUEUE_INTERVAL = float(os.environ.get('JOBS_REQUEUE_INTERVAL', 60))  # Revision de tareas de workers caidos
+
+    # Reservas de stock durante el pago en PayPal (segundos)
+    STOCK_RESERVATION_TTL = int(os.environ.get('STOCK_RESERVATION_TTL', 900))
+    STOCK_SWEEP_INTERVAL = float(os.environ.get('STOCK_SWEEP_INTERVAL', 60))
+
+    # Claves de idempotencia del checkout (segundos de validez y entre purgas de vencidas)
+    IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 86400))
+    IDEMPOTENCY_PURGE_INTERVAL = float(os.environ.get('IDEMPOTENCY_PURGE_INTERVAL', 600))
+
+    # Estadisticas del panel (dia local de los resumenes y dias mostrados en los graficos)
+    STATS_UTC_OFFSET_HOURS = float(os.environ.get('STATS_UTC_OFFSET_HOURS', -4))
+    STATS_DASHBOARD_DAYS = int(os.environ.get('STATS_DASHBOARD_DAYS', 30))
+
+    # Historial de medidas de clientes (revisiones por cliente y prenda, y dias de retencion; 0 = sin limite)
+    CLIENT_MEASUREMENT_REVISIONS_KEEP = int(os.environ.get('CLIENT_MEASUREMENT_REVISIONS_KEEP', 20))
+    CLIENT_MEASUREMENT_REVISIONS_DAYS = int(os.environ.get('CLIENT_MEASUREMENT_REVISIONS_DAYS', 730))
+
+    # Contador de visitas (se acumula en memoria y se escribe por lotes)
+    VIEW_FLUSH_INTERVAL = float(os.environ.get('VIEW_FLUSH_INTERVAL', 30))
+    VIEW_FLUSH_THRESHOLD = int(os.environ.get('VIEW_FLUSH_THRESHOLD', 50))
     
     # Integraciones
     PAYPAL_CLIENT_ID = os.environ.get(
@@ -42,6 +91,12 @@ class Config:
     PAYPAL_PERCENT_FEE = float(os.environ.get('PAYPAL_PERCENT_FEE', 0.0349))
     PAYPAL_FIXED_FEE = float(os.environ.get('PAYPAL_FIXED_FEE', 0.30))
     PAYPAL_ENVIRONMENT = os.environ.get('PAYPAL_ENVIRONMENT', 'sandbox')
+    PAYPAL_API_BASE = os.environ.get('PAYPAL_API_BASE')  # Opcional: otra URL (p. ej. stub local en pruebas)
+    PAYPAL_TIMEOUT = float(os.environ.get('PAYPAL_TIMEOUT', 10))
+    PAYPAL_RETRIES = int(os.environ.get('PAYPAL_RETRIES', 2))
+    # 'async': el pedido queda pendiente y la cola captura/concilia; 'sync': captura en la peticion
+    PAYPAL_CAPTURE_MODE = os.environ.get('PAYPAL_CAPTURE_MODE', 'async')
+    PAYPAL_RECONCILE_ATTEMPTS = int(os.environ.get('PAYPAL_RECONCILE_ATTEMPTS', 8))
     
     # Información de la tienda
     STORE_NAME = 'Modas Pathy'